@@ -1,19 +1,51 @@
-from dotenv import load_dotenv
-load_dotenv()
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
 
 from fastapi import FastAPI, Request
-
-from easypcm.config import MASTER_USER_ID, INVITE_EXPIRES_DAYS
-from easypcm.db import engine, SessionLocal
-from easypcm.models import Base
-
-from datetime import datetime, timezone
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse
+from sqlalchemy.orm.exc import StaleDataError
+
+from easypcm.config import (
+    MASTER_USER_ID,
+    INVITE_EXPIRES_DAYS,
+    OUTBOX_WORKER_ENABLED,
+    ARCHIVE_WORKER_ENABLED,
+    BACKUP_WORKER_ENABLED,
+    PREVENTIVE_WORKER_ENABLED,
+    READY_MAX_DB_WRITE_MS,
+    READY_MAX_OUTBOX_BACKLOG,
+    READY_MAX_OUTBOX_AGE_SEC,
+    DUP_MIN_SIMILARITY,
+    validate_config,
+)
+from easypcm.db import (
+    ReadSessionLocal, SessionLocal, SCHEMA_READY, SHARD_BY_ORG, for_each_engine, init_db, read_session, route_to_org,
+)
+from easypcm.outbox import (
+    queue_message,
+    queue_edit_text,
+    queue_edit_markup,
+    queue_answer_callback,
+    take_inline_reply,
+    forget_rolled_back,
+    outbox_worker,
+)
+from easypcm.archive import archive_worker
+from easypcm.backup import backup_worker
+from easypcm.preventive import first_due, parse_rule, preventive_worker
 from easypcm.telegram import (
-    send_message,
     main_menu_keyboard,
     close_os_inline_keyboard,
+    batch_close_inline_keyboard,
     update_os_inline_keyboard,
     status_inline_keyboard,
+    view_os_inline_keyboard,
+    os_card_inline_keyboard,
+    duplicate_inline_keyboard,
 )
 from easypcm.repository import (
     register_event_if_new,
@@ -22,6 +54,14 @@ from easypcm.repository import (
     get_org_by_id,
     get_user_org_id,
     get_user_role_in_org,
+    recover_org_commit,
+    list_notification_subscriptions,
+    add_notification_subscription,
+    remove_notification_subscription,
+    create_preventive_plan,
+    list_preventive_plans,
+    count_preventive_plans,
+    deactivate_preventive_plan,
     create_invite,
     consume_invite,
 
@@ -29,24 +69,112 @@ from easypcm.repository import (
     set_state,
     clear_state,
     create_open_work_order,
+    attach_report_to_work_order,
     list_open_work_orders,
+    get_work_order,
+    get_work_orders,
+    get_work_order_version,
+    get_archived_work_order,
+    get_work_order_card,
+    search_work_orders,
+    list_equipment_history,
+    status_time_report,
     close_work_order,
     add_materials,
     list_materials,
     add_technicians_to_os,
     list_technicians_for_os,
     update_work_order_status,
+    outbox_due_backlog,
+    probe_db_write,
+    WorkOrderConflict,
+    DuplicateWorkOrder,
+    ARCHIVED_STATUSES,
 )
 from easypcm.ui_labels import (
     BTN_OPEN, BTN_UPDATE, BTN_CLOSE, BTN_CONSULT,
-    CMD_OPEN, CMD_UPDATE, CMD_CLOSE,
+    CMD_OPEN, CMD_UPDATE, CMD_CLOSE, CMD_CLOSE_BATCH, CMD_CONSULT, CMD_HISTORY, CMD_BOTTLENECKS, CMD_PREVENTIVE,
     CMD_MENU_1, CMD_MENU_2, CMD_MENU_3,
-    CB_CLOSE_PREFIX, CB_UPDATE_PREFIX, CB_STATUS_PREFIX,
+    CB_CLOSE_PREFIX, CB_UPDATE_PREFIX, CB_STATUS_PREFIX, CB_VIEW_PREFIX, CB_HISTORY_PREFIX,
+    CB_DUP_PREFIX, CB_CLOSE_PAGE_PREFIX, CB_UPDATE_PAGE_PREFIX, CB_BATCH_PREFIX,
+    PICKER_PAGE_SIZE, BATCH_CLOSE_MAX, STATUS_OPTIONS, STATUS_FECHADA, CONSULT_MAX_RESULTS, HISTORY_MAX_RESULTS,
+    WAITING_STATUSES, BOTTLENECK_DEFAULT_DAYS, BOTTLENECK_MAX_DAYS, BOTTLENECK_MAX_LINES,
+    PREVENTIVE_LIST_MAX,
 )
 from easypcm.ui_texts import TXT
+from easypcm.instrumentation import install_db_hooks, metrics_exporter, tag, track_update
+from easypcm.notifications import EVENT_MACHINE_DOWN, EVENT_PREVENTIVE, ROLE_ALIASES, notify_machine_down
+from easypcm.log import log_event, setup_logging, stop_logging
 
-app = FastAPI()
-Base.metadata.create_all(bind=engine)
+log = logging.getLogger("easypcm.webhook")
+
+_started = False
+
+
+def startup() -> None:
+    """
+    Tudo que tem efeito colateral fica aqui, e não no import do módulo:
+    validação da config, schema, hooks do banco, log, exportação das métricas e
+    workers (outbox, arquivo, backup, preventivas).
+    Chamado pelo lifespan; benches que não passam pelo lifespan chamam direto.
+    """
+    global _started
+    if _started:
+        return
+    validate_config()
+    if not SCHEMA_READY:
+        # sob serve.py o processo pai já fez isso uma vez, antes dos workers
+        init_db()
+    for_each_engine(install_db_hooks)
+    setup_logging()
+    # só com METRICS_DIR (serve.py): o /metrics de qualquer worker soma todos
+    metrics_exporter.start()
+    if OUTBOX_WORKER_ENABLED:
+        outbox_worker.start()
+    if ARCHIVE_WORKER_ENABLED:
+        archive_worker.start()
+    if BACKUP_WORKER_ENABLED:
+        backup_worker.start()
+    if PREVENTIVE_WORKER_ENABLED:
+        preventive_worker.start()
+    _started = True
+
+
+def shutdown() -> None:
+    global _started
+    if PREVENTIVE_WORKER_ENABLED:
+        preventive_worker.stop()
+    if ARCHIVE_WORKER_ENABLED:
+        archive_worker.stop()
+    if BACKUP_WORKER_ENABLED:
+        backup_worker.stop()
+    if OUTBOX_WORKER_ENABLED:
+        outbox_worker.stop()
+        outbox_worker.drain()
+    metrics_exporter.stop()
+    stop_logging()
+    _started = False
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    startup()
+    try:
+        yield
+    finally:
+        shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def _instrument_updates(request: Request, call_next):
+    # tempo, SQL, commits e chamadas ao Bot API de cada update
+    if request.url.path != "/telegram/webhook":
+        return await call_next(request)
+    with track_update():
+        return await call_next(request)
 
 
 @app.get("/health")
@@ -54,6 +182,52 @@ def health():
     return {"ok": True}
 
 
+@app.get("/ready")
+def ready():
+    """
+    Prontidão de verdade: o banco aceita escrita a tempo e o outbox está
+    andando. 503 tira a instância do balanceador enquanto estiver saturada.
+    """
+    checks = {}
+    db = SessionLocal()
+    try:
+        try:
+            write_ms = probe_db_write(db)
+            checks["db_write"] = {"ok": write_ms <= READY_MAX_DB_WRITE_MS, "ms": round(write_ms, 2)}
+        except Exception as e:
+            checks["db_write"] = {"ok": False, "error": str(e)}
+
+        try:
+            due, oldest_age = outbox_due_backlog(db)
+            checks["outbox"] = {
+                "ok": due <= READY_MAX_OUTBOX_BACKLOG and oldest_age <= READY_MAX_OUTBOX_AGE_SEC,
+                "due": due,
+                "oldest_age_sec": round(oldest_age, 1),
+            }
+        except Exception as e:
+            checks["outbox"] = {"ok": False, "error": str(e)}
+    finally:
+        db.close()
+
+    if OUTBOX_WORKER_ENABLED:
+        checks["outbox_worker"] = {"ok": outbox_worker.is_alive()}
+
+    ok = all(c["ok"] for c in checks.values())
+    return JSONResponse({"ok": ok, "checks": checks}, status_code=200 if ok else 503)
+
+
+@app.get("/metrics")
+def metrics():
+    from easypcm.metrics import render_metrics  # só carrega quem for raspado
+
+    db = ReadSessionLocal()
+    try:
+        body = render_metrics(db)
+    finally:
+        db.close()
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
+
+
 @app.get("/")
 def home():
     return {"status": "Servidor rodando"}
@@ -146,6 +320,492 @@ def _parse_technicians_list(text: str) -> list[str]:
     return [p for p in parts if p]
 
 
+def _minutes_between(inicio_min: int, fim_min: int) -> int:
+    # serviço que virou a meia-noite (ex: 23:30 -> 01:10)
+    if fim_min < inicio_min:
+        fim_min += 24 * 60
+    return max(0, fim_min - inicio_min)
+
+
+def _parse_time_span(text: str) -> int | None:
+    """Aceita "HH:MM-HH:MM" ou o tempo total ("TOTAL 3h", "180") e retorna minutos."""
+    t = (text or "").strip()
+    if "-" in t:
+        parts = t.split("-")
+        if len(parts) != 2:
+            return None
+        inicio_min = _parse_hhmm(parts[0])
+        fim_min = _parse_hhmm(parts[1])
+        if inicio_min is None or fim_min is None:
+            return None
+        return _minutes_between(inicio_min, fim_min)
+    return _parse_total_duration_minutes(t)
+
+
+def _parse_parada(text: str) -> str | None:
+    val = (text or "").strip().upper()
+    if val in ("NAO", "NÃO"):
+        return "NÃO"
+    if val == "SIM":
+        return val
+    return None
+
+
+def _split_inline_fields(text: str) -> list[str]:
+    return [p.strip() for p in (text or "").split("|")]
+
+
+def _open_os(
+    db,
+    st,
+    org_id: int,
+    chat_id: str,
+    telegram_user_id: str,
+    equipamento: str,
+    setor: str,
+    problema: str,
+    parada: str,
+    reply_markup=None,
+    check_duplicate: bool = True,
+) -> None:
+    """
+    Abre a OS (alerta de máquina parada, resposta e limpeza do estado).
+    Se já houver OS aberta parecida do mesmo equipamento, não cria: guarda os
+    dados no estado e pergunta se anexa à existente (OPEN_FLOW/CONFIRM_DUP).
+    """
+    try:
+        wo = create_open_work_order(
+            db,
+            org_id=org_id,
+            chat_id=chat_id,
+            equipamento=equipamento,
+            setor=setor,
+            problema=problema,
+            maquina_parada=parada,
+            commit=False,
+            dup_min_similarity=DUP_MIN_SIMILARITY if check_duplicate else None,
+        )
+    except DuplicateWorkOrder as e:
+        dup = e.work_order
+        st.temp_equipamento = equipamento
+        st.temp_setor = setor
+        st.temp_problema = problema
+        st.temp_maquina_parada = parada
+        st.temp_os_version = dup.version
+        tag(step="CONFIRM_DUP")
+        queue_message(
+            db,
+            chat_id,
+            TXT.dup_found(dup.id, dup.equipamento, dup.descricao_do_problema, _format_dt(dup.abertura_em, "%d/%m/%Y %H:%M")),
+            reply_markup=duplicate_inline_keyboard(dup.id),
+        )
+        set_state(db, st, mode="OPEN_FLOW", step="CONFIRM_DUP", os_id=dup.id)
+        return
+
+    notify_machine_down(db, wo, exclude_user_id=telegram_user_id)
+    queue_message(
+        db,
+        chat_id,
+        TXT.open_done(wo.id, wo.equipamento, wo.setor, wo.maquina_parada, wo.descricao_do_problema),
+        reply_markup=reply_markup,
+    )
+    clear_state(db, st)
+
+
+def _close_date_text(fech_dt: datetime | None) -> str:
+    # formatted date for summary message
+    return (fech_dt or datetime.now(timezone.utc)).astimezone(timezone.utc).strftime("%d/%m/%Y")
+
+
+def _close_os(
+    db,
+    st,
+    org_id: int,
+    os_id: int,
+    chat_id: str,
+    fech_dt: datetime | None,
+    solucao: str,
+    tempo_min: int,
+    tecnicos: list[str],
+    materiais: list[str],
+    custo_pecas: str,
+    reply_markup: dict | None = None,
+    expected_version: int | None = None,
+) -> None:
+    """
+    Fecha a OS (técnicos, peças, fechamento, limpeza do estado e resposta)
+    em UMA transação. O fechamento vai primeiro: se outra pessoa gravou a OS
+    antes (WorkOrderConflict), nada de técnicos/peças chega a ser gravado.
+    """
+    wo = close_work_order(
+        db,
+        org_id=org_id,
+        os_id=os_id,
+        solucao=solucao,
+        tempo_min=tempo_min,
+        custo_pecas=custo_pecas,
+        fechamento_em=fech_dt,
+        commit=False,
+        expected_version=expected_version,
+    )
+
+    if tecnicos:
+        add_technicians_to_os(db, os_id, tecnicos, commit=False)
+    if materiais:
+        add_materials(db, os_id, materiais, commit=False)
+    db.flush()
+
+    techs_db = list_technicians_for_os(db, os_id)
+    tecnicos_txt = ", ".join(techs_db) if techs_db else "SEM INFORMAÇÃO"
+
+    mats = list_materials(db, os_id)
+    if mats:
+        mats_txt = ", ".join([m.descricao for m in mats[:6]])
+        if len(mats) > 6:
+            mats_txt += "..."
+    else:
+        mats_txt = "NENHUMA"
+
+    queue_message(
+        db,
+        chat_id,
+        TXT.close_done(
+            wo.id, wo.equipamento, wo.setor,
+            _close_date_text(fech_dt),
+            wo.tempo_gasto_minutos,
+            tecnicos_txt,
+            mats_txt,
+            wo.custo_pecas,
+            wo.solucao_aplicada,
+        ),
+        reply_markup=reply_markup,
+    )
+    clear_state(db, st, commit=False)
+    db.commit()
+
+
+def _batch_selection(st) -> dict[int, int]:
+    """OS marcadas no fechamento em lote: os_id -> versão de quando foi marcada."""
+    selected: dict[int, int] = {}
+    for item in (st.temp_lote or "").split(","):
+        os_id, _, version = item.partition(":")
+        if os_id.isdigit() and version.isdigit():
+            selected[int(os_id)] = int(version)
+    return selected
+
+
+def _set_batch_selection(st, selected: dict[int, int]) -> None:
+    st.temp_lote = ",".join(f"{os_id}:{version}" for os_id, version in selected.items())
+
+
+def _close_os_batch(
+    db,
+    st,
+    org_id: int,
+    selected: dict[int, int],
+    chat_id: str,
+    fech_dt: datetime | None,
+    solucao: str,
+    tempo_min: int,
+    tecnicos: list[str],
+    materiais: list[str],
+    custo_pecas: str,
+    reply_markup: dict | None = None,
+) -> None:
+    """
+    Fecha todas as OS marcadas (os_id -> versão) com as mesmas respostas em
+    UMA transação, na mesma ordem do _close_os. Se qualquer uma foi gravada
+    por outra pessoa depois de marcada (WorkOrderConflict), nenhuma é fechada.
+    """
+    rows = []
+    tecnicos_db: list[str] = []
+    for os_id, version in sorted(selected.items()):
+        wo = close_work_order(
+            db,
+            org_id=org_id,
+            os_id=os_id,
+            solucao=solucao,
+            tempo_min=tempo_min,
+            custo_pecas=custo_pecas,
+            fechamento_em=fech_dt,
+            commit=False,
+            expected_version=version,
+        )
+        if tecnicos:
+            tecnicos_db = add_technicians_to_os(db, os_id, tecnicos, commit=False)
+        if materiais:
+            add_materials(db, os_id, materiais, commit=False)
+        rows.append((wo.id, wo.equipamento, wo.setor))
+    db.flush()
+
+    # as respostas são as mesmas para todas: o resumo sai da última OS gravada
+    tecnicos_txt = ", ".join(dict.fromkeys(tecnicos_db)) if tecnicos_db else "SEM INFORMAÇÃO"
+    mats_txt = ", ".join(materiais[:6]) + ("..." if len(materiais) > 6 else "") if materiais else "NENHUMA"
+
+    queue_message(
+        db,
+        chat_id,
+        TXT.batch_close_done(
+            rows,
+            _close_date_text(fech_dt),
+            wo.tempo_gasto_minutos,
+            tecnicos_txt,
+            mats_txt,
+            wo.custo_pecas,
+            wo.solucao_aplicada,
+        ),
+        reply_markup=reply_markup,
+    )
+    clear_state(db, st, commit=False)
+    db.commit()
+
+
+def _open_os_picker_items(db, org_id: int, page: int) -> tuple[list[tuple[int, str]], bool]:
+    """Itens (id, resumo) de uma página do seletor de OS abertas + se há próxima página."""
+    abertas = list_open_work_orders(db, org_id, limit=PICKER_PAGE_SIZE + 1, offset=page * PICKER_PAGE_SIZE)
+    has_more = len(abertas) > PICKER_PAGE_SIZE
+
+    items = []
+    for wo in abertas[:PICKER_PAGE_SIZE]:
+        resumo = f"{wo.equipamento} - {wo.descricao_do_problema[:40].strip()}"
+        items.append((wo.id, resumo))
+    return items, has_more
+
+
+# rótulo de cada status e o caminho inverso para a busca da consulta
+# (aceita o valor do banco, com ou sem "_", e o rótulo do teclado)
+_STATUS_LABELS = dict((v, k) for k, v in STATUS_OPTIONS + [("Fechada", STATUS_FECHADA)])
+_STATUS_BY_TEXT = {}
+for _value, _label in _STATUS_LABELS.items():
+    _STATUS_BY_TEXT[_value] = _value
+    _STATUS_BY_TEXT[_value.replace("_", " ")] = _value
+    _STATUS_BY_TEXT[_label.upper()] = _value
+
+# fichas já montadas: (org_id, os_id) -> (version, texto). Toda gravação na OS
+# (inclusive o fechamento, que grava técnicos/peças na mesma transação) muda a
+# version; ficha com versão diferente da do banco é remontada. Vale entre
+# processos, pois a versão sempre vem do banco.
+_CARD_CACHE_MAX = 512
+_card_cache: OrderedDict[tuple[int, int], tuple[int, str]] = OrderedDict()
+_card_lock = threading.Lock()
+
+
+def _format_dt(value, fmt: str) -> str:
+    if not value:
+        return ""
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return value
+    return value.strftime(fmt)
+
+
+def _os_card_text(rdb, org_id: int, os_id: int) -> str | None:
+    """Texto da ficha da OS (None se não existir na empresa). rdb: sessão de leitura."""
+    key = (org_id, os_id)
+    version = get_work_order_version(rdb, org_id, os_id)
+    if version is None:
+        return None
+    with _card_lock:
+        hit = _card_cache.get(key)
+        if hit and hit[0] == version:
+            _card_cache.move_to_end(key)
+            return hit[1]
+
+    card = get_work_order_card(rdb, org_id, os_id)
+    if not card:
+        return None
+    wo, tecnicos, materiais = card
+    fechada = wo.status == STATUS_FECHADA
+    text = TXT.os_card(
+        wo.id, _STATUS_LABELS.get(wo.status, wo.status), wo.equipamento, wo.setor,
+        wo.maquina_parada, wo.descricao_do_problema,
+        _format_dt(wo.abertura_em, "%d/%m/%Y %H:%M"),
+        wo.status_observacao or "",
+        _format_dt(wo.fechamento_em, "%d/%m/%Y") if fechada else "",
+        wo.tempo_gasto_minutos,
+        ", ".join(tecnicos) if tecnicos else "SEM INFORMAÇÃO",
+        ", ".join(materiais) if materiais else "NENHUMA",
+        wo.custo_pecas,
+        wo.solucao_aplicada,
+        tipo="Preventiva" if wo.tipo_manutencao == "PREVENTIVA" else "",
+    )
+
+    with _card_lock:
+        _card_cache[key] = (wo.version, text)
+        _card_cache.move_to_end(key)
+        while len(_card_cache) > _CARD_CACHE_MAX:
+            _card_cache.popitem(last=False)
+    return text
+
+
+def _consult(db, org_id: int, chat_id: str, termo: str, reply_markup) -> None:
+    """Busca por número, status ou equipamento; um resultado vira ficha, vários viram lista."""
+    termo = termo.strip()
+    if termo.lstrip("#").isdigit():
+        os_id = int(termo.lstrip("#"))
+        with read_session(org_id) as rdb:
+            card = _os_card_text(rdb, org_id, os_id)
+        if card is None:
+            queue_message(db, chat_id, TXT.OS_NOT_FOUND, reply_markup=reply_markup)
+            return
+        queue_message(db, chat_id, card, reply_markup=os_card_inline_keyboard(os_id))
+        return
+
+    status = _STATUS_BY_TEXT.get(termo.upper(), "")
+    with read_session(org_id) as rdb:
+        found = search_work_orders(
+            rdb, org_id,
+            equipamento="" if status else termo,
+            status=status,
+            limit=CONSULT_MAX_RESULTS,
+        )
+        card = _os_card_text(rdb, org_id, found[0].id) if len(found) == 1 else None
+    if not found:
+        queue_message(db, chat_id, TXT.CONSULT_NOT_FOUND, reply_markup=reply_markup)
+        return
+    if len(found) == 1:
+        os_id = found[0].id
+        queue_message(db, chat_id, card, reply_markup=os_card_inline_keyboard(os_id))
+        return
+
+    items = [(wo.id, f"{wo.equipamento} - {_STATUS_LABELS.get(wo.status, wo.status)}") for wo in found]
+    queue_message(
+        db,
+        chat_id,
+        TXT.consult_results(termo, len(found), CONSULT_MAX_RESULTS),
+        reply_markup=view_os_inline_keyboard(items),
+    )
+
+
+def _equipment_history(db, org_id: int, chat_id: str, equipamento: str, reply_markup) -> None:
+    """Últimas OS do equipamento, com botão para a ficha de cada uma."""
+    with read_session(org_id) as rdb:
+        rows = list_equipment_history(rdb, org_id, equipamento, limit=HISTORY_MAX_RESULTS)
+    if not rows:
+        queue_message(db, chat_id, TXT.history_empty(equipamento), reply_markup=reply_markup)
+        return
+
+    lines = [
+        (
+            wo.id,
+            _format_dt(wo.abertura_em, "%d/%m/%Y"),
+            _STATUS_LABELS.get(wo.status, wo.status),
+            wo.descricao_do_problema[:60].strip(),
+        )
+        for wo in rows
+    ]
+    items = [(wo.id, f"{_format_dt(wo.abertura_em, '%d/%m/%Y')} - {wo.descricao_do_problema[:40].strip()}") for wo in rows]
+    queue_message(
+        db,
+        chat_id,
+        TXT.history(rows[0].equipamento, lines),
+        reply_markup=view_os_inline_keyboard(items),
+    )
+
+
+def _format_duration(seconds: float) -> str:
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return f"{minutes}min"
+    hours, minutes = divmod(minutes, 60)
+    if hours < 24:
+        return f"{hours}h{minutes:02d}"
+    days, hours = divmod(hours, 24)
+    return f"{days}d {hours}h"
+
+
+def _bottleneck_report(org_id: int, dias: int) -> str:
+    """Texto do /gargalos: um agregado (status x setor) resumido aqui por status e por espera."""
+    with read_session(org_id) as rdb:
+        rows = status_time_report(rdb, org_id, datetime.now(timezone.utc) - timedelta(days=dias))
+    if not rows:
+        return TXT.bottleneck_empty(dias)
+
+    by_status: dict[str, list[int]] = {}
+    for status, _setor, n, total, _max in rows:
+        acc = by_status.setdefault(status, [0, 0])
+        acc[0] += n
+        acc[1] += total
+    por_status = [
+        (_STATUS_LABELS.get(status, status), n, _format_duration(total / n), _format_duration(total))
+        for status, (n, total) in sorted(by_status.items(), key=lambda kv: kv[1][1], reverse=True)
+    ][:BOTTLENECK_MAX_LINES]
+
+    esperas = sorted(
+        (row for row in rows if row[0] in WAITING_STATUSES),
+        key=lambda row: row[3] / row[2],
+        reverse=True,
+    )[:BOTTLENECK_MAX_LINES]
+    esperas_fmt = [
+        (setor, _STATUS_LABELS.get(status, status), n, _format_duration(total / n))
+        for status, setor, n, total, _max in esperas
+    ]
+    return TXT.bottlenecks(dias, por_status, esperas_fmt)
+
+
+def _preventive_command(db, org_id: int, chat_id: str, telegram_user_id: str, arg: str, reply_markup) -> None:
+    """/preventiva lista os planos; add/del (só ADMIN) cadastram e removem."""
+    action, _, rest = arg.partition(" ")
+    action = action.lower()
+    if action in ("add", "del") and get_user_role_in_org(db, telegram_user_id, org_id) != "ORG_ADMIN":
+        queue_message(db, chat_id, TXT.PREVENTIVE_ONLY_ADMIN, reply_markup=reply_markup)
+        return
+
+    if action == "add":
+        # equipamento | setor | tarefa | regra [| item; item; ...]
+        fields = _split_inline_fields(rest)
+        if len(fields) not in (4, 5) or not all(fields[:4]):
+            queue_message(db, chat_id, TXT.PREVENTIVE_USAGE, reply_markup=reply_markup)
+            return
+        rule = parse_rule(fields[3])
+        if rule is None:
+            queue_message(db, chat_id, TXT.PREVENTIVE_RULE_INVALID, reply_markup=reply_markup)
+            return
+
+        checklist = fields[4].split(";") if len(fields) == 5 else []
+        proxima = first_due(*rule, datetime.now(timezone.utc))
+        plan = create_preventive_plan(
+            db, org_id, fields[0], fields[1], fields[2], checklist, *rule, proxima,
+            created_by_user_id=telegram_user_id,
+        )
+        queue_message(
+            db,
+            chat_id,
+            TXT.preventive_created(plan.id, plan.equipamento, plan.tarefa, TXT.preventive_rule(*rule), _format_dt(proxima, "%d/%m/%Y")),
+            reply_markup=reply_markup,
+        )
+        return
+
+    if action == "del":
+        plan_id = rest.strip().lstrip("#")
+        if not plan_id.isdigit():
+            queue_message(db, chat_id, TXT.PREVENTIVE_USAGE, reply_markup=reply_markup)
+        elif deactivate_preventive_plan(db, org_id, int(plan_id)):
+            queue_message(db, chat_id, TXT.preventive_removed(int(plan_id)), reply_markup=reply_markup)
+        else:
+            queue_message(db, chat_id, TXT.PREVENTIVE_NOT_FOUND, reply_markup=reply_markup)
+        return
+
+    if action:
+        queue_message(db, chat_id, TXT.PREVENTIVE_USAGE, reply_markup=reply_markup)
+        return
+
+    with read_session(org_id) as rdb:
+        plans = list_preventive_plans(rdb, org_id, limit=PREVENTIVE_LIST_MAX)
+        total = count_preventive_plans(rdb, org_id) if len(plans) >= PREVENTIVE_LIST_MAX else len(plans)
+    if not plans:
+        queue_message(db, chat_id, TXT.PREVENTIVE_EMPTY + "\n\n" + TXT.PREVENTIVE_USAGE, reply_markup=reply_markup)
+        return
+
+    rows = [
+        (p.id, p.equipamento, p.tarefa, TXT.preventive_rule(p.regra, p.regra_valor), _format_dt(p.proxima_em, "%d/%m/%Y"))
+        for p in plans
+    ]
+    queue_message(db, chat_id, TXT.preventive_list(rows, total), reply_markup=reply_markup)
+
+
 def _is_private_chat(message: dict) -> bool:
     chat = message.get("chat", {})
     return chat.get("type") == "private"
@@ -167,493 +827,931 @@ def _parse_command(text: str) -> tuple[str, str]:
     return (cmd, arg)
 
 
+# label "step" das métricas (instrumentation): só comandos e prefixos de callback
+# conhecidos; o resto vira "other" (texto livre criaria uma série por valor)
+_METRIC_COMMANDS = frozenset({
+    "/entrar", "/criar_empresa", "/invite_admin", "/invite_user", "/alertas",
+    CMD_OPEN, CMD_UPDATE, CMD_CLOSE, CMD_CLOSE_BATCH, CMD_CONSULT, CMD_HISTORY,
+    CMD_BOTTLENECKS, CMD_PREVENTIVE, CMD_MENU_1, CMD_MENU_2, CMD_MENU_3,
+})
+_METRIC_CALLBACKS = frozenset(
+    prefix.rstrip(":") for prefix in (
+        CB_CLOSE_PREFIX, CB_UPDATE_PREFIX, CB_STATUS_PREFIX, CB_VIEW_PREFIX, CB_HISTORY_PREFIX,
+        CB_DUP_PREFIX, CB_CLOSE_PAGE_PREFIX, CB_UPDATE_PAGE_PREFIX, CB_BATCH_PREFIX,
+    )
+)
+
+
+def _metric_step(value: str, known: frozenset[str]) -> str:
+    return value if value in known else "other"
+
+
 @app.post("/telegram/webhook")
 async def telegram_webhook(request: Request):
     update = await request.json()
-    db = SessionLocal()
+    # process_update bloqueia (SQLite, espera do lock de escrita): fora do event
+    # loop, que segue atendendo /health, /ready e os outros updates. O contexto
+    # vai junto para a thread (métricas do update em instrumentation)
+    body = await run_in_threadpool(process_update, update)
+    if "method" not in body:
+        outbox_worker.wake()
+    return body
+
 
+def process_update(update: dict) -> dict:
+    """
+    Processa um update numa sessão própria e devolve o corpo da resposta do
+    webhook (a chamada inline, se houver). Usado também pelo bench de replay.
+    """
+    db = SessionLocal()
     try:
-        # =====================================================
-        # DEDUP (ANTI-FLOOD) por update_id
-        # =====================================================
-        update_id = update.get("update_id")
-        dedup_key = f"upd:{update_id}" if update_id is not None else None
-
-        chat_id_for_event = ""
-        if "callback_query" in update:
-            cb0 = update["callback_query"]
-            chat_id_for_event = str(cb0["message"]["chat"]["id"])
-        else:
-            msg0 = update.get("message") or update.get("edited_message")
-            if msg0:
-                chat_id_for_event = str(msg0["chat"]["id"])
+        try:
+            result = _handle_update(db, update)
+        except (WorkOrderConflict, StaleDataError) as e:
+            # outra transação gravou a mesma OS / estado do chat no meio do caminho
+            db.rollback()
+            forget_rolled_back(db)
+            result = _reply_conflict(db, update, e)
+        inline = take_inline_reply(db)
+        # respostas que não vieram junto de uma mudança de estado
+        db.commit()
+    except Exception:
+        log_event(log, "update_failed", logging.ERROR, exc_info=True)
+        raise
+    finally:
+        db.close()
 
-        if dedup_key:
-            is_new = register_event_if_new(db, dedup_key, chat_id_for_event, update)
-            if not is_new:
-                return {"ok": True}
+    return inline or result
 
-        menu = main_menu_keyboard()
-
-        # =====================================================
-        # CALLBACKS (inline buttons)
-        # =====================================================
-        if "callback_query" in update:
-            cb = update["callback_query"]
-            message = cb.get("message", {})
-            chat_id = str(message.get("chat", {}).get("id", ""))
-            data = cb.get("data", "")
-
-            # callbacks devem funcionar só no privado
-            # (se quiser permitir grupo depois, a gente adapta)
-            st = get_or_create_chat_state(db, chat_id)
-
-            # Identidade do usuário
-            from_user = cb.get("from", {})
-            telegram_user_id = str(from_user.get("id", ""))
-            username = from_user.get("username", "") or ""
-            first_name = from_user.get("first_name", "") or ""
-            is_master = (telegram_user_id == str(MASTER_USER_ID))
-            upsert_user(db, telegram_user_id, username=username, first_name=first_name, is_master=is_master)
-
-            org_id = get_user_org_id(db, telegram_user_id)
-            if not org_id:
-                send_message(chat_id, "Você ainda não está em uma empresa. Use: /entrar SEU-CÓDIGO", reply_markup=menu)
-                return {"ok": True}
 
-            # Fechar OS: escolha da OS
-            if data.startswith(CB_CLOSE_PREFIX):
-                os_id = int(data.split(":", 1)[1])
-                # start a fresh close flow (wipe any leftover temp fields)
-                clear_state(db, st)
-                st.temp_fechamento_data = ""
-                db.commit()
+def _user_org_id(db, telegram_user_id: str, st) -> int | None:
+    """
+    Empresa do usuário; no modo por empresa já aponta a sessão para o banco
+    dela e, antes de qualquer fluxo, reaplica no estado do chat (st) o commit
+    anterior que só chegou ao banco da empresa (ver db.WriteSession).
+    """
+    org_id = get_user_org_id(db, telegram_user_id)
+    route_to_org(db, org_id)
+    if SHARD_BY_ORG and org_id and recover_org_commit(db, st):
+        log_event(log, "org_commit_recovered", logging.WARNING, org_id=org_id, chat_id=st.chat_id)
+    return org_id
 
-                set_state(db, st, mode="CLOSE_FLOW", step="ASK_DATE", os_id=os_id)
-                send_message(chat_id, TXT.close_intro(os_id), reply_markup=menu)
-                return {"ok": True}
 
-            # Atualizar OS: escolha da OS
-            if data.startswith(CB_UPDATE_PREFIX):
-                os_id = int(data.split(":", 1)[1])
-                set_state(db, st, mode="UPDATE_FLOW", step="ASK_STATUS", os_id=os_id)
-                send_message(chat_id, TXT.update_intro(os_id), reply_markup=status_inline_keyboard())
-                return {"ok": True}
+def _update_chat_id(update: dict) -> str:
+    if "callback_query" in update:
+        return str(update["callback_query"]["message"]["chat"]["id"])
+    msg = update.get("message") or update.get("edited_message")
+    return str(msg["chat"]["id"]) if msg else ""
 
-            # Atualizar OS: escolha do status
-            if data.startswith(CB_STATUS_PREFIX):
-                status_val = data.split(":", 1)[1]
-                if st.mode != "UPDATE_FLOW" or st.step != "ASK_STATUS" or not st.os_id:
-                    send_message(chat_id, TXT.UNKNOWN_ACTION, reply_markup=menu)
-                    return {"ok": True}
 
-                st.temp_status = status_val
-                db.commit()
-                set_state(db, st, mode="UPDATE_FLOW", step="ASK_OBS", os_id=st.os_id)
-                send_message(chat_id, TXT.UPDATE_ASK_OBS, reply_markup=menu)
-                return {"ok": True}
+def _reply_conflict(db, update: dict, error: Exception) -> dict:
+    """
+    Responde ao usuário que perdeu a corrida. Conflito na OS encerra o fluxo
+    (o que ele preenchia não vale mais); conflito só no estado do chat
+    (dois updates simultâneos) mantém o fluxo e pede para reenviar.
+    """
+    chat_id = _update_chat_id(update)
+    if isinstance(error, WorkOrderConflict):
+        text = TXT.os_conflict(error.os_id)
+        clear_state(db, get_or_create_chat_state(db, chat_id), commit=False)
+    else:
+        text = TXT.CHAT_CONFLICT
+    log_event(log, "update_conflict", logging.WARNING, error=str(error)[:200])
+
+    if "callback_query" in update:
+        queue_answer_callback(db, str(update["callback_query"].get("id", "")), text, show_alert=True)
+    elif chat_id:
+        queue_message(db, chat_id, text, reply_markup=main_menu_keyboard())
+    return {"ok": True}
 
-            send_message(chat_id, TXT.UNKNOWN_ACTION, reply_markup=menu)
-            return {"ok": True}
 
-        # =====================================================
-        # MESSAGES
-        # =====================================================
-        message = update.get("message") or update.get("edited_message")
-        if not message:
+def _handle_update(db, update: dict) -> dict:
+    """
+    Processa um update. As respostas vão para o outbox (queue_message) e são
+    gravadas no mesmo commit da mudança de estado correspondente.
+    """
+    # =====================================================
+    # DEDUP (ANTI-FLOOD) por update_id
+    # =====================================================
+    update_id = update.get("update_id")
+    dedup_key = f"upd:{update_id}" if update_id is not None else None
+    tag(update_id=update_id)
+
+    chat_id_for_event = _update_chat_id(update)
+    tag(chat_id=chat_id_for_event)
+
+    if dedup_key:
+        is_new = register_event_if_new(db, dedup_key, chat_id_for_event, update)
+        if not is_new:
+            tag(flow="DUPLICATE")
             return {"ok": True}
 
-        chat_id = str(message["chat"]["id"])
-        chat_type = message.get("chat", {}).get("type", "")
-        text = _normalize_text(message.get("text", ""))
+    menu = main_menu_keyboard()
+
+    # =====================================================
+    # CALLBACKS (inline buttons)
+    # =====================================================
+    if "callback_query" in update:
+        cb = update["callback_query"]
+        cb_id = str(cb.get("id", ""))
+        message = cb.get("message", {})
+        chat_id = str(message.get("chat", {}).get("id", ""))
+        message_id = message.get("message_id")
+        data = cb.get("data", "")
+        tag(flow="CALLBACK", step=_metric_step(data.split(":", 1)[0], _METRIC_CALLBACKS))
+
+        # callbacks devem funcionar só no privado
+        # (se quiser permitir grupo depois, a gente adapta)
+        st = get_or_create_chat_state(db, chat_id)
 
         # Identidade do usuário
-        from_user = message.get("from", {})
+        from_user = cb.get("from", {})
         telegram_user_id = str(from_user.get("id", ""))
         username = from_user.get("username", "") or ""
         first_name = from_user.get("first_name", "") or ""
         is_master = (telegram_user_id == str(MASTER_USER_ID))
         upsert_user(db, telegram_user_id, username=username, first_name=first_name, is_master=is_master)
 
-        # A partir de agora, a UX alvo é PRIVADO
-        if chat_type != "private":
-            send_message(
-                chat_id,
-                "Para manter privacidade e organização, use o bot no PRIVADO.\n"
-                "Abra uma conversa comigo e use /menu.\n\n"
-                "Se precisar entrar em uma empresa: /entrar SEU-CÓDIGO",
-                reply_markup=menu,
-            )
+        # toda resposta de callback responde o answerCallbackQuery (tira o "carregando")
+        # e edita a própria mensagem do seletor em vez de mandar uma nova
+        org_id = _user_org_id(db, telegram_user_id, st)
+        tag(org_id=org_id)
+        if not org_id:
+            queue_answer_callback(db, cb_id, TXT.NOT_IN_ORG, show_alert=True)
             return {"ok": True}
 
-        st = get_or_create_chat_state(db, chat_id)
+        # Fechar OS: escolha da OS
+        if data.startswith(CB_CLOSE_PREFIX):
+            os_id = int(data.split(":", 1)[1])
+            wo = get_work_order(db, org_id, os_id)
+            if not wo or wo.status in ARCHIVED_STATUSES:
+                queue_answer_callback(db, cb_id, TXT.OS_ALREADY_CLOSED if wo else TXT.OS_NOT_FOUND, show_alert=True)
+                return {"ok": True}
 
-        # =====================================================
-        # COMANDOS DE ORG/INVITE
-        # =====================================================
-        cmd, arg = _parse_command(text)
+            # start a fresh close flow (wipe any leftover temp fields)
+            clear_state(db, st)
+            st.temp_fechamento_data = ""
+            st.temp_os_version = wo.version
+            db.commit()
+
+            queue_answer_callback(db, cb_id)
+            queue_edit_text(db, chat_id, message_id, TXT.close_intro(os_id))
+            set_state(db, st, mode="CLOSE_FLOW", step="ASK_DATE", os_id=os_id)
+            return {"ok": True}
 
-        if cmd == "/entrar":
-            token = (arg or "").strip()
-            if not token:
-                send_message(chat_id, "Uso: /entrar INV-XXXXXX", reply_markup=menu)
+        # Atualizar OS: escolha da OS
+        if data.startswith(CB_UPDATE_PREFIX):
+            os_id = int(data.split(":", 1)[1])
+            wo = get_work_order(db, org_id, os_id)
+            if not wo or wo.status in ARCHIVED_STATUSES:
+                queue_answer_callback(db, cb_id, TXT.OS_ALREADY_CLOSED if wo else TXT.OS_NOT_FOUND, show_alert=True)
                 return {"ok": True}
 
-            ok, msg, org_id, role = consume_invite(db, token, telegram_user_id)
-            if not ok:
-                send_message(chat_id, msg, reply_markup=menu)
+            st.temp_os_version = wo.version
+            queue_answer_callback(db, cb_id)
+            queue_edit_text(db, chat_id, message_id, TXT.update_intro(os_id), reply_markup=status_inline_keyboard())
+            set_state(db, st, mode="UPDATE_FLOW", step="ASK_STATUS", os_id=os_id)
+            return {"ok": True}
+
+        # Atualizar OS: escolha do status
+        if data.startswith(CB_STATUS_PREFIX):
+            status_val = data.split(":", 1)[1]
+            if st.mode != "UPDATE_FLOW" or st.step != "ASK_STATUS" or not st.os_id:
+                queue_answer_callback(db, cb_id, TXT.UNKNOWN_ACTION)
                 return {"ok": True}
 
-            org = get_org_by_id(db, org_id) if org_id else None
-            org_name = org.name if org else "Empresa"
-            send_message(chat_id, f"{msg}\n\nEmpresa: {org_name}\nPerfil: {role}", reply_markup=menu)
+            status_label = dict((v, k) for k, v in STATUS_OPTIONS).get(status_val, status_val)
+            st.temp_status = status_val
+            db.commit()
+            queue_answer_callback(db, cb_id)
+            queue_edit_text(db, chat_id, message_id, TXT.update_ask_obs(status_label))
+            set_state(db, st, mode="UPDATE_FLOW", step="ASK_OBS", os_id=st.os_id)
             return {"ok": True}
 
-        if cmd == "/criar_empresa":
-            if not is_master:
-                send_message(chat_id, "Sem permissão. Apenas o MASTER pode criar empresas.", reply_markup=menu)
+        # Consultar OS: ficha da OS escolhida na lista (mensagem nova, a lista fica)
+        if data.startswith(CB_VIEW_PREFIX):
+            os_id = int(data.split(":", 1)[1])
+            with read_session(org_id) as rdb:
+                card = _os_card_text(rdb, org_id, os_id)
+            if card is None:
+                queue_answer_callback(db, cb_id, TXT.OS_NOT_FOUND, show_alert=True)
                 return {"ok": True}
 
-            name = (arg or "").strip().strip('"')
-            if not name:
-                send_message(chat_id, 'Uso: /criar_empresa "Nome da Empresa"', reply_markup=menu)
+            queue_answer_callback(db, cb_id)
+            queue_message(db, chat_id, card, reply_markup=os_card_inline_keyboard(os_id))
+            return {"ok": True}
+
+        # Histórico do equipamento da OS (botão da ficha)
+        if data.startswith(CB_HISTORY_PREFIX):
+            os_id = int(data.split(":", 1)[1])
+            wo = get_work_order(db, org_id, os_id) or get_archived_work_order(db, org_id, os_id)
+            if not wo:
+                queue_answer_callback(db, cb_id, TXT.OS_NOT_FOUND, show_alert=True)
                 return {"ok": True}
 
-            org = create_organization(db, name)
-            send_message(chat_id, f"Empresa criada!\nID: {org.id}\nNome: {org.name}", reply_markup=menu)
-            send_message(chat_id, f"Agora gere o convite do admin:\n/invite_admin {org.id}", reply_markup=menu)
+            queue_answer_callback(db, cb_id)
+            _equipment_history(db, org_id, chat_id, wo.equipamento, reply_markup=menu)
             return {"ok": True}
 
-        if cmd == "/invite_admin":
-            if not is_master:
-                send_message(chat_id, "Sem permissão. Apenas o MASTER pode criar convite de admin.", reply_markup=menu)
+        # Abertura com OS parecida aberta: anexar a ela ou abrir nova
+        if data.startswith(CB_DUP_PREFIX):
+            parts = data.split(":")
+            if st.mode != "OPEN_FLOW" or st.step != "CONFIRM_DUP" or not st.os_id:
+                queue_answer_callback(db, cb_id, TXT.UNKNOWN_ACTION)
                 return {"ok": True}
 
-            if not arg or not arg.strip().isdigit():
-                send_message(chat_id, "Uso: /invite_admin <ORG_ID>", reply_markup=menu)
+            if parts[1] == "attach" and len(parts) == 3 and parts[2] == str(st.os_id):
+                wo, became_down = attach_report_to_work_order(
+                    db, org_id, st.os_id, st.temp_problema, st.temp_maquina_parada,
+                    commit=False, expected_version=st.temp_os_version,
+                )
+                if became_down:
+                    notify_machine_down(db, wo, exclude_user_id=telegram_user_id)
+                queue_answer_callback(db, cb_id)
+                queue_edit_text(
+                    db, chat_id, message_id,
+                    TXT.attach_done(wo.id, wo.equipamento, wo.setor, wo.maquina_parada, wo.descricao_do_problema),
+                )
+                clear_state(db, st)
                 return {"ok": True}
 
-            org_id = int(arg.strip())
-            org = get_org_by_id(db, org_id)
-            if not org or not org.active:
-                send_message(chat_id, "Empresa não encontrada.", reply_markup=menu)
+            if parts[1] == "new":
+                queue_answer_callback(db, cb_id)
+                _open_os(
+                    db, st, org_id, chat_id, telegram_user_id,
+                    st.temp_equipamento, st.temp_setor, st.temp_problema, st.temp_maquina_parada,
+                    reply_markup=menu, check_duplicate=False,
+                )
                 return {"ok": True}
 
-            inv = create_invite(
-                db,
-                org_id=org_id,
-                created_by_user_id=telegram_user_id,
-                role_to_grant="ORG_ADMIN",
-                expires_days=INVITE_EXPIRES_DAYS,
-            )
-            send_message(
-                chat_id,
-                f"Convite de ADMIN criado (expira em {INVITE_EXPIRES_DAYS} dias):\n\n{inv.token}\n\n"
-                f"Envie este código para o admin da empresa.",
-                reply_markup=menu,
-            )
+            queue_answer_callback(db, cb_id, TXT.UNKNOWN_ACTION)
             return {"ok": True}
 
-        if cmd == "/invite_user":
-            # precisa ser admin da org
-            org_id = get_user_org_id(db, telegram_user_id)
-            if not org_id:
-                send_message(chat_id, "Você ainda não está em uma empresa. Use: /entrar SEU-CÓDIGO", reply_markup=menu)
+        # Fechar OS em lote: várias OS marcadas no seletor (a seleção fica no
+        # estado do chat) e um fluxo de fechamento só para todas elas
+        if data.startswith(CB_BATCH_PREFIX):
+            parts = data.split(":")
+            action = parts[1] if len(parts) > 1 else ""
+            picking = st.mode == "CLOSE_FLOW" and st.step == "PICK_BATCH"
+
+            if action == "pg" and len(parts) == 3:
+                page = max(0, int(parts[2]))
+                items, has_more = _open_os_picker_items(db, org_id, page)
+                queue_answer_callback(db, cb_id)
+                if picking:
+                    markup = batch_close_inline_keyboard(items, _batch_selection(st), page=page, has_more=has_more)
+                    queue_edit_markup(db, chat_id, message_id, markup)
+                    return {"ok": True}
+
+                # veio do seletor de fechar: começa um lote novo
+                markup = batch_close_inline_keyboard(items, {}, page=page, has_more=has_more)
+                queue_edit_text(db, chat_id, message_id, TXT.BATCH_PICK, reply_markup=markup)
+                clear_state(db, st, commit=False)
+                set_state(db, st, mode="CLOSE_FLOW", step="PICK_BATCH", os_id=None)
                 return {"ok": True}
 
-            role = get_user_role_in_org(db, telegram_user_id, org_id)
-            if role != "ORG_ADMIN":
-                send_message(chat_id, "Sem permissão. Apenas ADMIN da empresa pode convidar usuários.", reply_markup=menu)
+            if not picking:
+                queue_answer_callback(db, cb_id, TXT.UNKNOWN_ACTION)
                 return {"ok": True}
 
-            inv = create_invite(
-                db,
-                org_id=org_id,
-                created_by_user_id=telegram_user_id,
-                role_to_grant="ORG_USER",
-                expires_days=INVITE_EXPIRES_DAYS,
-            )
-            send_message(
-                chat_id,
-                f"Convite de USUÁRIO criado (expira em {INVITE_EXPIRES_DAYS} dias):\n\n{inv.token}\n\n"
-                f"Envie este código para a pessoa entrar com /entrar {inv.token}",
-                reply_markup=menu,
+            selected = _batch_selection(st)
+
+            if action == "cancel":
+                queue_answer_callback(db, cb_id)
+                queue_edit_text(db, chat_id, message_id, TXT.BATCH_CANCELLED)
+                clear_state(db, st)
+                return {"ok": True}
+
+            if action == "ok":
+                if not selected:
+                    queue_answer_callback(db, cb_id, TXT.BATCH_EMPTY, show_alert=True)
+                    return {"ok": True}
+                queue_answer_callback(db, cb_id)
+                queue_edit_text(db, chat_id, message_id, TXT.batch_intro(sorted(selected)))
+                set_state(db, st, mode="CLOSE_FLOW", step="ASK_DATE", os_id=None)
+                return {"ok": True}
+
+            if action == "tog" and len(parts) == 4:
+                os_id, page = int(parts[2]), max(0, int(parts[3]))
+                if os_id in selected:
+                    del selected[os_id]
+                else:
+                    wo = get_work_order(db, org_id, os_id)
+                    if not wo or wo.status in ARCHIVED_STATUSES:
+                        queue_answer_callback(db, cb_id, TXT.OS_ALREADY_CLOSED if wo else TXT.OS_NOT_FOUND, show_alert=True)
+                        return {"ok": True}
+                    selected[os_id] = wo.version
+            elif action == "all" and len(parts) == 3:
+                page = max(0, int(parts[2]))
+                abertas = list_open_work_orders(db, org_id, limit=PICKER_PAGE_SIZE, offset=page * PICKER_PAGE_SIZE)
+                for wo in abertas:
+                    selected.setdefault(wo.id, wo.version)
+            else:
+                queue_answer_callback(db, cb_id, TXT.UNKNOWN_ACTION)
+                return {"ok": True}
+
+            if len(selected) > BATCH_CLOSE_MAX:
+                queue_answer_callback(db, cb_id, TXT.batch_limit(BATCH_CLOSE_MAX), show_alert=True)
+                return {"ok": True}
+
+            _set_batch_selection(st, selected)
+            db.commit()
+            items, has_more = _open_os_picker_items(db, org_id, page)
+            queue_answer_callback(db, cb_id)
+            queue_edit_markup(
+                db, chat_id, message_id,
+                batch_close_inline_keyboard(items, selected, page=page, has_more=has_more),
             )
             return {"ok": True}
 
-        # =====================================================
-        # BLOQUEIO: precisa estar em uma empresa para usar /menu e fluxos
-        # =====================================================
-        org_id = get_user_org_id(db, telegram_user_id)
+        # Paginação dos seletores: troca só o teclado da mesma mensagem
+        if data.startswith(CB_CLOSE_PAGE_PREFIX) or data.startswith(CB_UPDATE_PAGE_PREFIX):
+            page = max(0, int(data.split(":", 1)[1]))
+            items, has_more = _open_os_picker_items(db, org_id, page)
+            if data.startswith(CB_CLOSE_PAGE_PREFIX):
+                markup = close_os_inline_keyboard(items, page=page, has_more=has_more)
+            else:
+                markup = update_os_inline_keyboard(items, page=page, has_more=has_more)
+            queue_answer_callback(db, cb_id)
+            queue_edit_markup(db, chat_id, message_id, markup)
+            return {"ok": True}
+
+        queue_answer_callback(db, cb_id, TXT.UNKNOWN_ACTION)
+        return {"ok": True}
+
+    # =====================================================
+    # MESSAGES
+    # =====================================================
+    message = update.get("message") or update.get("edited_message")
+    if not message:
+        return {"ok": True}
+
+    chat_id = str(message["chat"]["id"])
+    chat_type = message.get("chat", {}).get("type", "")
+    text = _normalize_text(message.get("text", ""))
+
+    # Identidade do usuário
+    from_user = message.get("from", {})
+    telegram_user_id = str(from_user.get("id", ""))
+    username = from_user.get("username", "") or ""
+    first_name = from_user.get("first_name", "") or ""
+    is_master = (telegram_user_id == str(MASTER_USER_ID))
+    upsert_user(db, telegram_user_id, username=username, first_name=first_name, is_master=is_master)
+
+    # A partir de agora, a UX alvo é PRIVADO
+    if chat_type != "private":
+        queue_message(
+            db,
+            chat_id,
+            "Para manter privacidade e organização, use o bot no PRIVADO.\n"
+            "Abra uma conversa comigo e use /menu.\n\n"
+            "Se precisar entrar em uma empresa: /entrar SEU-CÓDIGO",
+            reply_markup=menu,
+        )
+        return {"ok": True}
+
+    st = get_or_create_chat_state(db, chat_id)
+
+    # =====================================================
+    # COMANDOS DE ORG/INVITE
+    # =====================================================
+    cmd, arg = _parse_command(text)
+    tag(flow=st.mode, step=st.step or (_metric_step(cmd, _METRIC_COMMANDS) if cmd else "-"))
+
+    if cmd == "/entrar":
+        token = (arg or "").strip()
+        if not token:
+            queue_message(db, chat_id, "Uso: /entrar INV-XXXXXX", reply_markup=menu)
+            return {"ok": True}
+
+        ok, msg, org_id, role = consume_invite(db, token, telegram_user_id)
+        if not ok:
+            queue_message(db, chat_id, msg, reply_markup=menu)
+            return {"ok": True}
+
+        org = get_org_by_id(db, org_id) if org_id else None
+        org_name = org.name if org else "Empresa"
+        queue_message(db, chat_id, f"{msg}\n\nEmpresa: {org_name}\nPerfil: {role}", reply_markup=menu)
+        return {"ok": True}
+
+    if cmd == "/criar_empresa":
+        if not is_master:
+            queue_message(db, chat_id, "Sem permissão. Apenas o MASTER pode criar empresas.", reply_markup=menu)
+            return {"ok": True}
+
+        name = (arg or "").strip().strip('"')
+        if not name:
+            queue_message(db, chat_id, 'Uso: /criar_empresa "Nome da Empresa"', reply_markup=menu)
+            return {"ok": True}
+
+        org = create_organization(db, name)
+        queue_message(db, chat_id, f"Empresa criada!\nID: {org.id}\nNome: {org.name}", reply_markup=menu)
+        queue_message(db, chat_id, f"Agora gere o convite do admin:\n/invite_admin {org.id}", reply_markup=menu)
+        return {"ok": True}
+
+    if cmd == "/invite_admin":
+        if not is_master:
+            queue_message(db, chat_id, "Sem permissão. Apenas o MASTER pode criar convite de admin.", reply_markup=menu)
+            return {"ok": True}
+
+        if not arg or not arg.strip().isdigit():
+            queue_message(db, chat_id, "Uso: /invite_admin <ORG_ID>", reply_markup=menu)
+            return {"ok": True}
+
+        org_id = int(arg.strip())
+        org = get_org_by_id(db, org_id)
+        if not org or not org.active:
+            queue_message(db, chat_id, "Empresa não encontrada.", reply_markup=menu)
+            return {"ok": True}
+
+        inv = create_invite(
+            db,
+            org_id=org_id,
+            created_by_user_id=telegram_user_id,
+            role_to_grant="ORG_ADMIN",
+            expires_days=INVITE_EXPIRES_DAYS,
+        )
+        queue_message(
+            db,
+            chat_id,
+            f"Convite de ADMIN criado (expira em {INVITE_EXPIRES_DAYS} dias):\n\n{inv.token}\n\n"
+            f"Envie este código para o admin da empresa.",
+            reply_markup=menu,
+        )
+        return {"ok": True}
+
+    if cmd == "/invite_user":
+        # precisa ser admin da org
+        org_id = _user_org_id(db, telegram_user_id, st)
         if not org_id:
-            send_message(
-                chat_id,
-                "Você ainda não está em uma empresa.\n\n"
-                "Use: /entrar INV-XXXXXX\n\n"
-                "Se você é o MASTER, crie uma empresa com:\n/criar_empresa \"Nome\"",
-                reply_markup=menu,
-            )
+            queue_message(db, chat_id, "Você ainda não está em uma empresa. Use: /entrar SEU-CÓDIGO", reply_markup=menu)
+            return {"ok": True}
+
+        role = get_user_role_in_org(db, telegram_user_id, org_id)
+        if role != "ORG_ADMIN":
+            queue_message(db, chat_id, "Sem permissão. Apenas ADMIN da empresa pode convidar usuários.", reply_markup=menu)
             return {"ok": True}
 
-        # =====================================================
-        # MENU / COMANDOS EXISTENTES
-        # =====================================================
-        if text in (CMD_MENU_1, CMD_MENU_2, CMD_MENU_3, BTN_CONSULT):
-            send_message(chat_id, TXT.MENU_TITLE, reply_markup=menu)
+        inv = create_invite(
+            db,
+            org_id=org_id,
+            created_by_user_id=telegram_user_id,
+            role_to_grant="ORG_USER",
+            expires_days=INVITE_EXPIRES_DAYS,
+        )
+        queue_message(
+            db,
+            chat_id,
+            f"Convite de USUÁRIO criado (expira em {INVITE_EXPIRES_DAYS} dias):\n\n{inv.token}\n\n"
+            f"Envie este código para a pessoa entrar com /entrar {inv.token}",
+            reply_markup=menu,
+        )
+        return {"ok": True}
+
+    if cmd == "/alertas":
+        org_id = _user_org_id(db, telegram_user_id, st)
+        if not org_id:
+            queue_message(db, chat_id, TXT.NOT_IN_ORG, reply_markup=menu)
             return {"ok": True}
 
-        if text in (CMD_OPEN, BTN_OPEN):
-            set_state(db, st, mode="OPEN_FLOW", step="ASK_EQUIP", os_id=None)
-            send_message(chat_id, TXT.OPEN_START, reply_markup=menu)
+        if get_user_role_in_org(db, telegram_user_id, org_id) != "ORG_ADMIN":
+            queue_message(db, chat_id, TXT.ALERTS_ONLY_ADMIN, reply_markup=menu)
             return {"ok": True}
 
-        if text in (CMD_CLOSE, BTN_CLOSE):
-            abertas = list_open_work_orders(db, org_id, limit=10)
-            if not abertas:
-                send_message(chat_id, TXT.NO_OPEN_OS_TO_CLOSE, reply_markup=menu)
+        event = EVENT_MACHINE_DOWN
+        head, _, rest = arg.partition(" ")
+        if head.upper() == EVENT_PREVENTIVE:
+            # /alertas preventiva [add|del ...]: aviso das OS geradas pelos planos
+            event, arg = EVENT_PREVENTIVE, rest.strip()
+
+        parts = arg.split(None, 2)
+        action = parts[0].lower() if parts else ""
+
+        if action == "add" and len(parts) >= 2 and parts[1].upper() in ROLE_ALIASES:
+            setor = parts[2] if len(parts) > 2 else ""
+            add_notification_subscription(db, org_id, event, ROLE_ALIASES[parts[1].upper()], setor)
+        elif action == "del" and len(parts) == 2 and parts[1].lstrip("#").isdigit():
+            if not remove_notification_subscription(db, org_id, int(parts[1].lstrip("#"))):
+                queue_message(db, chat_id, "Regra não encontrada.", reply_markup=menu)
                 return {"ok": True}
+        elif action:
+            queue_message(db, chat_id, TXT.ALERTS_USAGE, reply_markup=menu)
+            return {"ok": True}
+
+        subs = list_notification_subscriptions(db, org_id, event)
+        preventive = event == EVENT_PREVENTIVE
+        if not subs:
+            default = TXT.ALERTS_DEFAULT_PREVENTIVE if preventive else TXT.ALERTS_DEFAULT
+            queue_message(db, chat_id, default + "\n\n" + TXT.ALERTS_USAGE, reply_markup=menu)
+            return {"ok": True}
 
-            items = []
-            for wo in abertas:
-                resumo = f"{wo.equipamento} - {wo.descricao_do_problema[:40].strip()}"
-                items.append((wo.id, resumo))
+        rules = [(sub.id, sub.role, sub.setor) for sub in subs]
+        if preventive:
+            queue_message(db, chat_id, TXT.alerts_list(rules, evento="preventivas"), reply_markup=menu)
+        else:
+            queue_message(db, chat_id, TXT.alerts_list(rules), reply_markup=menu)
+        return {"ok": True}
+
+    # =====================================================
+    # BLOQUEIO: precisa estar em uma empresa para usar /menu e fluxos
+    # =====================================================
+    org_id = _user_org_id(db, telegram_user_id, st)
+    tag(org_id=org_id)
+    if not org_id:
+        queue_message(
+            db,
+            chat_id,
+            "Você ainda não está em uma empresa.\n\n"
+            "Use: /entrar INV-XXXXXX\n\n"
+            "Se você é o MASTER, crie uma empresa com:\n/criar_empresa \"Nome\"",
+            reply_markup=menu,
+        )
+        return {"ok": True}
 
-            send_message(chat_id, "Selecione a OS para fechar:", reply_markup=close_os_inline_keyboard(items))
+    # =====================================================
+    # COMANDOS EM UMA LINHA (/abrir ... | ... e /fechar N ... | ...)
+    # =====================================================
+    if cmd == CMD_OPEN and arg:
+        fields = _split_inline_fields(arg)
+        if len(fields) != 4 or not fields[0] or not fields[1]:
+            queue_message(db, chat_id, TXT.OPEN_INLINE_USAGE, reply_markup=menu)
             return {"ok": True}
 
-        if text in (CMD_UPDATE, BTN_UPDATE):
-            abertas = list_open_work_orders(db, org_id, limit=10)
-            if not abertas:
-                send_message(chat_id, TXT.NO_OPEN_OS_TO_UPDATE, reply_markup=menu)
-                return {"ok": True}
+        parada = _parse_parada(fields[3])
+        if parada is None:
+            queue_message(db, chat_id, TXT.PARADA_INVALID + "\n\n" + TXT.OPEN_INLINE_USAGE, reply_markup=menu)
+            return {"ok": True}
 
-            items = []
-            for wo in abertas:
-                resumo = f"{wo.equipamento} - {wo.descricao_do_problema[:40].strip()}"
-                items.append((wo.id, resumo))
+        _open_os(
+            db, st, org_id, chat_id, telegram_user_id,
+            fields[0], fields[1], fields[2], parada,
+            reply_markup=menu,
+        )
+        return {"ok": True}
 
-            send_message(chat_id, TXT.UPDATE_PICK_OS, reply_markup=update_os_inline_keyboard(items))
+    if cmd == CMD_CLOSE and arg:
+        # "<os> <data> | solução | tempo | técnicos [| peças [| custo]]"
+        fields = _split_inline_fields(arg)
+        head = fields[0].split()
+        if len(fields) < 4 or len(fields) > 6 or len(head) != 2 or not head[0].lstrip("#").isdigit():
+            queue_message(db, chat_id, TXT.CLOSE_INLINE_USAGE, reply_markup=menu)
             return {"ok": True}
 
-        # =====================================================
-        # OPEN_FLOW
-        # =====================================================
-        if st.mode == "OPEN_FLOW":
-            if st.step == "ASK_EQUIP":
-                st.temp_equipamento = text
-                db.commit()
-                set_state(db, st, mode="OPEN_FLOW", step="ASK_SETOR")
-                send_message(chat_id, TXT.ASK_SETOR, reply_markup=menu)
-                return {"ok": True}
+        os_id = int(head[0].lstrip("#"))
+        fech_dt = _parse_date(head[1])
+        if fech_dt is None:
+            queue_message(db, chat_id, TXT.CLOSE_DATE_INVALID, reply_markup=menu)
+            return {"ok": True}
 
-            if st.step == "ASK_SETOR":
-                if not text:
-                    send_message(chat_id, TXT.SETOR_REQUIRED, reply_markup=menu)
-                    return {"ok": True}
+        tempo_min = _parse_time_span(fields[2])
+        if tempo_min is None:
+            queue_message(db, chat_id, TXT.CLOSE_INICIO_INVALID + "\n\n" + TXT.CLOSE_INLINE_USAGE, reply_markup=menu)
+            return {"ok": True}
 
-                st.temp_setor = text
-                db.commit()
-                set_state(db, st, mode="OPEN_FLOW", step="ASK_PROBLEMA")
-                send_message(chat_id, TXT.ASK_PROBLEMA, reply_markup=menu)
-                return {"ok": True}
+        wo = get_work_order(db, org_id, os_id)
+        if not wo:
+            queue_message(db, chat_id, TXT.OS_NOT_FOUND, reply_markup=menu)
+            return {"ok": True}
+        if wo.status in ARCHIVED_STATUSES:
+            queue_message(db, chat_id, TXT.OS_ALREADY_CLOSED, reply_markup=menu)
+            return {"ok": True}
 
-            if st.step == "ASK_PROBLEMA":
-                st.temp_problema = text
-                db.commit()
-                set_state(db, st, mode="OPEN_FLOW", step="ASK_PARADA")
-                send_message(chat_id, TXT.ASK_PARADA, reply_markup=menu)
-                return {"ok": True}
+        _close_os(
+            db, st, org_id, os_id, chat_id,
+            fech_dt=fech_dt,
+            solucao=fields[1],
+            tempo_min=tempo_min,
+            tecnicos=_parse_technicians_list(fields[3]),
+            materiais=_parse_materials_list(fields[4] if len(fields) > 4 else ""),
+            custo_pecas=_safe_float_string(fields[5] if len(fields) > 5 else "0"),
+            reply_markup=menu,
+            expected_version=wo.version,
+        )
+        return {"ok": True}
 
-            if st.step == "ASK_PARADA":
-                val = text.upper()
-                if val not in ("SIM", "NAO", "NÃO"):
-                    send_message(chat_id, TXT.PARADA_INVALID, reply_markup=menu)
-                    return {"ok": True}
-                if val == "NÃO":
-                    val = "NÃO"
+    if cmd == CMD_CLOSE_BATCH and not arg:
+        items, has_more = _open_os_picker_items(db, org_id, page=0)
+        if not items:
+            queue_message(db, chat_id, TXT.NO_OPEN_OS_TO_CLOSE, reply_markup=menu)
+            return {"ok": True}
 
-                st.temp_maquina_parada = val
-                db.commit()
+        queue_message(db, chat_id, TXT.BATCH_PICK, reply_markup=batch_close_inline_keyboard(items, {}, has_more=has_more))
+        clear_state(db, st, commit=False)
+        set_state(db, st, mode="CLOSE_FLOW", step="PICK_BATCH", os_id=None)
+        return {"ok": True}
 
-                wo = create_open_work_order(
-                    db,
-                    org_id=org_id,
-                    chat_id=chat_id,
-                    equipamento=st.temp_equipamento,
-                    setor=st.temp_setor,
-                    problema=st.temp_problema,
-                    maquina_parada=st.temp_maquina_parada,
-                )
+    if cmd == CMD_CLOSE_BATCH:
+        # "<os,os,...> <data> | solução | tempo | técnicos [| peças [| custo]]"
+        fields = _split_inline_fields(arg)
+        head = fields[0].split()
+        ids_txt = " ".join(head[:-1]).replace(",", " ").split()
+        if len(fields) < 4 or len(fields) > 6 or not ids_txt or not all(i.lstrip("#").isdigit() for i in ids_txt):
+            queue_message(db, chat_id, TXT.CLOSE_BATCH_INLINE_USAGE, reply_markup=menu)
+            return {"ok": True}
 
-                clear_state(db, st)
-                send_message(
-                    chat_id,
-                    TXT.open_done(wo.id, wo.equipamento, wo.setor, wo.maquina_parada, wo.descricao_do_problema),
-                    reply_markup=menu,
-                )
-                return {"ok": True}
+        os_ids = list(dict.fromkeys(int(i.lstrip("#")) for i in ids_txt))
+        if len(os_ids) > BATCH_CLOSE_MAX:
+            queue_message(db, chat_id, TXT.batch_limit(BATCH_CLOSE_MAX), reply_markup=menu)
+            return {"ok": True}
 
-        # =====================================================
-        # UPDATE_FLOW
-        # =====================================================
-        if st.mode == "UPDATE_FLOW":
-            if st.step == "ASK_OBS":
-                obs = "" if text.upper() == "PULAR" else text
-                wo = update_work_order_status(db, org_id, st.os_id, st.temp_status, obs)
-                clear_state(db, st)
-                send_message(chat_id, TXT.update_done(wo.id, wo.status, wo.status_observacao), reply_markup=menu)
+        fech_dt = _parse_date(head[-1])
+        if fech_dt is None:
+            queue_message(db, chat_id, TXT.CLOSE_DATE_INVALID, reply_markup=menu)
+            return {"ok": True}
+
+        tempo_min = _parse_time_span(fields[2])
+        if tempo_min is None:
+            queue_message(db, chat_id, TXT.CLOSE_INICIO_INVALID + "\n\n" + TXT.CLOSE_BATCH_INLINE_USAGE, reply_markup=menu)
+            return {"ok": True}
+
+        wos = {wo.id: wo for wo in get_work_orders(db, org_id, os_ids)}
+        for os_id in os_ids:
+            wo = wos.get(os_id)
+            if not wo or wo.status in ARCHIVED_STATUSES:
+                queue_message(db, chat_id, f"#{os_id}: " + (TXT.OS_ALREADY_CLOSED if wo else TXT.OS_NOT_FOUND), reply_markup=menu)
                 return {"ok": True}
 
-        # =====================================================
-        # CLOSE_FLOW
-        # =====================================================
-        if st.mode == "CLOSE_FLOW":
-            os_id = st.os_id
+        _close_os_batch(
+            db, st, org_id, {os_id: wos[os_id].version for os_id in os_ids}, chat_id,
+            fech_dt=fech_dt,
+            solucao=fields[1],
+            tempo_min=tempo_min,
+            tecnicos=_parse_technicians_list(fields[3]),
+            materiais=_parse_materials_list(fields[4] if len(fields) > 4 else ""),
+            custo_pecas=_safe_float_string(fields[5] if len(fields) > 5 else "0"),
+            reply_markup=menu,
+        )
+        return {"ok": True}
 
-            if st.step == "ASK_DATE":
-                dt = _parse_date(text)
-                if dt is None:
-                    send_message(chat_id, TXT.CLOSE_DATE_INVALID, reply_markup=menu)
-                    return {"ok": True}
-                st.temp_fechamento_data = dt.isoformat()
-                db.commit()
-                set_state(db, st, mode="CLOSE_FLOW", step="ASK_SOLUCAO", os_id=os_id)
-                send_message(chat_id, TXT.CLOSE_ASK_SOLUCAO, reply_markup=menu)
+    if cmd == CMD_CONSULT and arg:
+        # só leitura: não mexe no fluxo em andamento
+        _consult(db, org_id, chat_id, arg, reply_markup=menu)
+        return {"ok": True}
+
+    if cmd == CMD_BOTTLENECKS:
+        if arg and not arg.isdigit():
+            queue_message(db, chat_id, TXT.BOTTLENECK_USAGE, reply_markup=menu)
+            return {"ok": True}
+        dias = min(max(int(arg or BOTTLENECK_DEFAULT_DAYS), 1), BOTTLENECK_MAX_DAYS)
+        queue_message(db, chat_id, _bottleneck_report(org_id, dias), reply_markup=menu)
+        return {"ok": True}
+
+    if cmd == CMD_PREVENTIVE:
+        _preventive_command(db, org_id, chat_id, telegram_user_id, arg, reply_markup=menu)
+        return {"ok": True}
+
+    if cmd == CMD_HISTORY:
+        equipamento = arg
+        if arg.lstrip("#").isdigit():
+            # /historico 42 = equipamento da OS 42
+            hist_id = int(arg.lstrip("#"))
+            wo = get_work_order(db, org_id, hist_id) or get_archived_work_order(db, org_id, hist_id)
+            if not wo:
+                queue_message(db, chat_id, TXT.OS_NOT_FOUND, reply_markup=menu)
                 return {"ok": True}
+            equipamento = wo.equipamento
+        if not equipamento:
+            queue_message(db, chat_id, TXT.HISTORY_USAGE, reply_markup=menu)
+            return {"ok": True}
 
-            if st.step == "ASK_SOLUCAO":
-                st.temp_solucao = text
-                db.commit()
-                set_state(db, st, mode="CLOSE_FLOW", step="ASK_INICIO", os_id=os_id)
-                send_message(chat_id, TXT.CLOSE_ASK_INICIO, reply_markup=menu)
+        _equipment_history(db, org_id, chat_id, equipamento, reply_markup=menu)
+        return {"ok": True}
+
+    # =====================================================
+    # MENU / COMANDOS EXISTENTES
+    # =====================================================
+    if text in (CMD_MENU_1, CMD_MENU_2, CMD_MENU_3):
+        queue_message(db, chat_id, TXT.MENU_TITLE, reply_markup=menu)
+        return {"ok": True}
+
+    if text in (CMD_CONSULT, BTN_CONSULT):
+        queue_message(db, chat_id, TXT.CONSULT_START, reply_markup=menu)
+        set_state(db, st, mode="CONSULT_FLOW", step="ASK_QUERY", os_id=None)
+        return {"ok": True}
+
+    if text in (CMD_OPEN, BTN_OPEN):
+        queue_message(db, chat_id, TXT.OPEN_START, reply_markup=menu)
+        set_state(db, st, mode="OPEN_FLOW", step="ASK_EQUIP", os_id=None)
+        return {"ok": True}
+
+    if text in (CMD_CLOSE, BTN_CLOSE):
+        items, has_more = _open_os_picker_items(db, org_id, page=0)
+        if not items:
+            queue_message(db, chat_id, TXT.NO_OPEN_OS_TO_CLOSE, reply_markup=menu)
+            return {"ok": True}
+
+        queue_message(
+            db,
+            chat_id,
+            "Selecione a OS para fechar:",
+            reply_markup=close_os_inline_keyboard(items, has_more=has_more),
+        )
+        return {"ok": True}
+
+    if text in (CMD_UPDATE, BTN_UPDATE):
+        items, has_more = _open_os_picker_items(db, org_id, page=0)
+        if not items:
+            queue_message(db, chat_id, TXT.NO_OPEN_OS_TO_UPDATE, reply_markup=menu)
+            return {"ok": True}
+
+        queue_message(db, chat_id, TXT.UPDATE_PICK_OS, reply_markup=update_os_inline_keyboard(items, has_more=has_more))
+        return {"ok": True}
+
+    # =====================================================
+    # CONSULT_FLOW
+    # =====================================================
+    if st.mode == "CONSULT_FLOW" and st.step == "ASK_QUERY" and text:
+        _consult(db, org_id, chat_id, text, reply_markup=menu)
+        clear_state(db, st)
+        return {"ok": True}
+
+    # =====================================================
+    # OPEN_FLOW
+    # =====================================================
+    if st.mode == "OPEN_FLOW":
+        if st.step == "ASK_EQUIP":
+            st.temp_equipamento = text
+            db.commit()
+            queue_message(db, chat_id, TXT.ASK_SETOR, reply_markup=menu)
+            set_state(db, st, mode="OPEN_FLOW", step="ASK_SETOR")
+            return {"ok": True}
+
+        if st.step == "ASK_SETOR":
+            if not text:
+                queue_message(db, chat_id, TXT.SETOR_REQUIRED, reply_markup=menu)
                 return {"ok": True}
 
-            if st.step == "ASK_INICIO":
-                total_min = _parse_total_duration_minutes(text)
-                if total_min is not None:
-                    st.temp_inicio_hhmm = f"TOTAL:{total_min}"
-                    st.temp_fim_hhmm = ""
-                    db.commit()
-                    set_state(db, st, mode="CLOSE_FLOW", step="ASK_TECNICOS", os_id=os_id)
-                    send_message(chat_id, TXT.CLOSE_ASK_TECNICOS, reply_markup=menu)
-                    return {"ok": True}
+            st.temp_setor = text
+            db.commit()
+            queue_message(db, chat_id, TXT.ASK_PROBLEMA, reply_markup=menu)
+            set_state(db, st, mode="OPEN_FLOW", step="ASK_PROBLEMA")
+            return {"ok": True}
 
-                inicio_min = _parse_hhmm(text)
-                if inicio_min is None:
-                    send_message(chat_id, TXT.CLOSE_INICIO_INVALID, reply_markup=menu)
-                    return {"ok": True}
+        if st.step == "ASK_PROBLEMA":
+            st.temp_problema = text
+            db.commit()
+            queue_message(db, chat_id, TXT.ASK_PARADA, reply_markup=menu)
+            set_state(db, st, mode="OPEN_FLOW", step="ASK_PARADA")
+            return {"ok": True}
 
-                st.temp_inicio_hhmm = text
-                db.commit()
-                set_state(db, st, mode="CLOSE_FLOW", step="ASK_FIM", os_id=os_id)
-                send_message(chat_id, TXT.CLOSE_ASK_FIM, reply_markup=menu)
+        if st.step == "ASK_PARADA":
+            val = _parse_parada(text)
+            if val is None:
+                queue_message(db, chat_id, TXT.PARADA_INVALID, reply_markup=menu)
                 return {"ok": True}
 
-            if st.step == "ASK_FIM":
-                fim_min = _parse_hhmm(text)
-                if fim_min is None:
-                    send_message(chat_id, TXT.CLOSE_FIM_INVALID, reply_markup=menu)
-                    return {"ok": True}
+            st.temp_maquina_parada = val
+            db.commit()
 
-                st.temp_fim_hhmm = text
-                db.commit()
-                set_state(db, st, mode="CLOSE_FLOW", step="ASK_TECNICOS", os_id=os_id)
-                send_message(chat_id, TXT.CLOSE_ASK_TECNICOS, reply_markup=menu)
+            _open_os(
+                db, st, org_id, chat_id, telegram_user_id,
+                st.temp_equipamento, st.temp_setor, st.temp_problema, st.temp_maquina_parada,
+                reply_markup=menu,
+            )
+            return {"ok": True}
+
+        if st.step == "CONFIRM_DUP":
+            # a escolha é pelos botões; texto solto só relembra
+            queue_message(db, chat_id, TXT.DUP_CHOOSE, reply_markup=menu)
+            return {"ok": True}
+
+    # =====================================================
+    # UPDATE_FLOW
+    # =====================================================
+    if st.mode == "UPDATE_FLOW":
+        if st.step == "ASK_OBS":
+            obs = "" if text.upper() == "PULAR" else text
+            wo = update_work_order_status(
+                db, org_id, st.os_id, st.temp_status, obs,
+                commit=False, expected_version=st.temp_os_version,
+            )
+            queue_message(db, chat_id, TXT.update_done(wo.id, wo.status, wo.status_observacao), reply_markup=menu)
+            clear_state(db, st)
+            return {"ok": True}
+
+    # =====================================================
+    # CLOSE_FLOW
+    # =====================================================
+    if st.mode == "CLOSE_FLOW":
+        os_id = st.os_id
+
+        if st.step == "PICK_BATCH":
+            queue_message(db, chat_id, TXT.BATCH_PICK_BUTTONS, reply_markup=menu)
+            return {"ok": True}
+
+        if st.step == "ASK_DATE":
+            dt = _parse_date(text)
+            if dt is None:
+                queue_message(db, chat_id, TXT.CLOSE_DATE_INVALID, reply_markup=menu)
                 return {"ok": True}
+            st.temp_fechamento_data = dt.isoformat()
+            db.commit()
+            queue_message(db, chat_id, TXT.CLOSE_ASK_SOLUCAO, reply_markup=menu)
+            set_state(db, st, mode="CLOSE_FLOW", step="ASK_SOLUCAO", os_id=os_id)
+            return {"ok": True}
 
-            if st.step == "ASK_TECNICOS":
-                st.temp_tecnicos = text
+        if st.step == "ASK_SOLUCAO":
+            st.temp_solucao = text
+            db.commit()
+            queue_message(db, chat_id, TXT.CLOSE_ASK_INICIO, reply_markup=menu)
+            set_state(db, st, mode="CLOSE_FLOW", step="ASK_INICIO", os_id=os_id)
+            return {"ok": True}
+
+        if st.step == "ASK_INICIO":
+            total_min = _parse_total_duration_minutes(text)
+            if total_min is not None:
+                st.temp_inicio_hhmm = f"TOTAL:{total_min}"
+                st.temp_fim_hhmm = ""
                 db.commit()
-                set_state(db, st, mode="CLOSE_FLOW", step="ASK_MATERIAIS", os_id=os_id)
-                send_message(chat_id, TXT.CLOSE_ASK_MATERIAIS, reply_markup=menu)
+                queue_message(db, chat_id, TXT.CLOSE_ASK_TECNICOS, reply_markup=menu)
+                set_state(db, st, mode="CLOSE_FLOW", step="ASK_TECNICOS", os_id=os_id)
                 return {"ok": True}
 
-            if st.step == "ASK_MATERIAIS":
-                st.temp_materiais = text
-                db.commit()
-                set_state(db, st, mode="CLOSE_FLOW", step="ASK_CUSTO", os_id=os_id)
-                send_message(chat_id, TXT.CLOSE_ASK_CUSTO, reply_markup=menu)
+            inicio_min = _parse_hhmm(text)
+            if inicio_min is None:
+                queue_message(db, chat_id, TXT.CLOSE_INICIO_INVALID, reply_markup=menu)
                 return {"ok": True}
 
-            if st.step == "ASK_CUSTO":
-                st.temp_custo_pecas = _safe_float_string(text)
-                db.commit()
+            st.temp_inicio_hhmm = text
+            db.commit()
+            queue_message(db, chat_id, TXT.CLOSE_ASK_FIM, reply_markup=menu)
+            set_state(db, st, mode="CLOSE_FLOW", step="ASK_FIM", os_id=os_id)
+            return {"ok": True}
 
-                tempo_min = 0
-                if st.temp_inicio_hhmm.startswith("TOTAL:"):
-                    try:
-                        tempo_min = int(st.temp_inicio_hhmm.split(":", 1)[1])
-                    except Exception:
-                        tempo_min = 0
-                else:
-                    inicio_min = _parse_hhmm(st.temp_inicio_hhmm)
-                    fim_min = _parse_hhmm(st.temp_fim_hhmm)
-                    if inicio_min is not None and fim_min is not None:
-                        if fim_min < inicio_min:
-                            fim_min += 24 * 60
-                        tempo_min = max(0, fim_min - inicio_min)
-
-                tech_names = _parse_technicians_list(st.temp_tecnicos)
-                if tech_names:
-                    add_technicians_to_os(db, os_id, tech_names)
-
-                materiais = _parse_materials_list(st.temp_materiais)
-                if materiais:
-                    add_materials(db, os_id, materiais)
-
-                # determine closing datetime from stored string
-                fech_dt = None
-                if st.temp_fechamento_data:
-                    try:
-                        fech_dt = datetime.fromisoformat(st.temp_fechamento_data)
-                    except Exception:
-                        fech_dt = None
-
-                wo = close_work_order(
-                    db,
-                    org_id=org_id,
-                    os_id=os_id,
-                    solucao=st.temp_solucao,
-                    tempo_min=tempo_min,
-                    custo_pecas=st.temp_custo_pecas,
-                    fechamento_em=fech_dt,
-                )
+        if st.step == "ASK_FIM":
+            fim_min = _parse_hhmm(text)
+            if fim_min is None:
+                queue_message(db, chat_id, TXT.CLOSE_FIM_INVALID, reply_markup=menu)
+                return {"ok": True}
 
-                techs_db = list_technicians_for_os(db, os_id)
-                tecnicos_txt = ", ".join(techs_db) if techs_db else "SEM INFORMAÇÃO"
+            st.temp_fim_hhmm = text
+            db.commit()
+            queue_message(db, chat_id, TXT.CLOSE_ASK_TECNICOS, reply_markup=menu)
+            set_state(db, st, mode="CLOSE_FLOW", step="ASK_TECNICOS", os_id=os_id)
+            return {"ok": True}
 
-                mats = list_materials(db, os_id)
-                if mats:
-                    mats_txt = ", ".join([m.descricao for m in mats[:6]])
-                    if len(mats) > 6:
-                        mats_txt += "..."
-                else:
-                    mats_txt = "NENHUMA"
+        if st.step == "ASK_TECNICOS":
+            st.temp_tecnicos = text
+            db.commit()
+            queue_message(db, chat_id, TXT.CLOSE_ASK_MATERIAIS, reply_markup=menu)
+            set_state(db, st, mode="CLOSE_FLOW", step="ASK_MATERIAIS", os_id=os_id)
+            return {"ok": True}
 
-                # formatted date for summary message
-                if fech_dt:
-                    data_txt = fech_dt.astimezone(timezone.utc).strftime("%d/%m/%Y")
-                else:
-                    data_txt = datetime.now(timezone.utc).strftime("%d/%m/%Y")
+        if st.step == "ASK_MATERIAIS":
+            st.temp_materiais = text
+            db.commit()
+            queue_message(db, chat_id, TXT.CLOSE_ASK_CUSTO, reply_markup=menu)
+            set_state(db, st, mode="CLOSE_FLOW", step="ASK_CUSTO", os_id=os_id)
+            return {"ok": True}
 
-                clear_state(db, st)
-                send_message(
-                    chat_id,
-                    TXT.close_done(
-                        wo.id, wo.equipamento, wo.setor,
-                        data_txt,
-                        wo.tempo_gasto_minutos,
-                        tecnicos_txt,
-                        mats_txt,
-                        wo.custo_pecas,
-                        wo.solucao_aplicada,
-                    ),
+        if st.step == "ASK_CUSTO":
+            custo = _safe_float_string(text)
+
+            tempo_min = 0
+            if st.temp_inicio_hhmm.startswith("TOTAL:"):
+                try:
+                    tempo_min = int(st.temp_inicio_hhmm.split(":", 1)[1])
+                except Exception:
+                    tempo_min = 0
+            else:
+                inicio_min = _parse_hhmm(st.temp_inicio_hhmm)
+                fim_min = _parse_hhmm(st.temp_fim_hhmm)
+                if inicio_min is not None and fim_min is not None:
+                    tempo_min = _minutes_between(inicio_min, fim_min)
+
+            # determine closing datetime from stored string
+            fech_dt = None
+            if st.temp_fechamento_data:
+                try:
+                    fech_dt = datetime.fromisoformat(st.temp_fechamento_data)
+                except Exception:
+                    fech_dt = None
+
+            if st.temp_lote:
+                _close_os_batch(
+                    db, st, org_id, _batch_selection(st), chat_id,
+                    fech_dt=fech_dt,
+                    solucao=st.temp_solucao,
+                    tempo_min=tempo_min,
+                    tecnicos=_parse_technicians_list(st.temp_tecnicos),
+                    materiais=_parse_materials_list(st.temp_materiais),
+                    custo_pecas=custo,
                     reply_markup=menu,
                 )
                 return {"ok": True}
 
-        send_message(chat_id, TXT.UNKNOWN_COMMAND, reply_markup=menu)
-        return {"ok": True}
+            _close_os(
+                db, st, org_id, os_id, chat_id,
+                fech_dt=fech_dt,
+                solucao=st.temp_solucao,
+                tempo_min=tempo_min,
+                tecnicos=_parse_technicians_list(st.temp_tecnicos),
+                materiais=_parse_materials_list(st.temp_materiais),
+                custo_pecas=custo,
+                reply_markup=menu,
+                expected_version=st.temp_os_version,
+            )
+            return {"ok": True}
 
-    finally:
-        db.close()
\ No newline at end of file
+    queue_message(db, chat_id, TXT.UNKNOWN_COMMAND, reply_markup=menu)
+    return {"ok": True}
@@ -0,0 +1,176 @@
+# bench/bench_repository.py
+"""
+Cronometra as consultas do repositório contra um banco grande
+(gerado por bench.gen_dataset).
+
+Cada função roda --iterations vezes com argumentos sorteados do próprio
+banco (empresas grandes e pequenas, OS abertas e fechadas, usuários ativos),
+numa sessão nova a cada chamada, como no webhook.
+
+Para avaliar uma mudança de índice/schema:
+    python -m bench.bench_repository --db /tmp/big.db --save antes.json
+    ... aplica a mudança ...
+    python -m bench.bench_repository --db /tmp/big.db --compare antes.json
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.load_test import percentile
+
+
+def build_cases(db, rng: random.Random, n: int) -> dict:
+    """Sorteia os argumentos de cada consulta a partir dos dados existentes."""
+    from sqlalchemy import func
+    from easypcm.models import OrgUserRow, WorkOrderRow
+
+    org_ids = [r[0] for r in db.query(WorkOrderRow.org_id).group_by(WorkOrderRow.org_id)
+               .order_by(func.count(WorkOrderRow.id).desc()).all()]
+    big_org = org_ids[0]
+    max_os = db.query(func.max(WorkOrderRow.id)).scalar() or 1
+    user_ids = [r[0] for r in db.query(OrgUserRow.telegram_user_id).filter(OrgUserRow.active == True).limit(50_000).all()]
+
+    def some(seq):
+        return [rng.choice(seq) for _ in range(n)]
+
+    os_ids = [rng.randint(1, max_os) for _ in range(n)]
+    os_rows = (
+        db.query(WorkOrderRow.id, WorkOrderRow.org_id, WorkOrderRow.equipamento)
+        .filter(WorkOrderRow.id.in_(os_ids))
+        .all()
+    )
+    os_org = {r[0]: r[1] for r in os_rows}
+    equips = [(r[1], r[2]) for r in os_rows] or [(big_org, "")]
+
+    return {
+        "orgs": some(org_ids),
+        "big_org": big_org,
+        "users": some(user_ids),
+        "os": [(os_org.get(i, big_org), i) for i in os_ids],
+        "equips": [rng.choice(equips) for _ in range(n)],
+    }
+
+
+def run(session_factory, cases: dict, iterations: int) -> dict[str, list[float]]:
+    from easypcm.repository import (
+        get_user_org_id,
+        get_user_org_membership,
+        get_work_order,
+        get_work_order_card,
+        find_duplicate_open_work_order,
+        list_equipment_history,
+        list_active_org_members,
+        list_materials,
+        list_open_work_orders,
+        list_technicians_for_os,
+        search_work_orders,
+        status_time_report,
+    )
+    from datetime import datetime, timedelta, timezone
+
+    last_30d = datetime.now(timezone.utc) - timedelta(days=30)
+
+    benches = {
+        "list_open_work_orders": lambda db, i: list_open_work_orders(db, cases["orgs"][i]),
+        "list_open_work_orders[big_org]": lambda db, i: list_open_work_orders(db, cases["big_org"]),
+        "list_open_work_orders[page 5]": lambda db, i: list_open_work_orders(db, cases["big_org"], offset=50),
+        "get_user_org_membership": lambda db, i: get_user_org_membership(db, cases["users"][i]),
+        "get_user_org_id": lambda db, i: get_user_org_id(db, cases["users"][i]),
+        "get_work_order": lambda db, i: get_work_order(db, *cases["os"][i]),
+        "list_technicians_for_os": lambda db, i: list_technicians_for_os(db, cases["os"][i][1]),
+        "list_materials": lambda db, i: list_materials(db, cases["os"][i][1]),
+        "get_work_order_card": lambda db, i: get_work_order_card(db, *cases["os"][i]),
+        "list_equipment_history": lambda db, i: list_equipment_history(db, *cases["equips"][i]),
+        "find_duplicate_open_work_order": lambda db, i: find_duplicate_open_work_order(
+            db, *cases["equips"][i], "vazamento no selo mecânico", 0.2),
+        "status_time_report[30d]": lambda db, i: status_time_report(db, cases["orgs"][i], last_30d),
+        "status_time_report[30d, big_org]": lambda db, i: status_time_report(db, cases["big_org"], last_30d),
+        "search_work_orders[equip]": lambda db, i: search_work_orders(db, cases["orgs"][i], equipamento="Bomba"),
+        "list_active_org_members": lambda db, i: list_active_org_members(db, cases["orgs"][i]),
+    }
+
+    results: dict[str, list[float]] = {}
+    for name, fn in benches.items():
+        timings = []
+        for i in range(iterations):
+            db = session_factory()
+            try:
+                t0 = time.perf_counter()
+                fn(db, i)
+                timings.append(time.perf_counter() - t0)
+            finally:
+                db.close()
+        results[name] = timings
+    return results
+
+
+def summarize(results: dict[str, list[float]]) -> dict[str, dict[str, float]]:
+    return {
+        name: {
+            "mean_ms": statistics.mean(t) * 1000,
+            "p50_ms": percentile(t, 50) * 1000,
+            "p95_ms": percentile(t, 95) * 1000,
+            "p99_ms": percentile(t, 99) * 1000,
+        }
+        for name, t in results.items()
+    }
+
+
+def report(summary: dict, baseline: dict | None = None, out=sys.stdout) -> None:
+    header = f"{'consulta':<34}{'média ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    if baseline:
+        header += f"{'Δ p50':>10}"
+    print(header, file=out)
+    for name, s in summary.items():
+        line = f"{name:<34}{s['mean_ms']:>10.3f}{s['p50_ms']:>10.3f}{s['p95_ms']:>10.3f}{s['p99_ms']:>10.3f}"
+        if baseline and name in baseline and baseline[name]["p50_ms"]:
+            delta = (s["p50_ms"] / baseline[name]["p50_ms"] - 1) * 100
+            line += f"{delta:>+9.1f}%"
+        print(line, file=out)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark das consultas do repositório")
+    parser.add_argument("--db", required=True, help="banco gerado por bench.gen_dataset")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--save", default="", help="grava o resumo em JSON")
+    parser.add_argument("--compare", default="", help="compara com um resumo salvo antes")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        parser.error(f"banco não encontrado: {args.db}")
+
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.abspath(args.db)}"
+    from easypcm.db import SessionLocal
+
+    rng = random.Random(args.seed)
+    db = SessionLocal()
+    try:
+        cases = build_cases(db, rng, max(args.iterations, args.warmup))
+    finally:
+        db.close()
+
+    run(SessionLocal, cases, args.warmup)  # aquece cache de páginas e statements
+    summary = summarize(run(SessionLocal, cases, args.iterations))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    report(summary, baseline)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# bench/fake_bot_api.py
+"""
+Servidor HTTP local que imita o Bot API do Telegram para benchmarks.
+
+Responde qualquer POST /bot<TOKEN>/<método> com {"ok": true}, conta as
+chamadas por método e pode simular latência e 429 (retry_after).
+
+Uso isolado:
+    python -m bench.fake_bot_api --port 8081 --latency-ms 40
+e rode o bot com TELEGRAM_API_BASE=http://127.0.0.1:8081
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeBotApi:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency_ms: float = 0.0, rate_429: float = 0.0):
+        self.latency_ms = latency_ms
+        self.rate_429 = rate_429
+        self.calls: Counter = Counter()
+        self.throttled = 0
+        self._lock = threading.Lock()
+        self._message_id = 0
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                self.rfile.read(length)
+                method = self.path.rsplit("/", 1)[-1]
+                api._handle(self, method)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _handle(self, handler: BaseHTTPRequestHandler, method: str) -> None:
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000.0)
+
+        with self._lock:
+            if self.rate_429 and random.random() < self.rate_429:
+                self.throttled += 1
+                status = 429
+                body = {"ok": False, "error_code": 429, "parameters": {"retry_after": 1}}
+            else:
+                self.calls[method] += 1
+                self._message_id += 1
+                status = 200
+                body = {"ok": True, "result": {"message_id": self._message_id}}
+
+        raw = json.dumps(body).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(raw)))
+        handler.end_headers()
+        handler.wfile.write(raw)
+
+    def start(self) -> "FakeBotApi":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-bot-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def total_calls(self) -> int:
+        with self._lock:
+            return sum(self.calls.values())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Bot API fake para benchmarks")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--rate-429", type=float, default=0.0, help="fração das chamadas que recebem 429")
+    args = parser.parse_args()
+
+    api = FakeBotApi(port=args.port, latency_ms=args.latency_ms, rate_429=args.rate_429).start()
+    print(f"Bot API fake em {api.base_url} (Ctrl+C para sair)")
+    try:
+        while True:
+            time.sleep(5)
+            print(dict(api.calls), "429:", api.throttled)
+    except KeyboardInterrupt:
+        api.stop()
+
+
+if __name__ == "__main__":
+    main()
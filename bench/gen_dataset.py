@@ -0,0 +1,313 @@
+# bench/gen_dataset.py
+"""
+Gera um banco SQLite grande e realista para benchmarks do repositório.
+
+Distribuições (aproximadas do uso real):
+- tamanho das empresas em cauda longa (poucas empresas grandes, muitas pequenas);
+- ~10% dos membros são ORG_ADMIN, ~3% das associações inativas;
+- equipamentos por empresa em Zipf: poucas máquinas concentram as falhas;
+- aberturas espalhadas pelos últimos --days dias, mais em dias úteis;
+- OS recentes têm mais chance de estar abertas; as antigas quase todas fechadas;
+- tempo de reparo log-normal (mediana ~1h30), 0-4 materiais e 1-3 técnicos por OS fechada;
+- histórico de status: ~30% das fechadas passam por uma espera (compras, terceiro...) no meio.
+
+Tudo entra por INSERT em lote (executemany) em transações grandes.
+
+Uso:
+    python -m bench.gen_dataset --db /tmp/big.db --orgs 200 --users 20000 --work-orders 2000000
+"""
+import argparse
+import bisect
+import itertools
+import math
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from easypcm.schemas import normalize_equipamento
+from easypcm.ui_labels import (
+    STATUS_ABERTA, STATUS_EM_ANDAMENTO, STATUS_CANCELADA, STATUS_FECHADA,
+    STATUS_AGUARDANDO_COMPRAS, STATUS_AGUARDANDO_PARADA, STATUS_AGUARDANDO_TERCEIRO,
+)
+
+SETORES = [
+    "Utilidades", "Produção", "Envase", "Caldeiraria", "Elétrica", "Ferramentaria",
+    "Expedição", "Tratamento de efluentes", "Laboratório", "Almoxarifado",
+]
+EQUIP_TIPOS = [
+    "Bomba", "Compressor", "Motor", "Esteira", "Redutor", "Prensa", "Torno",
+    "Caldeira", "Chiller", "Exaustor", "Empilhadeira", "Painel", "Válvula", "Misturador",
+]
+PROBLEMAS = [
+    "vazamento no selo mecânico", "ruído anormal no rolamento", "superaquecimento",
+    "disjuntor desarmando", "vibração excessiva", "correia rompida", "baixa pressão",
+    "falha no sensor", "curto no painel", "travamento do eixo", "óleo contaminado",
+]
+SOLUCOES = [
+    "troca do selo mecânico", "troca dos rolamentos", "limpeza e lubrificação",
+    "substituição do disjuntor", "alinhamento e balanceamento", "troca da correia",
+    "ajuste do pressostato", "substituição do sensor", "reaperto dos bornes",
+]
+MATERIAIS = [
+    "Selo mecânico", "Rolamento 6205", "Rolamento 6308", "Graxa", "Óleo ISO 68",
+    "Correia A-42", "Disjuntor 32A", "Sensor indutivo", "Parafusos M8", "Junta de vedação",
+    "Contator", "Fusível", "Retentor", "Mangueira hidráulica",
+]
+NOMES = [
+    "Marcos", "João", "Pedro", "Ana", "Carlos", "Lucas", "Mateus", "Rafael", "Bruno",
+    "Felipe", "Juliana", "Paulo", "André", "Tiago", "Diego", "Rodrigo", "Fernanda",
+]
+SOBRENOMES = ["Silva", "Souza", "Oliveira", "Santos", "Lima", "Costa", "Pereira", "Almeida", "Gomes", "Ribeiro"]
+OPEN_STATUSES = [
+    STATUS_ABERTA, STATUS_EM_ANDAMENTO, STATUS_AGUARDANDO_COMPRAS,
+    STATUS_AGUARDANDO_PARADA, STATUS_AGUARDANDO_TERCEIRO,
+]
+WAIT_STATUSES = [STATUS_AGUARDANDO_COMPRAS, STATUS_AGUARDANDO_PARADA, STATUS_AGUARDANDO_TERCEIRO]
+
+
+class Weighted:
+    """Sorteio com pesos fixos via busca binária nos pesos acumulados."""
+
+    def __init__(self, items: list, weights: list[float]):
+        self.items = items
+        self.cum = list(itertools.accumulate(weights))
+
+    def pick(self, rng: random.Random):
+        return self.items[bisect.bisect_right(self.cum, rng.random() * self.cum[-1])]
+
+
+def zipf_weights(n: int, s: float = 1.1) -> list[float]:
+    return [1.0 / (k ** s) for k in range(1, n + 1)]
+
+
+def _batches(rows_iter, size: int):
+    batch = []
+    for row in rows_iter:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def generate(engine, args) -> None:
+    from sqlalchemy import insert
+    from easypcm.models import (
+        Base,
+        MaterialRow,
+        OrganizationRow,
+        OrgUserRow,
+        TechnicianRow,
+        UserRow,
+        WorkOrderRow,
+        WorkOrderStatusHistoryRow,
+        WorkOrderTechnicianRow,
+    )
+
+    rng = random.Random(args.seed)
+    Base.metadata.create_all(bind=engine)
+    now = datetime.now(timezone.utc)
+
+    def bulk(conn, model, rows_iter) -> int:
+        total = 0
+        for batch in _batches(rows_iter, args.batch):
+            conn.execute(insert(model), batch)
+            total += len(batch)
+        return total
+
+    t0 = time.perf_counter()
+    with engine.begin() as conn:
+        if engine.dialect.name == "sqlite":
+            # só durante a carga: o arquivo é descartável até o fim do script
+            conn.exec_driver_sql("PRAGMA synchronous = OFF")
+
+        # empresas: tamanho em cauda longa (Pareto)
+        org_ids = list(range(1, args.orgs + 1))
+        org_sizes = [rng.paretovariate(1.2) for _ in org_ids]
+        bulk(conn, OrganizationRow, (
+            {"id": oid, "name": f"Empresa {oid}", "active": True, "created_at": now - timedelta(days=args.days)}
+            for oid in org_ids
+        ))
+        org_pick = Weighted(org_ids, org_sizes)
+
+        # usuários e associações
+        first_uid = 100_000_000
+        user_ids = [str(first_uid + i) for i in range(args.users)]
+        bulk(conn, UserRow, (
+            {"telegram_user_id": uid, "username": f"user{uid}", "first_name": rng.choice(NOMES),
+             "is_master": False, "created_at": now}
+            for uid in user_ids
+        ))
+        members_by_org: dict[int, list[str]] = {oid: [] for oid in org_ids}
+
+        def memberships():
+            for i, uid in enumerate(user_ids):
+                # garante ao menos um admin por empresa
+                oid = org_ids[i] if i < len(org_ids) else org_pick.pick(rng)
+                members_by_org[oid].append(uid)
+                role = "ORG_ADMIN" if i < len(org_ids) or rng.random() < 0.10 else "ORG_USER"
+                yield {"org_id": oid, "telegram_user_id": uid, "role": role,
+                       "active": rng.random() >= 0.03, "created_at": now}
+        bulk(conn, OrgUserRow, memberships())
+
+        # técnicos (nome é único no cadastro global)
+        tech_names = sorted({f"{n} {s}" for n in NOMES for s in SOBRENOMES})[: args.technicians]
+        bulk(conn, TechnicianRow, ({"id": i + 1, "nome": n} for i, n in enumerate(tech_names)))
+        tech_pick = Weighted(list(range(1, len(tech_names) + 1)), zipf_weights(len(tech_names), 0.8))
+
+        # equipamentos por empresa: Zipf sobre um catálogo próprio
+        equip_by_org = {}
+        for oid, size in zip(org_ids, org_sizes):
+            n_equip = max(5, min(400, int(20 * size)))
+            names = [f"{rng.choice(EQUIP_TIPOS)} {k:03d}" for k in range(1, n_equip + 1)]
+            setores = [rng.choice(SETORES) for _ in names]
+            equip_by_org[oid] = Weighted(list(zip(names, setores)), zipf_weights(n_equip))
+
+        print(f"cadastros: {time.perf_counter() - t0:.1f}s")
+
+        span_sec = args.days * 86400
+        material_rows: list[dict] = []
+        link_rows: list[dict] = []
+        history_rows: list[dict] = []
+        counts = {"wo": 0, "mat": 0, "tech": 0, "hist": 0}
+
+        def status_change(wo_id, oid, setor, from_status, to_status, since, at):
+            history_rows.append({
+                "org_id": oid, "work_order_id": wo_id, "setor": setor,
+                "from_status": from_status, "to_status": to_status,
+                "from_since": since, "changed_at": at,
+                "duration_sec": int((at - since).total_seconds()), "observacao": "",
+            })
+
+        def flush_children():
+            if material_rows:
+                conn.execute(insert(MaterialRow), material_rows)
+                counts["mat"] += len(material_rows)
+                material_rows.clear()
+            if link_rows:
+                conn.execute(insert(WorkOrderTechnicianRow), link_rows)
+                counts["tech"] += len(link_rows)
+                link_rows.clear()
+            if history_rows:
+                conn.execute(insert(WorkOrderStatusHistoryRow), history_rows)
+                counts["hist"] += len(history_rows)
+                history_rows.clear()
+
+        def work_orders():
+            for wo_id in range(1, args.work_orders + 1):
+                oid = org_pick.pick(rng)
+                equip, setor = equip_by_org[oid].pick(rng)
+                members = members_by_org[oid] or user_ids[:1]
+
+                # abertura: ids crescentes no tempo, com menos movimento no fim de semana
+                age = span_sec * (1 - wo_id / args.work_orders) + rng.uniform(0, 3600)
+                opened = now - timedelta(seconds=age)
+                if opened.weekday() >= 5 and rng.random() < 0.6:
+                    opened -= timedelta(days=2)
+
+                age_days = age / 86400
+                still_open = rng.random() < (0.6 if age_days < 7 else 0.15 if age_days < 60 else 0.01)
+                parada = "SIM" if rng.random() < 0.3 else "NÃO"
+
+                row = {
+                    "id": wo_id,
+                    "org_id": oid,
+                    "chat_id": rng.choice(members),
+                    "equipamento": equip,
+                    "equipamento_norm": normalize_equipamento(equip),
+                    "setor": setor,
+                    "descricao_do_problema": rng.choice(PROBLEMAS),
+                    "maquina_parada": parada,
+                    "status_observacao": "",
+                    "abertura_em": opened,
+                    "created_at": opened,
+                    "source_text": "",
+                }
+                if not still_open and rng.random() < 0.02:
+                    row.update(
+                        status=STATUS_CANCELADA, status_updated_at=opened,
+                        solucao_aplicada="SEM INFORMAÇÃO", tempo_gasto_minutos="SEM INFORMAÇÃO",
+                        custo_pecas="SEM INFORMAÇÃO", fechamento_em=None,
+                    )
+                    status_change(wo_id, oid, setor, STATUS_ABERTA, STATUS_CANCELADA, opened, opened)
+                elif still_open:
+                    status = rng.choice(OPEN_STATUSES)
+                    moved = opened + timedelta(seconds=rng.uniform(0, min(age, 86400)))
+                    row.update(
+                        status=status, status_updated_at=moved if status != STATUS_ABERTA else opened,
+                        solucao_aplicada="SEM INFORMAÇÃO", tempo_gasto_minutos="SEM INFORMAÇÃO",
+                        custo_pecas="SEM INFORMAÇÃO", fechamento_em=None,
+                    )
+                    if status != STATUS_ABERTA:
+                        status_change(wo_id, oid, setor, STATUS_ABERTA, status, opened, moved)
+                else:
+                    minutes = max(5, int(rng.lognormvariate(math.log(90), 0.8)))
+                    closed = opened + timedelta(minutes=minutes + rng.uniform(0, 2880))
+                    n_mat = min(4, int(rng.expovariate(0.8)))
+                    row.update(
+                        status=STATUS_FECHADA, status_updated_at=closed,
+                        solucao_aplicada=rng.choice(SOLUCOES), tempo_gasto_minutos=str(minutes),
+                        custo_pecas=f"{rng.lognormvariate(math.log(150), 1.0) if n_mat else 0:.2f}",
+                        fechamento_em=closed,
+                    )
+                    if rng.random() < 0.3:
+                        wait = rng.choice(WAIT_STATUSES)
+                        mid = opened + (closed - opened) * rng.uniform(0.05, 0.3)
+                        status_change(wo_id, oid, setor, STATUS_ABERTA, wait, opened, mid)
+                        status_change(wo_id, oid, setor, wait, STATUS_FECHADA, mid, closed)
+                    else:
+                        status_change(wo_id, oid, setor, STATUS_ABERTA, STATUS_FECHADA, opened, closed)
+                    for _ in range(n_mat):
+                        material_rows.append({"work_order_id": wo_id, "descricao": rng.choice(MATERIAIS), "created_at": closed})
+                    for tech_id in {tech_pick.pick(rng) for _ in range(rng.choice((1, 1, 2, 2, 3)))}:
+                        link_rows.append({"work_order_id": wo_id, "technician_id": tech_id})
+                yield row
+
+        t1 = time.perf_counter()
+        for batch in _batches(work_orders(), args.batch):
+            conn.execute(insert(WorkOrderRow), batch)
+            counts["wo"] += len(batch)
+            flush_children()
+            if counts["wo"] % (args.batch * 20) == 0:
+                rate = counts["wo"] / (time.perf_counter() - t1)
+                print(f"  {counts['wo']:>10} OS  ({rate:,.0f}/s)")
+
+    print(
+        f"pronto em {time.perf_counter() - t0:.1f}s: {args.orgs} empresas, {args.users} usuários, "
+        f"{counts['wo']} OS, {counts['mat']} materiais, {counts['tech']} vínculos de técnicos, "
+        f"{counts['hist']} trocas de status"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Gera um banco grande e realista para benchmarks")
+    parser.add_argument("--db", required=True, help="arquivo SQLite de saída (não pode existir)")
+    parser.add_argument("--orgs", type=int, default=100)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--work-orders", type=int, default=1_000_000)
+    parser.add_argument("--technicians", type=int, default=120)
+    parser.add_argument("--days", type=int, default=730, help="janela de aberturas (dias para trás)")
+    parser.add_argument("--batch", type=int, default=5_000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    if os.path.exists(args.db):
+        parser.error(f"{args.db} já existe")
+    if args.users < args.orgs:
+        parser.error("--users precisa ser >= --orgs (um admin por empresa)")
+
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.abspath(args.db)}"
+    # escritor único: o PRAGMA synchronous não pode rodar dentro do BEGIN IMMEDIATE
+    os.environ["SQLITE_BEGIN_IMMEDIATE"] = "0"
+    from easypcm.db import engine
+
+    generate(engine, args)
+
+
+if __name__ == "__main__":
+    main()
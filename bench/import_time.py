@@ -0,0 +1,77 @@
+# bench/import_time.py
+"""
+Mede o cold start: quanto custa "import app" num processo Python novo.
+
+Cada rodada sobe um interpretador com -X importtime; o tempo total vem do
+relógio do processo filho e o detalhe por módulo do relatório do importtime
+(stderr). Nada de banco/rede é tocado no import (ver app.startup).
+
+    python -m bench.import_time
+    python -m bench.import_time --runs 20 --top 25 --module app
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_SNIPPET = "import time; t0 = time.perf_counter(); import {module}; print(time.perf_counter() - t0)"
+
+
+def run_once(module: str, env: dict) -> tuple[float, dict[str, int]]:
+    """Retorna (segundos do import, {módulo: cumulativo em µs})."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _SNIPPET.format(module=module)],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+    )
+    cumulative: dict[str, int] = {}
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _self_us, cum_us, name = line[len("import time:"):].split("|", 2)
+        cumulative[name.strip()] = int(cum_us)
+    return float(proc.stdout.strip().splitlines()[-1]), cumulative
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Tempo de import (cold start) do EasyPCM")
+    parser.add_argument("--module", default="app")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=15, help="módulos mais caros (cumulativo)")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    # banco de rascunho: o import não deveria nem abrir, mas se abrir não suja o real
+    env.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='easypcm-import-'), 'x.db')}")
+    env.setdefault("TELEGRAM_BOT_TOKEN", "BENCH")
+    env.setdefault("MASTER_USER_ID", "0")
+
+    totals: list[float] = []
+    per_module: dict[str, list[int]] = {}
+    for _ in range(args.runs):
+        total, cumulative = run_once(args.module, env)
+        totals.append(total)
+        for name, us in cumulative.items():
+            per_module.setdefault(name, []).append(us)
+
+    print(f"import {args.module}: {args.runs} rodadas")
+    print(f"  mediana {statistics.median(totals) * 1000:.1f} ms"
+          f"  mín {min(totals) * 1000:.1f} ms  máx {max(totals) * 1000:.1f} ms\n")
+
+    # só módulos de topo (sem ponto) ou do próprio projeto, para a lista ser útil
+    ranked = sorted(
+        ((statistics.median(v), name) for name, v in per_module.items()
+         if "." not in name or name.startswith("easypcm")),
+        reverse=True,
+    )
+    print(f"{'módulo':<40}{'cumulativo ms (mediana)':>26}")
+    for us, name in ranked[:args.top]:
+        print(f"{name:<40}{us / 1000:>26.1f}")
+
+
+if __name__ == "__main__":
+    main()
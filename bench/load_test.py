@@ -0,0 +1,319 @@
+# bench/load_test.py
+"""
+Benchmark ponta a ponta do webhook.
+
+Sobe um Bot API fake local, cria um banco SQLite temporário com empresas e
+usuários sintéticos e dispara updates em /telegram/webhook simulando os
+fluxos completos (abrir -> atualizar -> fechar) de muitos chats em paralelo.
+
+Relata updates/s, latência p50/p95/p99 por passo de fluxo e commits no banco
+por update. Com --backup, roda backups online em sequência durante o teste e
+compara a latência dos updates com e sem backup em andamento.
+
+Uso:
+    python -m bench.load_test --chats 200 --orgs 10 --concurrency 50
+    python -m bench.load_test --chats 200 --backup
+    python -m bench.load_test --chats 200 --orgs 10 --shard
+
+Requer httpx (pip install -r bench/requirements.txt).
+"""
+import argparse
+import asyncio
+import contextvars
+import itertools
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+# o bench roda a partir da raiz do repositório
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.fake_bot_api import FakeBotApi
+
+# contador de commits do update em andamento (cada task do asyncio tem o seu;
+# a thread do worker do outbox não tem nenhum e fica de fora)
+_commits: contextvars.ContextVar[list[int] | None] = contextvars.ContextVar("bench_commits", default=None)
+
+
+def _on_commit(_conn) -> None:
+    counter = _commits.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = min(len(ordered) - 1, max(0, int(round(p / 100.0 * (len(ordered) - 1)))))
+    return ordered[k]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.commits: dict[str, list[int]] = defaultdict(list)
+        # latência de todos os updates, separada por "havia backup rodando?"
+        self.by_backup: dict[bool, list[float]] = defaultdict(list)
+        self.updates = 0
+
+    def add(self, step: str, seconds: float, commits: int, during_backup: bool = False) -> None:
+        self.latencies[step].append(seconds)
+        self.commits[step].append(commits)
+        self.by_backup[during_backup].append(seconds)
+        self.updates += 1
+
+    def report(self, elapsed: float, out=sys.stdout) -> None:
+        total_commits = sum(sum(c) for c in self.commits.values())
+        print(f"\nupdates: {self.updates}  tempo: {elapsed:.2f}s  "
+              f"throughput: {self.updates / elapsed:.1f} updates/s  "
+              f"commits/update: {total_commits / max(1, self.updates):.2f}", file=out)
+        print(f"\n{'passo':<28}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'commits':>9}", file=out)
+        for step in sorted(self.latencies):
+            lat = self.latencies[step]
+            print(
+                f"{step:<28}{len(lat):>6}"
+                f"{percentile(lat, 50) * 1000:>10.1f}"
+                f"{percentile(lat, 95) * 1000:>10.1f}"
+                f"{percentile(lat, 99) * 1000:>10.1f}"
+                f"{statistics.mean(self.commits[step]):>9.2f}",
+                file=out,
+            )
+
+        if self.by_backup.get(True):
+            print(f"\n{'backup em andamento':<28}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}", file=out)
+            for during, label in ((False, "não"), (True, "sim")):
+                lat = self.by_backup.get(during, [])
+                print(
+                    f"{label:<28}{len(lat):>6}"
+                    f"{percentile(lat, 50) * 1000:>10.1f}"
+                    f"{percentile(lat, 95) * 1000:>10.1f}"
+                    f"{percentile(lat, 99) * 1000:>10.1f}",
+                    file=out,
+                )
+
+
+class SyntheticChat:
+    """Gera os updates de um chat privado (mensagens e callbacks)."""
+
+    _update_ids = itertools.count(1)
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+
+    def message(self, text: str) -> dict:
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": 1,
+                "chat": {"id": self.user_id, "type": "private"},
+                "from": {"id": self.user_id, "first_name": f"Bench {self.user_id}"},
+                "text": text,
+            },
+        }
+
+    def callback(self, data: str) -> dict:
+        uid = next(self._update_ids)
+        return {
+            "update_id": uid,
+            "callback_query": {
+                "id": f"cb{uid}",
+                "data": data,
+                "from": {"id": self.user_id, "first_name": f"Bench {self.user_id}"},
+                "message": {"message_id": 1, "chat": {"id": self.user_id, "type": "private"}},
+            },
+        }
+
+
+def seed(session_factory, n_orgs: int, n_chats: int, first_user_id: int) -> None:
+    from easypcm.models import OrgUserRow
+    from easypcm.repository import create_organization, upsert_user
+
+    db = session_factory()
+    try:
+        org_ids = [create_organization(db, f"Bench {i}").id for i in range(n_orgs)]
+        for i in range(n_chats):
+            uid = str(first_user_id + i)
+            upsert_user(db, uid, first_name=f"Bench {uid}")
+            role = "ORG_ADMIN" if i < n_orgs else "ORG_USER"
+            db.add(OrgUserRow(org_id=org_ids[i % n_orgs], telegram_user_id=uid, role=role, active=True))
+        db.commit()
+    finally:
+        db.close()
+
+
+async def run_chat(client, recorder: Recorder, chat: SyntheticChat,
+                   session_factory, rounds: int, parada: str) -> None:
+    from sqlalchemy import desc
+    from easypcm.db import route_to_org
+    from easypcm.instrumentation import backup_in_progress
+    from easypcm.models import ChatState, WorkOrderRow
+    from easypcm.repository import get_user_org_id
+
+    async def post(step: str, update: dict) -> None:
+        counter = [0]
+        token = _commits.set(counter)
+        try:
+            during_backup = backup_in_progress.is_set()
+            t0 = time.perf_counter()
+            r = await client.post("/telegram/webhook", json=update)
+            elapsed = time.perf_counter() - t0
+            during_backup = during_backup or backup_in_progress.is_set()
+        finally:
+            _commits.reset(token)
+        r.raise_for_status()
+        recorder.add(step, elapsed, counter[0], during_backup)
+
+    for _ in range(rounds):
+        # abrir
+        await post("open:start", chat.message("/abrir"))
+        await post("open:ASK_EQUIP", chat.message(f"Bomba {chat.user_id % 50}"))
+        await post("open:ASK_SETOR", chat.message("Utilidades"))
+        await post("open:ASK_PROBLEMA", chat.message("vazamento no selo mecânico"))
+        await post("open:ASK_PARADA", chat.message(parada))
+
+        db = session_factory()
+        try:
+            # outro chat da empresa já abriu OS parecida p/ a mesma bomba: abre nova
+            st = db.query(ChatState.step).filter(ChatState.chat_id == str(chat.user_id)).first()
+        finally:
+            db.close()
+        if st and st[0] == "CONFIRM_DUP":
+            await post("open:cb_dup_new", chat.callback("dup:new"))
+
+        db = session_factory()
+        try:
+            route_to_org(db, get_user_org_id(db, str(chat.user_id)))  # --shard
+            os_id = (
+                db.query(WorkOrderRow.id)
+                .filter(WorkOrderRow.chat_id == str(chat.user_id))
+                .order_by(desc(WorkOrderRow.id))
+                .first()[0]
+            )
+        finally:
+            db.close()
+
+        # atualizar
+        await post("update:picker", chat.message("/atualizar"))
+        await post("update:cb_os", chat.callback(f"update:{os_id}"))
+        await post("update:cb_status", chat.callback("status:AGUARDANDO_COMPRAS"))
+        await post("update:ASK_OBS", chat.message("aguardando selo"))
+
+        # fechar
+        await post("close:picker", chat.message("/fechar"))
+        await post("close:cb_os", chat.callback(f"close:{os_id}"))
+        await post("close:ASK_DATE", chat.message("HOJE"))
+        await post("close:ASK_SOLUCAO", chat.message("troca do selo mecânico"))
+        await post("close:ASK_INICIO", chat.message("08:10"))
+        await post("close:ASK_FIM", chat.message("09:40"))
+        await post("close:ASK_TECNICOS", chat.message("Marcos, João"))
+        await post("close:ASK_MATERIAIS", chat.message("Selo mecânico, Graxa"))
+        await post("close:ASK_CUSTO", chat.message("120,50"))
+
+
+async def main_async(args) -> None:
+    import httpx
+    from sqlalchemy import event
+
+    import app as app_module
+    from easypcm.db import engine, SessionLocal
+    from easypcm.outbox import outbox_worker
+
+    # o ASGITransport não dispara o lifespan: schema, hooks e log sobem aqui
+    app_module.startup()
+    seed(SessionLocal, args.orgs, args.chats, args.first_user_id)
+    event.listen(engine, "commit", _on_commit)
+
+    if args.worker:
+        outbox_worker.start()
+
+    backups_done = threading.Event()
+    backup_thread = None
+    if args.backup:
+        from easypcm.backup import backup_database
+
+        def backup_loop() -> None:
+            # backups com uma folga entre eles, até o fim do teste (para ter
+            # updates com e sem backup em andamento na comparação)
+            backup_dir = os.path.join(os.path.dirname(engine.url.database), "backups")
+            while not backups_done.wait(args.backup_gap):
+                backup_database(backup_dir, keep=1)
+
+        backup_thread = threading.Thread(target=backup_loop, name="bench-backup", daemon=True)
+        backup_thread.start()
+
+    recorder = Recorder()
+    sem = asyncio.Semaphore(args.concurrency)
+    transport = httpx.ASGITransport(app=app_module.app)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def guarded(i: int):
+            async with sem:
+                await run_chat(
+                    client, recorder,
+                    SyntheticChat(args.first_user_id + i),
+                    SessionLocal, args.rounds, args.parada,
+                )
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(guarded(i) for i in range(args.chats)))
+        elapsed = time.perf_counter() - t0
+
+    if backup_thread:
+        backups_done.set()
+        backup_thread.join()
+    if args.worker:
+        outbox_worker.stop()
+    app_module.shutdown()
+
+    recorder.report(elapsed)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark ponta a ponta do webhook do EasyPCM")
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--orgs", type=int, default=5)
+    parser.add_argument("--rounds", type=int, default=1, help="ciclos abrir/atualizar/fechar por chat")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--parada", default="NÃO", help="resposta de máquina parada (SIM dispara alertas)")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0)
+    parser.add_argument("--first-user-id", type=int, default=900_000)
+    parser.add_argument("--no-worker", dest="worker", action="store_false", help="não sobe o worker do outbox")
+    parser.add_argument("--db", default="", help="arquivo SQLite (padrão: temporário)")
+    parser.add_argument("--shard", action="store_true",
+                        help="um banco por empresa (SHARD_BY_ORG=1), ao lado do --db")
+    parser.add_argument("--backup", action="store_true",
+                        help="faz backups online durante o teste (ver easypcm/backup.py)")
+    parser.add_argument("--backup-gap", type=float, default=1.0, help="segundos entre um backup e o próximo")
+    args = parser.parse_args()
+
+    api = FakeBotApi(latency_ms=args.api_latency_ms).start()
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="easypcm-bench-"), "bench.db")
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    os.environ["TELEGRAM_API_BASE"] = api.base_url
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "BENCH")
+    os.environ.setdefault("MASTER_USER_ID", "0")
+    os.environ["OUTBOX_WORKER_ENABLED"] = "0"  # o bench controla o worker
+    os.environ["ARCHIVE_WORKER_ENABLED"] = "0"
+    os.environ["BACKUP_WORKER_ENABLED"] = "0"  # idem (--backup)
+    os.environ["PREVENTIVE_WORKER_ENABLED"] = "0"
+    if args.shard:
+        os.environ["SHARD_BY_ORG"] = "1"
+        os.environ["SHARD_DIR"] = os.path.join(os.path.dirname(os.path.abspath(db_path)), "shards")
+
+    try:
+        asyncio.run(main_async(args))
+    finally:
+        api.stop()
+
+    print(f"\nchamadas ao Bot API fake: {dict(api.calls)}")
+    print(f"banco: {db_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+# bench/replay.py
+"""
+Replay do tráfego real gravado em events.raw_update.
+
+Copia o banco (API de backup do SQLite) para um arquivo de rascunho, apaga
+da cópia os eventos do intervalo escolhido (senão o dedup por update_id
+descartaria todos) e reenvia esses updates pelo mesmo caminho do webhook,
+com o Bot API apontado para o servidor fake. O banco original não é tocado.
+
+Atenção: a cópia já contém o estado final (OS, chat_states) produzido por
+esses updates, então alguns passos podem divergir do que aconteceu em
+produção. Para regressão de desempenho isso basta; para comparar respostas,
+use uma cópia do banco feita antes do intervalo (--source).
+
+Uso:
+    python -m bench.replay --source easypcm.db --since 2026-10-01 --until 2026-10-02
+    python -m bench.replay --source easypcm.db --from-id 5000 --pacing recorded --speed 10
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.fake_bot_api import FakeBotApi
+from bench.load_test import Recorder
+
+
+def _sql_ts(text: str) -> str:
+    """ISO (com ou sem hora) -> formato gravado pelo SQLite (UTC)."""
+    dt = datetime.fromisoformat(text)
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def copy_database(source: str, target: str) -> None:
+    src = sqlite3.connect(f"file:{source}?mode=ro", uri=True)
+    dst = sqlite3.connect(target)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+
+def take_events(db_path: str, args) -> list[tuple[int, str, dict]]:
+    """Lê (id, created_at, update) do intervalo e apaga esses eventos da cópia."""
+    where, params = [], []
+    if args.since:
+        where.append("created_at >= ?")
+        params.append(_sql_ts(args.since))
+    if args.until:
+        where.append("created_at < ?")
+        params.append(_sql_ts(args.until))
+    if args.from_id:
+        where.append("id >= ?")
+        params.append(args.from_id)
+    if args.to_id:
+        where.append("id <= ?")
+        params.append(args.to_id)
+    sql = "SELECT id, created_at, raw_update FROM events"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY id"
+    if args.limit:
+        sql += f" LIMIT {int(args.limit)}"
+
+    con = sqlite3.connect(db_path)
+    try:
+        rows = con.execute(sql, params).fetchall()
+        events = []
+        for event_id, created_at, raw in rows:
+            try:
+                events.append((event_id, created_at or "", json.loads(raw)))
+            except (TypeError, ValueError):
+                continue
+        con.executemany("DELETE FROM events WHERE id = ?", [(e[0],) for e in events])
+        con.commit()
+        return events
+    finally:
+        con.close()
+
+
+def _offsets(events: list[tuple[int, str, dict]]) -> list[float]:
+    """Segundos desde o primeiro evento (para o ritmo gravado)."""
+    stamps = []
+    for _event_id, created_at, _update in events:
+        try:
+            stamps.append(datetime.fromisoformat(created_at).timestamp())
+        except ValueError:
+            stamps.append(stamps[-1] if stamps else 0.0)
+    first = stamps[0] if stamps else 0.0
+    return [t - first for t in stamps]
+
+
+def replay(events: list[tuple[int, str, dict]], pacing: str, speed: float) -> tuple[Recorder, float, int]:
+    from app import process_update, startup
+    from easypcm.instrumentation import track_update
+
+    startup()  # sem lifespan aqui: schema, hooks do banco e log
+    recorder = Recorder()
+    errors = 0
+    offsets = _offsets(events) if pacing == "recorded" else []
+
+    t0 = time.perf_counter()
+    for i, (_event_id, _created_at, update) in enumerate(events):
+        if offsets:
+            delay = offsets[i] / speed - (time.perf_counter() - t0)
+            if delay > 0:
+                time.sleep(delay)
+
+        with track_update() as m:
+            start = time.perf_counter()
+            try:
+                process_update(update)
+            except Exception:
+                errors += 1
+                m.flow = "ERROR"
+            elapsed = time.perf_counter() - start
+        recorder.add(f"{m.flow or '-'}:{m.step or '-'}", elapsed, m.commits)
+
+    return recorder, time.perf_counter() - t0, errors
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay de updates gravados em events.raw_update")
+    parser.add_argument("--source", default="easypcm.db", help="banco SQLite de origem (só leitura)")
+    parser.add_argument("--since", default="", help="início (ISO, UTC), inclusive")
+    parser.add_argument("--until", default="", help="fim (ISO, UTC), exclusivo")
+    parser.add_argument("--from-id", type=int, default=0)
+    parser.add_argument("--to-id", type=int, default=0)
+    parser.add_argument("--limit", type=int, default=0)
+    parser.add_argument("--pacing", choices=("fast", "recorded"), default="fast",
+                        help="fast = o mais rápido possível; recorded = ritmo original")
+    parser.add_argument("--speed", type=float, default=1.0, help="acelera o ritmo gravado (ex: 10)")
+    parser.add_argument("--worker", action="store_true", help="sobe o worker do outbox contra o Bot API fake")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0)
+    parser.add_argument("--keep", action="store_true", help="não apaga o banco de rascunho no fim")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.source):
+        parser.error(f"banco não encontrado: {args.source}")
+
+    scratch_dir = tempfile.mkdtemp(prefix="easypcm-replay-")
+    scratch = os.path.join(scratch_dir, "replay.db")
+    copy_database(args.source, scratch)
+    events = take_events(scratch, args)
+    if not events:
+        print("nenhum evento no intervalo")
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+        return
+
+    api = FakeBotApi(latency_ms=args.api_latency_ms).start()
+
+    # o .env vale para o resto; banco e Bot API sempre apontam para o rascunho/fake
+    from dotenv import load_dotenv
+    load_dotenv()
+    os.environ["DATABASE_URL"] = f"sqlite:///{scratch}"
+    os.environ["TELEGRAM_API_BASE"] = api.base_url
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "REPLAY")
+    os.environ.setdefault("MASTER_USER_ID", "0")
+    os.environ["OUTBOX_WORKER_ENABLED"] = "0"
+    os.environ["ARCHIVE_WORKER_ENABLED"] = "0"
+    os.environ["BACKUP_WORKER_ENABLED"] = "0"
+    os.environ["PREVENTIVE_WORKER_ENABLED"] = "0"
+
+    from easypcm.outbox import outbox_worker
+    if args.worker:
+        outbox_worker.start()
+
+    try:
+        recorder, elapsed, errors = replay(events, args.pacing, args.speed)
+    finally:
+        if args.worker:
+            outbox_worker.stop()
+        api.stop()
+
+    recorder.report(elapsed)
+    print(f"\nerros: {errors}")
+    print(f"chamadas ao Bot API fake: {dict(api.calls)}")
+    if args.keep:
+        print(f"banco de rascunho: {scratch}")
+    else:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
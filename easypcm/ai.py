@@ -1,4 +1,8 @@
-from openai import OpenAI
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from openai import OpenAI
 
 SYSTEM_PROMPT = """
 Você é um assistente de PCM especializado em manutenção industrial.
@@ -24,7 +28,25 @@ Regras:
 5) Responda SOMENTE com JSON válido, sem markdown, sem explicações.
 """.strip()
 
-def extrair_os(openai_client: OpenAI, texto: str) -> str:
+
+@lru_cache(maxsize=1)
+def get_openai_client() -> "OpenAI":
+    """
+    Cliente criado no primeiro uso: o SDK da OpenAI é pesado de importar e a IA
+    é opcional no MVP, então quem não usa não paga o custo no cold start.
+    """
+    from openai import OpenAI
+
+    from .config import OPENAI_API_KEY
+
+    if not OPENAI_API_KEY:
+        raise RuntimeError("OPENAI_API_KEY não encontrado no .env")
+    return OpenAI(api_key=OPENAI_API_KEY)
+
+
+def extrair_os(openai_client: "OpenAI | None", texto: str) -> str:
+    if openai_client is None:
+        openai_client = get_openai_client()
     user_prompt = f"""
 Texto do técnico:
 {texto}
@@ -0,0 +1,192 @@
+# easypcm/archive.py
+"""
+Arquivo de OS antigas (hot/cold).
+
+OS fechadas ou canceladas há mais de ARCHIVE_AFTER_DAYS saem de work_orders
+(com peças e técnicos) para as tabelas *_archive do mesmo banco. As tabelas
+quentes ficam do tamanho do trabalho em andamento; histórico, consulta e
+ficha continuam achando as arquivadas (repository junta as duas camadas).
+
+Cada lote é uma transação curta (cópia + DELETE) seguida de uma pausa, para
+os webhooks pegarem o lock de escrita entre um lote e outro.
+
+O mesmo job apaga do outbox as chamadas resolvidas (SENT/FAILED) há mais de
+OUTBOX_KEEP_DAYS: sem isso toda resposta ficaria guardada para sempre.
+
+Em produção o serve.py roda o job a cada ARCHIVE_INTERVAL_HOURS. Avulso:
+    python -m easypcm.archive
+    python -m easypcm.archive --days 365 --batch 200 --outbox-days 3
+"""
+import argparse
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from .config import (
+    ARCHIVE_AFTER_DAYS,
+    ARCHIVE_BATCH_PAUSE_SEC,
+    ARCHIVE_BATCH_SIZE,
+    ARCHIVE_INTERVAL_HOURS,
+    OUTBOX_KEEP_DAYS,
+)
+from .db import SHARD_BY_ORG, SessionLocal, route_to_org, tenant_org_ids
+from .log import log_event
+from .repository import ArchiveConflict, archive_closed_work_orders, purge_org_commits, purge_outbox
+
+log = logging.getLogger("easypcm.archive")
+
+
+def run_archive(
+    session_factory=SessionLocal,
+    older_than_days: int = ARCHIVE_AFTER_DAYS,
+    batch_size: int = ARCHIVE_BATCH_SIZE,
+    pause: float = ARCHIVE_BATCH_PAUSE_SEC,
+    stop: threading.Event | None = None,
+) -> int:
+    """Arquiva tudo o que venceu, lote a lote. Retorna quantas OS foram movidas."""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=older_than_days)
+    t0 = time.perf_counter()
+    moved = batches = 0
+    # no modo por empresa, banco a banco
+    for org_id in tenant_org_ids() if SHARD_BY_ORG else [None]:
+        last_id = 0
+        while not (stop and stop.is_set()):
+            db = route_to_org(session_factory(), org_id)
+            try:
+                n, next_id = archive_closed_work_orders(db, cutoff, batch_size=batch_size, after_id=last_id)
+            except ArchiveConflict as e:
+                # fica na tabela quente até alguém resolver; os lotes seguintes andam
+                log_event(log, "archive_id_conflict", logging.ERROR, org_id=org_id, os_ids=e.os_ids[:20])
+                n, next_id = 0, e.last_id
+            finally:
+                db.close()
+            if next_id == last_id:
+                break
+            last_id = next_id
+            moved += n
+            batches += 1
+            if n and pause:
+                time.sleep(pause)
+
+    log_event(
+        log, "archive_done",
+        moved=moved, batches=batches, older_than_days=older_than_days,
+        ms=round((time.perf_counter() - t0) * 1000, 1),
+    )
+    return moved
+
+
+def run_outbox_purge(
+    session_factory=SessionLocal,
+    keep_days: int = OUTBOX_KEEP_DAYS,
+    batch_size: int = ARCHIVE_BATCH_SIZE,
+    pause: float = ARCHIVE_BATCH_PAUSE_SEC,
+    stop: threading.Event | None = None,
+) -> int:
+    """
+    Apaga do outbox o que foi resolvido há mais de keep_days, lote a lote.
+    No modo por empresa também os org_commits (registros para refazer o
+    catálogo, db.WriteSession) de cada banco de empresa. Retorna quantas
+    chamadas do outbox apagou.
+    """
+    if keep_days <= 0:
+        return 0
+    cutoff = datetime.now(timezone.utc) - timedelta(days=keep_days)
+    t0 = time.perf_counter()
+    # o outbox fica no banco principal (catálogo), também no modo por empresa
+    purged = _purge_in_batches(session_factory, None, purge_outbox, cutoff, batch_size, pause, stop)
+    commits = 0
+    for org_id in tenant_org_ids() if SHARD_BY_ORG else []:
+        commits += _purge_in_batches(session_factory, org_id, purge_org_commits, cutoff, batch_size, pause, stop)
+
+    log_event(
+        log, "outbox_purge_done",
+        purged=purged, org_commits=commits, keep_days=keep_days,
+        ms=round((time.perf_counter() - t0) * 1000, 1),
+    )
+    return purged
+
+
+def _purge_in_batches(session_factory, org_id, purge, cutoff, batch_size, pause, stop) -> int:
+    purged = 0
+    while not (stop and stop.is_set()):
+        db = route_to_org(session_factory(), org_id)
+        try:
+            n = purge(db, cutoff, batch_size=batch_size)
+        finally:
+            db.close()
+        purged += n
+        if n < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+    return purged
+
+
+class ArchiveWorker:
+    """Roda run_archive e run_outbox_purge numa thread, na subida e depois a cada interval_hours."""
+
+    def __init__(self, session_factory=SessionLocal, interval_hours: float = ARCHIVE_INTERVAL_HOURS):
+        self._session_factory = session_factory
+        self.interval_hours = interval_hours
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        if self.interval_hours <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="archive-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        # interrompe entre lotes; o lote em andamento termina (ou desfaz) sozinho
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def is_alive(self) -> bool:
+        return bool(self._thread and self._thread.is_alive())
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            for job in (run_archive, run_outbox_purge):
+                try:
+                    job(self._session_factory, stop=self._stop)
+                except Exception:
+                    log_event(log, "archive_worker_error", logging.ERROR, job=job.__name__, exc_info=True)
+            self._stop.wait(self.interval_hours * 3600)
+
+
+archive_worker = ArchiveWorker()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Move OS fechadas antigas para as tabelas de arquivo")
+    parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS,
+                        help="arquiva OS fechadas/canceladas há mais de N dias")
+    parser.add_argument("--batch", type=int, default=ARCHIVE_BATCH_SIZE, help="OS por transação")
+    parser.add_argument("--pause", type=float, default=ARCHIVE_BATCH_PAUSE_SEC,
+                        help="segundos entre lotes (libera o lock de escrita)")
+    parser.add_argument("--outbox-days", type=int, default=OUTBOX_KEEP_DAYS,
+                        help="apaga do outbox o que foi enviado/falhou há mais de N dias (0 = não apaga)")
+    args = parser.parse_args()
+
+    from .db import init_db
+    from .log import setup_logging, stop_logging
+
+    setup_logging()
+    try:
+        init_db()  # garante as tabelas *_archive
+        moved = run_archive(older_than_days=args.days, batch_size=args.batch, pause=args.pause)
+        print(f"{moved} OS arquivadas")
+        purged = run_outbox_purge(keep_days=args.outbox_days, batch_size=args.batch, pause=args.pause)
+        print(f"{purged} chamadas do outbox apagadas")
+    finally:
+        stop_logging()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+# easypcm/backup.py
+"""
+Backup online do SQLite, sem parar o bot.
+
+Copiar o arquivo com o serviço rodando pode pegar uma página no meio de um
+commit (cópia rasgada, ainda mais com o -wal ao lado). Aqui a cópia usa a
+API de backup do SQLite em passos de BACKUP_PAGES_PER_STEP páginas, com uma
+pausa entre eles: cada passo segura só um lock de leitura curto e os
+webhooks continuam gravando.
+
+Se o banco muda no meio (outro processo commitou), o SQLite recomeça a cópia.
+Sob escrita contínua isso pode não terminar nunca; depois de MAX_RESTARTS
+recomeços a cópia é feita de uma vez só (em WAL uma leitura longa não
+bloqueia escritores, só adia o checkpoint).
+
+A cópia é conferida (PRAGMA quick_check), compactada em
+BACKUP_DIR/<banco>-<AAAAMMDDTHHMMSSZ>.db.gz e só as últimas BACKUP_KEEP
+ficam. Entre os passos medimos a espera pelo lock de escrita (o que um
+webhook sentiria): vai para o log (backup_done) e para o /metrics. Durante
+a cópia fica um marcador BACKUP_DIR/.running-<pid>-<ns>: os workers do
+serve.py o veem e separam a latência dos updates feitos durante o backup.
+
+    python -m easypcm.backup run
+    python -m easypcm.backup list
+    python -m easypcm.backup restore backups/easypcm-20261019T030000Z.db.gz --force
+
+No modo por empresa (SHARD_BY_ORG) cada banco de empresa tem os próprios
+snapshots (org_<id>-...db.gz); restaure com --target shards/org_<id>.db.
+
+O restore sobrescreve o banco: rode com o serviço parado.
+"""
+import argparse
+import glob
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+from .config import (
+    BACKUP_DIR,
+    BACKUP_INTERVAL_HOURS,
+    BACKUP_KEEP,
+    BACKUP_PAGES_PER_STEP,
+    BACKUP_STEP_PAUSE_SEC,
+)
+from .db import SHARD_BY_ORG, SessionLocal, engine, shard_path, tenant_org_ids
+from .instrumentation import BACKUP_DURATION, BACKUP_TOTAL, BACKUP_WRITE_WAIT, backup_marker
+from .log import log_event
+from .repository import probe_db_write
+
+log = logging.getLogger("easypcm.backup")
+
+# recomeços (banco alterado durante a cópia) antes de copiar de uma vez
+MAX_RESTARTS = 3
+# mede a espera de escrita a cada N passos
+PROBE_EVERY_STEPS = 10
+
+_CHUNK = 1024 * 1024
+# compactação rápida: o nível 6 fica ~3x mais lento (CPU disputada com os
+# webhooks) para um arquivo só ~15% menor
+GZIP_LEVEL = 1
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def database_path() -> str:
+    """Arquivo do banco configurado (DATABASE_URL); só SQLite em arquivo."""
+    database = engine.url.database
+    if engine.dialect.name != "sqlite" or not database or database == ":memory:":
+        raise RuntimeError("Backup online só para SQLite em arquivo (DATABASE_URL).")
+    return os.path.abspath(database)
+
+
+def list_snapshots(dest_dir: str = BACKUP_DIR, db_path: str | None = None) -> list[str]:
+    """Snapshots do banco em dest_dir, mais recentes primeiro."""
+    stem = os.path.splitext(os.path.basename(db_path or database_path()))[0]
+    # o nome leva a data em UTC (AAAAMMDDTHHMMSSZ): ordem alfabética = cronológica
+    return sorted(glob.glob(os.path.join(dest_dir, f"{stem}-*.db.gz")), reverse=True)
+
+
+def _quick_check(path: str) -> None:
+    con = sqlite3.connect(path)
+    try:
+        result = con.execute("PRAGMA quick_check").fetchone()[0]
+    finally:
+        con.close()
+    if result != "ok":
+        raise RuntimeError(f"Cópia inconsistente ({path}): {result}")
+
+
+def _copy_online(src_path: str, dst_path: str, pages: int, pause: float,
+                 session_factory, waits: list[float]) -> dict:
+    stats = {"steps": 0, "restarts": 0, "pages": 0, "one_shot": False}
+    remaining_before: list[int] = []
+
+    def progress(_status, remaining, total):
+        stats["steps"] += 1
+        stats["pages"] = total
+        if remaining_before and remaining > remaining_before[0]:
+            stats["restarts"] += 1
+            if stats["restarts"] > MAX_RESTARTS:
+                raise _TooManyRestarts()
+        remaining_before[:] = [remaining]
+        if stats["steps"] % PROBE_EVERY_STEPS == 0:
+            db = session_factory()
+            try:
+                waits.append(probe_db_write(db) / 1000.0)
+            finally:
+                db.close()
+        if remaining and pause:
+            time.sleep(pause)
+
+    src = sqlite3.connect(f"file:{src_path}?mode=ro", uri=True)
+    dst = sqlite3.connect(dst_path)
+    try:
+        try:
+            src.backup(dst, pages=pages, progress=progress)
+        except _TooManyRestarts:
+            stats["one_shot"] = True
+            src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+    return stats
+
+
+def _gzip_file(src_path: str, dst_path: str, pause: float) -> None:
+    with open(src_path, "rb") as f_in, gzip.open(dst_path, "wb", compresslevel=GZIP_LEVEL) as f_out:
+        # também em passos: compactar é o trecho que mais usa CPU
+        while chunk := f_in.read(_CHUNK):
+            f_out.write(chunk)
+            if pause:
+                time.sleep(pause)
+
+
+def _publish(part_path: str, final_path: str) -> bool:
+    """Dá o nome final ao snapshot sem sobrescrever (link atômico). False se o nome já existe."""
+    try:
+        os.link(part_path, final_path)
+    except FileExistsError:
+        return False
+    return True
+
+
+def _rotate(snapshots: list[str], keep: int) -> list[str]:
+    removed = snapshots[max(keep, 1):]
+    for path in removed:
+        os.remove(path)
+    return removed
+
+
+def backup_database(
+    dest_dir: str = BACKUP_DIR,
+    keep: int = BACKUP_KEEP,
+    pages: int = BACKUP_PAGES_PER_STEP,
+    pause: float = BACKUP_STEP_PAUSE_SEC,
+    session_factory=SessionLocal,
+    src_path: str | None = None,
+) -> str:
+    """Faz um snapshot compactado do banco (padrão: o de DATABASE_URL) e aplica a rotação. Retorna o caminho."""
+    src_path = src_path or database_path()
+    os.makedirs(dest_dir, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    stem = os.path.splitext(os.path.basename(src_path))[0]
+    final_path = os.path.join(dest_dir, f"{stem}-{stamp}.db.gz")
+    if os.path.exists(final_path):
+        # outra execução (ex: o CLI com o worker rodando) já fez o snapshot deste segundo
+        log_event(log, "backup_skipped", path=final_path)
+        return final_path
+
+    # temporários únicos por execução: duas no mesmo segundo não dividem arquivo
+    fd, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix=f".{stem}-{stamp}-", suffix=".db")
+    os.close(fd)
+    part_path = tmp_path + ".gz.part"
+
+    t0 = time.perf_counter()
+    waits: list[float] = []
+    try:
+        # marcador visto pelos workers do serve.py (latência durante o backup)
+        with backup_marker():
+            stats = _copy_online(src_path, tmp_path, pages, pause, session_factory, waits)
+            copy_sec = time.perf_counter() - t0
+            _quick_check(tmp_path)
+            _gzip_file(tmp_path, part_path, pause)
+            published = _publish(part_path, final_path)
+    except Exception:
+        BACKUP_TOTAL.inc(("error",))
+        log_event(log, "backup_failed", logging.ERROR, exc_info=True, db=src_path)
+        raise
+    finally:
+        for leftover in (tmp_path, tmp_path + "-wal", tmp_path + "-shm", part_path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    if not published:
+        # a outra execução do mesmo segundo terminou antes; fica o snapshot dela
+        log_event(log, "backup_skipped", path=final_path)
+        return final_path
+
+    elapsed = time.perf_counter() - t0
+    BACKUP_TOTAL.inc(("ok",))
+    BACKUP_DURATION.observe((), elapsed)
+    for w in waits:
+        BACKUP_WRITE_WAIT.observe((), w)
+
+    removed = _rotate(list_snapshots(dest_dir, src_path), keep)
+    log_event(
+        log, "backup_done",
+        path=final_path, bytes=os.path.getsize(final_path), pages=stats["pages"],
+        steps=stats["steps"], restarts=stats["restarts"], one_shot=stats["one_shot"],
+        copy_ms=round(copy_sec * 1000, 1), total_ms=round(elapsed * 1000, 1),
+        write_wait_p50_ms=round(statistics.median(waits) * 1000, 2) if waits else None,
+        write_wait_max_ms=round(max(waits) * 1000, 2) if waits else None,
+        rotated=len(removed),
+    )
+    return final_path
+
+
+def backup_all(dest_dir: str = BACKUP_DIR, **kwargs) -> list[str]:
+    """Catálogo e, no modo por empresa, o banco de cada empresa (um snapshot cada)."""
+    paths = [database_path()]
+    if SHARD_BY_ORG:
+        paths += [p for p in map(shard_path, tenant_org_ids()) if os.path.exists(p)]
+    return [backup_database(dest_dir, src_path=p, **kwargs) for p in paths]
+
+
+def restore_database(snapshot: str, target: str | None = None, force: bool = False) -> str:
+    """
+    Descompacta o snapshot no lugar do banco (ou de target, ex: o arquivo de
+    uma empresa em SHARD_DIR). O banco atual (se houver) fica ao lado como
+    <banco>.pre-restore. Rode com o serviço parado.
+    """
+    target = os.path.abspath(target or database_path())
+    if os.path.exists(target) and not force:
+        raise RuntimeError(f"{target} já existe; use --force (com o serviço parado).")
+
+    restoring = target + ".restore"
+    opener = gzip.open if snapshot.endswith(".gz") else open
+    with opener(snapshot, "rb") as f_in, open(restoring, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out, _CHUNK)
+    try:
+        _quick_check(restoring)
+    except Exception:
+        os.remove(restoring)
+        raise
+
+    if os.path.exists(target):
+        os.replace(target, target + ".pre-restore")
+    # -wal/-shm do banco antigo seriam aplicados por cima do restaurado
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(target + suffix):
+            os.remove(target + suffix)
+    os.replace(restoring, target)
+    log_event(log, "backup_restored", snapshot=snapshot, db=target)
+    return target
+
+
+class BackupWorker:
+    """
+    Backup a cada interval_hours numa thread. O prazo conta a partir do
+    snapshot mais recente em disco: reiniciar o serviço não gera outro backup.
+    """
+
+    def __init__(self, interval_hours: float = BACKUP_INTERVAL_HOURS, dest_dir: str = BACKUP_DIR):
+        self.interval_hours = interval_hours
+        self.dest_dir = dest_dir
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        if self.interval_hours <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        if engine.dialect.name != "sqlite":
+            return  # outros bancos têm o próprio backup (ex: pg_dump)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="backup-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        # não interrompe uma cópia em andamento; só não agenda a próxima
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def is_alive(self) -> bool:
+        return bool(self._thread and self._thread.is_alive())
+
+    def _seconds_until_due(self) -> float:
+        snapshots = list_snapshots(self.dest_dir)
+        if not snapshots:
+            return 0.0
+        age = time.time() - os.path.getmtime(snapshots[0])
+        return max(0.0, self.interval_hours * 3600 - age)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                wait = self._seconds_until_due()
+                if wait <= 0:
+                    backup_all(self.dest_dir)
+                    wait = self.interval_hours * 3600
+            except Exception:
+                log_event(log, "backup_worker_error", logging.ERROR, exc_info=True)
+                wait = min(self.interval_hours * 3600, 600)  # tenta de novo em 10 min
+            self._stop.wait(wait)
+
+
+backup_worker = BackupWorker()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Backup online do banco SQLite do EasyPCM")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run = sub.add_parser("run", help="faz um snapshot agora")
+    run.add_argument("--dir", default=BACKUP_DIR)
+    run.add_argument("--keep", type=int, default=BACKUP_KEEP)
+    run.add_argument("--pages", type=int, default=BACKUP_PAGES_PER_STEP, help="páginas por passo (-1 = de uma vez)")
+    run.add_argument("--pause", type=float, default=BACKUP_STEP_PAUSE_SEC, help="segundos entre passos")
+
+    lst = sub.add_parser("list", help="lista os snapshots")
+    lst.add_argument("--dir", default=BACKUP_DIR)
+
+    restore = sub.add_parser("restore", help="restaura um snapshot (serviço parado)")
+    restore.add_argument("snapshot")
+    restore.add_argument("--target", default=None, help="arquivo de destino (padrão: DATABASE_URL)")
+    restore.add_argument("--force", action="store_true", help="sobrescreve o banco existente")
+    args = parser.parse_args()
+
+    from .log import setup_logging, stop_logging
+
+    setup_logging()
+    try:
+        if args.command == "run":
+            for path in backup_all(args.dir, keep=args.keep, pages=args.pages, pause=args.pause):
+                print(path)
+        elif args.command == "list":
+            for path in list_snapshots(args.dir):
+                print(f"{path}  {os.path.getsize(path) / 1e6:.1f} MB")
+        else:
+            print(f"restaurado em {restore_database(args.snapshot, args.target, force=args.force)}")
+    finally:
+        stop_logging()
+
+
+if __name__ == "__main__":
+    main()
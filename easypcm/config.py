@@ -10,12 +10,80 @@ MASTER_USER_ID = os.getenv("MASTER_USER_ID")  # ex: "1350252394"
 
 INVITE_EXPIRES_DAYS = int(os.getenv("INVITE_EXPIRES_DAYS", "7"))
 
-if not TELEGRAM_BOT_TOKEN:
-    raise RuntimeError("TELEGRAM_BOT_TOKEN não encontrado no .env")
+# worker que envia o outbox; desligue (0) para rodar só a API, ex: benchmarks
+OUTBOX_WORKER_ENABLED = os.getenv("OUTBOX_WORKER_ENABLED", "1") == "1"
 
-# OPENAI_API_KEY não deve travar o bot no MVP
-# if not OPENAI_API_KEY:
-#     raise RuntimeError("OPENAI_API_KEY não encontrado no .env")
+# arquivo de OS antigas + limpeza do outbox (easypcm/archive.py); como o
+# backup, o serve.py desliga nos workers e roda no processo pai
+ARCHIVE_WORKER_ENABLED = os.getenv("ARCHIVE_WORKER_ENABLED", "1") == "1"
 
-if not MASTER_USER_ID:
-    raise RuntimeError("MASTER_USER_ID não encontrado no .env (ex: 1350252394)")
\ No newline at end of file
+# backup automático do SQLite (easypcm/backup.py); o serve.py desliga nos
+# workers e roda no processo pai
+BACKUP_WORKER_ENABLED = os.getenv("BACKUP_WORKER_ENABLED", "1") == "1"
+
+# agendador de preventivas (easypcm/preventive.py); como o backup, o
+# serve.py desliga nos workers e roda no processo pai
+PREVENTIVE_WORKER_ENABLED = os.getenv("PREVENTIVE_WORKER_ENABLED", "1") == "1"
+
+# métricas com vários processos (serve.py): cada processo grava os próprios
+# contadores/histogramas em METRICS_DIR a cada METRICS_EXPORT_SEC e o /metrics
+# de qualquer um deles soma todos. Vazio = só o processo atual
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+METRICS_EXPORT_SEC = float(os.getenv("METRICS_EXPORT_SEC", "1"))
+
+# responde no próprio corpo do webhook quando o update gera só uma chamada
+INLINE_REPLY_ENABLED = os.getenv("INLINE_REPLY_ENABLED", "1") == "1"
+
+# limites do /ready (acima disso o serviço se declara saturado)
+READY_MAX_DB_WRITE_MS = float(os.getenv("READY_MAX_DB_WRITE_MS", "500"))
+READY_MAX_OUTBOX_BACKLOG = int(os.getenv("READY_MAX_OUTBOX_BACKLOG", "1000"))
+READY_MAX_OUTBOX_AGE_SEC = float(os.getenv("READY_MAX_OUTBOX_AGE_SEC", "60"))
+
+# abertura de OS: similaridade (trigramas, 0 a 1) entre o problema informado e o
+# de uma OS aberta do mesmo equipamento a partir da qual oferecemos anexar
+DUP_MIN_SIMILARITY = float(os.getenv("DUP_MIN_SIMILARITY", "0.2"))
+
+# arquivo: OS fechadas/canceladas há mais de N dias saem das tabelas quentes
+# (easypcm/archive.py). Lotes pequenos com pausa entre eles para não segurar
+# o lock de escrita do SQLite; intervalo 0 = o serve.py não roda o job
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+ARCHIVE_BATCH_PAUSE_SEC = float(os.getenv("ARCHIVE_BATCH_PAUSE_SEC", "0.2"))
+ARCHIVE_INTERVAL_HOURS = float(os.getenv("ARCHIVE_INTERVAL_HOURS", "24"))
+
+# outbox: chamadas já enviadas (ou que falharam de vez) há mais de N dias são
+# apagadas pelo mesmo job do arquivo; 0 = guarda para sempre
+OUTBOX_KEEP_DAYS = int(os.getenv("OUTBOX_KEEP_DAYS", "7"))
+
+# backup online: cópia em passos de N páginas com pausa entre eles (o lock de
+# leitura de cada passo é curto), compactada (.db.gz), guardando as últimas
+# BACKUP_KEEP. Intervalo 0 = sem backup automático
+BACKUP_DIR = os.getenv("BACKUP_DIR", "./backups")
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "24"))
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "256"))
+BACKUP_STEP_PAUSE_SEC = float(os.getenv("BACKUP_STEP_PAUSE_SEC", "0.005"))
+
+# preventivas: o agendador acorda no próximo vencimento ou a cada TICK (para
+# ver planos novos/removidos), gera as OS vencidas em lotes com pausa entre
+# eles e marca os vencimentos para HOUR_UTC (9 = 06:00 em Brasília)
+PREVENTIVE_TICK_SEC = float(os.getenv("PREVENTIVE_TICK_SEC", "60"))
+PREVENTIVE_BATCH_SIZE = int(os.getenv("PREVENTIVE_BATCH_SIZE", "200"))
+PREVENTIVE_BATCH_PAUSE_SEC = float(os.getenv("PREVENTIVE_BATCH_PAUSE_SEC", "0.2"))
+PREVENTIVE_HOUR_UTC = int(os.getenv("PREVENTIVE_HOUR_UTC", "9"))
+
+
+def validate_config() -> None:
+    """
+    Confere as variáveis obrigatórias. Roda na inicialização do app (lifespan),
+    não no import: importar o pacote (benches, scripts) não exige o .env completo.
+    """
+    if not TELEGRAM_BOT_TOKEN:
+        raise RuntimeError("TELEGRAM_BOT_TOKEN não encontrado no .env")
+
+    # OPENAI_API_KEY não deve travar o bot no MVP
+    # if not OPENAI_API_KEY:
+    #     raise RuntimeError("OPENAI_API_KEY não encontrado no .env")
+
+    if not MASTER_USER_ID:
+        raise RuntimeError("MASTER_USER_ID não encontrado no .env (ex: 1350252394)")
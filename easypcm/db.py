@@ -1,15 +1,448 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, DeclarativeBase
+import os
+import threading
+from contextlib import contextmanager
 
-DATABASE_URL = "sqlite:///./easypcm.db"
+from sqlalchemy import create_engine, event, inspect, literal
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, sessionmaker, DeclarativeBase
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.sql.elements import TextClause
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./easypcm.db")
+
+# com vários processos (serve.py) o SQLite vira o ponto de contenção:
+# quanto tempo esperar pelo lock de escrita antes de "database is locked"
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+# transações já começam com o lock de escrita (BEGIN IMMEDIATE): evita o
+# SQLITE_BUSY imediato de quem leu e depois tenta escrever enquanto outro
+# processo gravou. Ligado pelo serve.py quando há mais de um worker.
+SQLITE_BEGIN_IMMEDIATE = os.getenv("SQLITE_BEGIN_IMMEDIATE", "0") == "1"
+
+# o schema já foi criado/atualizado por quem subiu os processos (serve.py)
+SCHEMA_READY = os.getenv("EASYPCM_SCHEMA_READY", "0") == "1"
+
+# modo por empresa (opcional, só SQLite): as tabelas da operação
+# (models.TENANT_TABLES: OS, peças, técnicos, histórico, arquivo) ficam num
+# arquivo por empresa, SHARD_DIR/org_<id>.db. O banco de DATABASE_URL vira o
+# catálogo: empresas, usuários, vínculos, convites, estado das conversas e
+# outbox. Uma empresa gravando muito não segura o lock de escrita das outras.
+# Ver route_to_org.
+SHARD_BY_ORG = os.getenv("SHARD_BY_ORG", "0") == "1"
+SHARD_DIR = os.getenv("SHARD_DIR", "./shards")
+
+# leituras pesadas (consulta, histórico, relatórios, /metrics) vão por um
+# engine só de leitura, com pool próprio: não ocupam a conexão nem disputam o
+# lock de quem grava (set_state, close_work_order). Vazio = o próprio banco
+# de DATABASE_URL (SQLite: aberto com mode=ro; em WAL o leitor vê o último
+# commit e não bloqueia escritores). Ou a URL de uma réplica (ex: Postgres).
+READ_DATABASE_URL = os.getenv("READ_DATABASE_URL", "")
 
 engine = create_engine(
     DATABASE_URL,
-    connect_args={"check_same_thread": False},  # necessário para SQLite
+    # necessário para SQLite
+    connect_args={"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {},
+)
+
+
+
+class WriteSession(Session):
+    """
+    Sessão de escrita (SessionLocal). No modo por empresa um commit pode
+    gravar em dois bancos, sem two-phase commit: OS no da empresa; estado do
+    chat e outbox no catálogo. O SQLAlchemy commita as conexões numa ordem
+    qualquer, então aqui o banco da empresa vai primeiro e leva junto um
+    registro (models.OrgCommitRow) do que o catálogo vai gravar. Se o commit
+    do catálogo falhar ou o processo cair entre os dois, o próximo update do
+    chat reaplica o registro (repository.recover_org_commit): a resposta não
+    se perde e o usuário não reenvia a resposta que criaria outra OS. Nunca
+    fica o contrário (estado/resposta dizendo que a OS existe sem ela).
+    """
+
+    def commit(self) -> None:
+        org = self.info.get("org_conn")
+        if org is not None:
+            self._commit_org_first(*org)
+        super().commit()
+
+    def _commit_org_first(self, conn, changes_at_begin: int) -> None:
+        from .repository import record_org_commit
+
+        self.flush()
+        dbapi_conn = conn.connection.dbapi_connection
+        if dbapi_conn.total_changes == changes_at_begin:
+            return  # só leu do banco da empresa: nada a ordenar
+        record_org_commit(self, conn, self.info.get("tx_outbox", []))
+        # o commit do SQLAlchemy nesta conexão vira um COMMIT sem transação (no-op)
+        dbapi_conn.commit()
+
+
+@event.listens_for(WriteSession, "after_begin")
+def _track_org_connection(session, _transaction, connection) -> None:
+    if connection.engine in _tenant_engines.values():
+        session.info["org_conn"] = (connection, connection.connection.dbapi_connection.total_changes)
+
+
+@event.listens_for(WriteSession, "before_flush")
+def _collect_outbox(session, _flush_context, _instances) -> None:
+    # chamadas gravadas nesta transação (o registro do WriteSession refaz todas)
+    if not SHARD_BY_ORG:
+        return
+    from .models import OutboxMessageRow
+
+    session.info.setdefault("tx_outbox", []).extend(
+        [obj.chat_id, obj.method, obj.payload, obj.priority]
+        for obj in session.new if isinstance(obj, OutboxMessageRow)
+    )
+
+
+@event.listens_for(WriteSession, "after_transaction_end")
+def _forget_org_connection(session, transaction) -> None:
+    if transaction.parent is None:
+        session.info.pop("org_conn", None)
+        session.info.pop("tx_outbox", None)
+
+
+SessionLocal = sessionmaker(bind=engine, class_=WriteSession, autocommit=False, autoflush=False)
+
+
+def _sqlite_ro_url(path: str) -> str:
+    return f"sqlite:///file:{os.path.abspath(path)}?mode=ro&uri=true"
+
+
+def _read_url() -> str:
+    if READ_DATABASE_URL:
+        return READ_DATABASE_URL
+    if engine.dialect.name == "sqlite" and engine.url.database not in (None, "", ":memory:"):
+        return _sqlite_ro_url(engine.url.database)
+    return DATABASE_URL  # sem réplica: mesmo banco, pool separado
+
+
+_READ_URL = _read_url()
+read_engine = create_engine(
+    _READ_URL,
+    connect_args={"check_same_thread": False} if _READ_URL.startswith("sqlite") else {},
 )
 
-SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+# sessão de leitura: use read_session(org_id); só SELECT (o SQLite mode=ro recusa escrita)
+ReadSessionLocal = sessionmaker(bind=read_engine, autocommit=False, autoflush=False, info={"read_only": True})
+
+
+def _sqlite_on_connect(dbapi_conn, _record):
+    if SQLITE_BEGIN_IMMEDIATE:
+        # o BEGIN passa a ser nosso (evento "begin" abaixo)
+        dbapi_conn.isolation_level = None
+    cur = dbapi_conn.cursor()
+    cur.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+    # WAL: leitores não bloqueiam o escritor (e vice-versa) entre processos
+    cur.execute("PRAGMA journal_mode = WAL")
+    cur.execute("PRAGMA synchronous = NORMAL")
+    cur.close()
+
+
+def _sqlite_begin(conn):
+    conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+def _sqlite_read_on_connect(dbapi_conn, _record):
+    # mode=ro: nada de journal_mode (o WAL já vem gravado no arquivo) nem BEGIN IMMEDIATE
+    cur = dbapi_conn.cursor()
+    cur.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+    cur.close()
+
+
+def _configure_sqlite(eng) -> None:
+    event.listen(eng, "connect", _sqlite_on_connect)
+    if SQLITE_BEGIN_IMMEDIATE:
+        event.listen(eng, "begin", _sqlite_begin)
+
+
+if engine.dialect.name == "sqlite":
+    _configure_sqlite(engine)
+if read_engine.dialect.name == "sqlite":
+    event.listen(read_engine, "connect", _sqlite_read_on_connect)
+
+
+# bancos das empresas (modo SHARD_BY_ORG), abertos sob demanda
+_tenant_engines: dict = {}
+_tenant_read_engines: dict = {}
+_tenant_lock = threading.Lock()
+# funções aplicadas a todo engine, inclusive os das empresas criados depois
+# (ex: instrumentation.install_db_hooks)
+_engine_hooks: list = []
+
+
+def for_each_engine(fn) -> None:
+    """Aplica fn(engine) ao engine principal e a todos os das empresas, atuais e futuros."""
+    _engine_hooks.append(fn)
+    fn(engine)
+    fn(read_engine)
+    for eng in [*_tenant_engines.values(), *_tenant_read_engines.values()]:
+        fn(eng)
+
+
+def _dispose_after_fork() -> None:
+    # conexões herdadas do pai não podem ser usadas no filho; só as esquece
+    engine.dispose(close=False)
+    read_engine.dispose(close=False)
+    for eng in [*_tenant_engines.values(), *_tenant_read_engines.values()]:
+        eng.dispose(close=False)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_dispose_after_fork)
 
 
 class Base(DeclarativeBase):
     pass
+
+
+def _ddl_default(column, dialect) -> str | None:
+    """DEFAULT constante da coluna para o ALTER TABLE (None se não houver)."""
+    if column.server_default is not None:
+        arg = getattr(column.server_default, "arg", None)
+        if isinstance(arg, str):
+            return "'" + arg.replace("'", "''") + "'"
+        if isinstance(arg, TextClause):
+            return arg.text
+        return None  # ex: func.now(): o SQLite não aceita em ADD COLUMN
+    if column.default is not None and column.default.is_scalar:
+        return str(literal(column.default.arg).compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+    return None
+
+
+def _wants_autoincrement(table, dialect) -> bool:
+    return dialect.name == "sqlite" and bool(table.dialect_options["sqlite"].get("autoincrement"))
+
+
+def _rebuild_with_autoincrement(conn, table) -> bool:
+    """
+    Tabela criada antes do sqlite_autoincrement no modelo: o SQLite não tem
+    ALTER para isso, então recria a tabela (cópia + DROP + RENAME) e os índices.
+    Só as colunas do modelo são copiadas. Retorna se recriou.
+    """
+    sql = conn.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table.name,)
+    ).scalar()
+    if not sql or "AUTOINCREMENT" in sql.upper():
+        return False
+
+    tmp = f"{table.name}__rebuild"
+    ddl = str(CreateTable(table).compile(dialect=conn.dialect))
+    conn.exec_driver_sql(ddl.replace(f"CREATE TABLE {table.name} (", f"CREATE TABLE {tmp} (", 1))
+    cols = ", ".join(c.name for c in table.columns)
+    conn.exec_driver_sql(f"INSERT INTO {tmp} ({cols}) SELECT {cols} FROM {table.name}")
+    conn.exec_driver_sql(f"DROP TABLE {table.name}")
+    conn.exec_driver_sql(f"ALTER TABLE {tmp} RENAME TO {table.name}")
+    for index in table.indexes:
+        index.create(conn)
+    return True
+
+
+def _seed_autoincrement(conn, table) -> None:
+    """A sequência da tabela quente começa depois do maior id dela e do arquivo dela."""
+    names = [table.name]
+    archive = table.info.get("archive")
+    if archive and inspect(conn).has_table(archive):
+        names.append(archive)
+    top = max(conn.exec_driver_sql(f"SELECT coalesce(max(id), 0) FROM {name}").scalar() for name in names)
+    if not top:
+        return
+    updated = conn.exec_driver_sql(
+        "UPDATE sqlite_sequence SET seq = max(seq, ?) WHERE name = ?", (top, table.name)
+    ).rowcount
+    if not updated:
+        conn.exec_driver_sql("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table.name, top))
+
+
+def sync_schema(engine, metadata) -> list[str]:
+    """
+    create_all só cria tabelas que não existem. Para bancos já criados,
+    adiciona as colunas e índices novos do modelo (ALTER TABLE ADD COLUMN /
+    CREATE INDEX) e, no SQLite, recria com AUTOINCREMENT as tabelas que o
+    modelo pede assim. Não remove nada do modelo. Retorna o que foi adicionado.
+    """
+    added: list[str] = []
+    with engine.begin() as conn:
+        insp = inspect(conn)
+        for table in metadata.sorted_tables:
+            if not insp.has_table(table.name):
+                continue
+
+            existing = {c["name"] for c in insp.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=engine.dialect)}"
+                default = _ddl_default(column, engine.dialect)
+                if default is not None:
+                    ddl += f" DEFAULT {default}"
+                    if not column.nullable:
+                        ddl += " NOT NULL"
+                conn.exec_driver_sql(ddl)
+                added.append(f"{table.name}.{column.name}")
+
+            if _wants_autoincrement(table, engine.dialect):
+                if _rebuild_with_autoincrement(conn, table):
+                    added.append(f"{table.name}:autoincrement")
+                _seed_autoincrement(conn, table)
+                insp = inspect(conn)  # a tabela (e os índices) pode ter sido recriada
+
+            indexes = {ix["name"] for ix in insp.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(conn)
+                    added.append(index.name)
+    return added
+
+
+# ============================================================
+# MODO POR EMPRESA (SHARD_BY_ORG)
+# ============================================================
+
+def shard_path(org_id: int) -> str:
+    return os.path.abspath(os.path.join(SHARD_DIR, f"org_{int(org_id)}.db"))
+
+
+def _create_tenant_engine(org_id: int):
+    if engine.dialect.name != "sqlite":
+        # as tabelas da empresa têm FK para organizations, que só existe no
+        # catálogo: num schema por empresa (Postgres) o DDL não fecha
+        raise RuntimeError("SHARD_BY_ORG só é suportado com SQLite.")
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    eng = create_engine(f"sqlite:///{shard_path(org_id)}", connect_args={"check_same_thread": False})
+    _configure_sqlite(eng)
+    for fn in _engine_hooks:
+        fn(eng)
+    return eng
+
+
+def _init_tenant_schema(eng, sync: bool) -> list[str]:
+    from .models import Base, TENANT_TABLES
+    from .repository import backfill_equipamento_norm
+
+    try:
+        Base.metadata.create_all(bind=eng, tables=list(TENANT_TABLES))
+    except OperationalError:
+        # outro processo criou o banco da empresa ao mesmo tempo; o create_all
+        # só cria o que falta, então a segunda passada completa
+        Base.metadata.create_all(bind=eng, tables=list(TENANT_TABLES))
+    if not sync:
+        return []
+
+    added = sync_schema(eng, Base.metadata)
+    db = Session(bind=eng)
+    try:
+        backfill_equipamento_norm(db)
+    finally:
+        db.close()
+    return added
+
+
+def _open_tenant(org_id: int, sync: bool) -> tuple:
+    with _tenant_lock:
+        eng = _tenant_engines.get(org_id)
+        if eng is not None:
+            return eng, []
+        eng = _create_tenant_engine(org_id)
+        added = _init_tenant_schema(eng, sync)
+        _tenant_engines[org_id] = eng
+        return eng, added
+
+
+def tenant_engine(org_id: int):
+    """Engine do banco da empresa (criado, com schema, no primeiro uso)."""
+    eng = _tenant_engines.get(org_id)
+    if eng is None:
+        # sob serve.py o init_db do pai já sincronizou os bancos existentes
+        eng, _ = _open_tenant(org_id, sync=not SCHEMA_READY)
+    return eng
+
+
+def tenant_read_engine(org_id: int):
+    """Engine só de leitura (mode=ro) do banco da empresa."""
+    eng = _tenant_read_engines.get(org_id)
+    if eng is not None:
+        return eng
+    tenant_engine(org_id)  # o arquivo precisa existir (e ter o schema) antes do mode=ro
+    with _tenant_lock:
+        eng = _tenant_read_engines.get(org_id)
+        if eng is None:
+            eng = create_engine(_sqlite_ro_url(shard_path(org_id)), connect_args={"check_same_thread": False})
+            event.listen(eng, "connect", _sqlite_read_on_connect)
+            for fn in _engine_hooks:
+                fn(eng)
+            _tenant_read_engines[org_id] = eng
+    return eng
+
+
+def route_to_org(db: Session, org_id: int | None) -> Session:
+    """
+    No modo por empresa, manda as tabelas da operação desta sessão para o
+    banco da empresa (o resto continua no catálogo). Chame assim que souber
+    a empresa e antes de tocar em OS. Fora do modo, não faz nada.
+
+    Um commit da sessão grava nos dois bancos, um depois do outro (sem
+    two-phase commit): o da empresa primeiro, com o registro para refazer o
+    lado do catálogo (ver WriteSession).
+    """
+    if SHARD_BY_ORG and org_id:
+        from .models import TENANT_TABLES
+
+        eng = tenant_read_engine(org_id) if db.info.get("read_only") else tenant_engine(org_id)
+        for table in TENANT_TABLES:
+            db.bind_table(table, eng)
+    return db
+
+
+@contextmanager
+def read_session(org_id: int | None = None):
+    """
+    Sessão só de leitura (ReadSessionLocal), já roteada para a empresa no
+    modo por empresa. Não enxerga o que a sessão de escrita ainda não
+    commitou: use para consultas/relatórios, não no meio de um fluxo que grava.
+    """
+    db = route_to_org(ReadSessionLocal(), org_id)
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def tenant_org_ids() -> list[int]:
+    """Empresas do catálogo (um banco cada no modo por empresa)."""
+    from .models import OrganizationRow
+
+    db = SessionLocal()
+    try:
+        return [org_id for (org_id,) in db.query(OrganizationRow.id).order_by(OrganizationRow.id)]
+    finally:
+        db.close()
+
+
+def init_db() -> list[str]:
+    """
+    Cria as tabelas, aplica sync_schema e preenche colunas derivadas de linhas
+    antigas. Rode uma vez por deploy/processo pai. No modo por empresa o banco
+    principal só tem o catálogo e cada empresa existente é sincronizada aqui.
+    """
+    from .models import Base, TENANT_TABLES  # registra as tabelas no metadata
+    from .repository import backfill_equipamento_norm
+
+    tables = None
+    if SHARD_BY_ORG:
+        tables = [t for t in Base.metadata.sorted_tables if t not in TENANT_TABLES]
+    Base.metadata.create_all(bind=engine, tables=tables)
+    added = sync_schema(engine, Base.metadata)
+
+    if SHARD_BY_ORG:
+        for org_id in tenant_org_ids():
+            _, names = _open_tenant(org_id, sync=True)
+            added += [f"org_{org_id}:{name}" for name in names]
+        return added
+
+    db = SessionLocal()
+    try:
+        backfill_equipamento_norm(db)
+    finally:
+        db.close()
+    return added
@@ -0,0 +1,429 @@
+# easypcm/instrumentation.py
+"""
+Instrumentação por update do webhook.
+
+Para cada update medimos tempo de parede, nº de comandos SQL, nº de commits e
+nº de chamadas ao Bot API geradas, marcados com o fluxo/passo da conversa.
+O resultado vai para log estruturado (JSON, ver log.py) e para histogramas
+em memória.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .config import BACKUP_DIR, METRICS_DIR, METRICS_EXPORT_SEC
+
+log = logging.getLogger("easypcm.updates")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+class UpdateMetrics:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+        self.statements = 0
+        self.commits = 0
+        self.api_calls = 0
+        self.update_id: int | None = None
+        self.chat_id = ""
+        self.org_id: int | None = None
+        self.flow = ""
+        self.step = ""
+        self.error = False
+
+    def as_dict(self) -> dict:
+        return {
+            "update_id": self.update_id,
+            "chat_id": self.chat_id,
+            "org_id": self.org_id,
+            "flow": self.flow,
+            "step": self.step,
+            "latency_ms": round(self.elapsed * 1000, 2),
+            "sql_statements": self.statements,
+            "commits": self.commits,
+            "api_calls": self.api_calls,
+        }
+
+
+_current: ContextVar[UpdateMetrics | None] = ContextVar("easypcm_update_metrics", default=None)
+
+
+class Histogram:
+    """Histograma cumulativo no formato do Prometheus (buckets fixos)."""
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        for i, upper in enumerate(self.buckets):
+            if value <= upper:
+                self.counts[i] += 1
+        self.total += 1
+        self.sum += value
+
+
+class CounterFamily:
+    """Contador monotônico por combinação de labels."""
+
+    def __init__(self, name: str, help_text: str, label_names: tuple):
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self._lock = threading.Lock()
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, labels: tuple, value: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def snapshot(self) -> dict[tuple, float]:
+        with self._lock:
+            return dict(self._values)
+
+
+class HistogramFamily:
+    """Um histograma por combinação de labels (ex: flow/step)."""
+
+    def __init__(self, name: str, help_text: str, buckets: tuple, label_names: tuple):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.label_names = label_names
+        self._lock = threading.Lock()
+        self._series: dict[tuple, Histogram] = {}
+
+    def observe(self, labels: tuple, value: float) -> None:
+        with self._lock:
+            hist = self._series.get(labels)
+            if hist is None:
+                hist = Histogram(self.buckets)
+                self._series[labels] = hist
+            hist.observe(value)
+
+    def snapshot(self) -> dict[tuple, Histogram]:
+        with self._lock:
+            out = {}
+            for labels, hist in self._series.items():
+                copy = Histogram(hist.buckets)
+                copy.counts = list(hist.counts)
+                copy.total = hist.total
+                copy.sum = hist.sum
+                out[labels] = copy
+            return out
+
+
+UPDATES_TOTAL = CounterFamily(
+    "easypcm_updates_total", "Updates recebidos no webhook por resultado",
+    ("result",),  # processed / duplicate / error
+)
+
+UPDATE_LATENCY = HistogramFamily(
+    "easypcm_update_latency_seconds", "Tempo de processamento do update no webhook",
+    LATENCY_BUCKETS, ("flow", "step"),
+)
+UPDATE_SQL_STATEMENTS = HistogramFamily(
+    "easypcm_update_sql_statements", "Comandos SQL executados por update",
+    COUNT_BUCKETS, ("flow", "step"),
+)
+UPDATE_COMMITS = HistogramFamily(
+    "easypcm_update_commits", "Commits no banco por update",
+    COUNT_BUCKETS, ("flow", "step"),
+)
+UPDATE_API_CALLS = HistogramFamily(
+    "easypcm_update_api_calls", "Chamadas ao Bot API geradas por update",
+    COUNT_BUCKETS, ("flow", "step"),
+)
+
+# backup (easypcm/backup.py): quanto dura e quanto atrapalha quem escreve
+BACKUP_DURATION_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+
+BACKUP_TOTAL = CounterFamily(
+    "easypcm_backup_total", "Backups do banco por resultado",
+    ("result",),  # ok / error
+)
+BACKUP_DURATION = HistogramFamily(
+    "easypcm_backup_duration_seconds", "Duração do backup online (cópia + compactação)",
+    BACKUP_DURATION_BUCKETS, (),
+)
+BACKUP_WRITE_WAIT = HistogramFamily(
+    "easypcm_backup_write_wait_seconds", "Espera pelo lock de escrita medida entre os passos do backup",
+    LATENCY_BUCKETS, (),
+)
+UPDATE_LATENCY_DURING_BACKUP = HistogramFamily(
+    "easypcm_update_latency_during_backup_seconds", "Tempo do update no webhook enquanto um backup roda (em qualquer processo)",
+    LATENCY_BUCKETS, (),
+)
+# envio ao Bot API (easypcm/outbox.py)
+SEND_TOTAL = CounterFamily(
+    "easypcm_telegram_send_total", "Resultado das chamadas ao Bot API",
+    ("outcome",),  # sent / inline / throttled / retried / dropped
+)
+
+# ligado por backup.py durante a cópia neste processo
+backup_in_progress = threading.Event()
+
+# Sob serve.py o backup roda no processo pai e os updates nos workers: cada
+# cópia deixa também um marcador BACKUP_DIR/.running-<pid>-<ns>, visto por
+# todos. Marcador de processo que morreu no meio da cópia não conta.
+_BACKUP_MARKER = ".running-"
+BACKUP_CHECK_SEC = 1.0
+_backup_check_lock = threading.Lock()
+_backup_checked = [float("-inf"), False]  # [monotonic da última leitura, havia backup]
+
+
+@contextmanager
+def backup_marker():
+    """Marca um backup em andamento para este e os outros processos."""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    path = os.path.join(BACKUP_DIR, f"{_BACKUP_MARKER}{os.getpid()}-{time.time_ns()}")
+    open(path, "w").close()
+    backup_in_progress.set()
+    try:
+        yield
+    finally:
+        backup_in_progress.clear()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _scan_backup_markers() -> bool:
+    try:
+        names = os.listdir(BACKUP_DIR)
+    except OSError:
+        return False
+    for name in names:
+        if not name.startswith(_BACKUP_MARKER):
+            continue
+        try:
+            pid = int(name[len(_BACKUP_MARKER):].split("-", 1)[0])
+        except ValueError:
+            continue
+        if _pid_alive(pid):
+            return True
+    return False
+
+
+def backup_running() -> bool:
+    """Há backup em andamento em algum processo? Os marcadores são lidos no máximo a cada BACKUP_CHECK_SEC."""
+    if backup_in_progress.is_set():
+        return True
+    now = time.monotonic()
+    with _backup_check_lock:
+        if now - _backup_checked[0] >= BACKUP_CHECK_SEC:
+            _backup_checked[:] = [now, _scan_backup_markers()]
+        return _backup_checked[1]
+
+
+# ============================================================
+# VÁRIOS PROCESSOS (serve.py)
+# ============================================================
+# Cada processo guarda as métricas em memória; sob serve.py são N workers
+# mais o pai (envio, backup). Com METRICS_DIR cada um grava o snapshot num
+# arquivo próprio e o /metrics soma o estado atual do processo raspado com os
+# arquivos dos outros. O arquivo de um worker que morreu fica: as somas seguem
+# monotônicas quando o uvicorn sobe outro no lugar.
+
+FAMILIES = (
+    UPDATES_TOTAL, UPDATE_LATENCY, UPDATE_SQL_STATEMENTS, UPDATE_COMMITS, UPDATE_API_CALLS,
+    BACKUP_TOTAL, BACKUP_DURATION, BACKUP_WRITE_WAIT, UPDATE_LATENCY_DURING_BACKUP,
+    SEND_TOTAL,
+)
+
+
+def dump_state(path: str) -> None:
+    state = {}
+    for fam in FAMILIES:
+        if isinstance(fam, CounterFamily):
+            state[fam.name] = [[list(labels), value] for labels, value in fam.snapshot().items()]
+        else:
+            state[fam.name] = [
+                [list(labels), hist.counts, hist.total, hist.sum] for labels, hist in fam.snapshot().items()
+            ]
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, path)  # quem lê nunca vê o arquivo pela metade
+
+
+def peer_states() -> list[dict]:
+    """Snapshots gravados pelos outros processos (vazio sem METRICS_DIR)."""
+    if not METRICS_DIR:
+        return []
+    own = metrics_exporter.filename
+    states = []
+    try:
+        names = os.listdir(METRICS_DIR)
+    except OSError:
+        return []
+    for name in names:
+        if not name.endswith(".json") or name == own:
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as f:
+                states.append(json.load(f))
+        except (OSError, ValueError):
+            continue  # processo saindo ou arquivo de outra versão
+    return states
+
+
+def merged_snapshot(fam, peers: list[dict]) -> dict:
+    """snapshot() da família somado com o dos outros processos."""
+    snap = fam.snapshot()
+    for state in peers:
+        for entry in state.get(fam.name, ()):
+            labels = tuple(entry[0])
+            if isinstance(fam, CounterFamily):
+                snap[labels] = snap.get(labels, 0) + entry[1]
+                continue
+            hist = snap.get(labels)
+            if hist is None:
+                hist = snap[labels] = Histogram(fam.buckets)
+            hist.counts = [a + b for a, b in zip(hist.counts, entry[1])]
+            hist.total += entry[2]
+            hist.sum += entry[3]
+    return snap
+
+
+class MetricsExporter:
+    """Grava o snapshot deste processo em METRICS_DIR a cada interval segundos."""
+
+    def __init__(self, interval: float = METRICS_EXPORT_SEC):
+        self.interval = interval
+        self.filename = ""
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        if not METRICS_DIR or (self._thread and self._thread.is_alive()):
+            return
+        # pid + início: um pid reaproveitado não sobrescreve o arquivo de quem morreu
+        self.filename = f"{os.getpid()}-{time.time_ns()}.json"
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="metrics-exporter", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        if self.filename:
+            self._dump()  # o que entrou desde a última gravação
+
+    def _dump(self) -> None:
+        try:
+            dump_state(os.path.join(METRICS_DIR, self.filename))
+        except OSError:
+            log.exception("metrics_export_failed")
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._dump()
+            self._stop.wait(self.interval)
+
+
+metrics_exporter = MetricsExporter()
+
+
+# ============================================================
+# HOOKS
+# ============================================================
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    m = _current.get()
+    if m is not None:
+        m.statements += 1
+
+
+def _on_commit(conn):
+    m = _current.get()
+    if m is not None:
+        m.commits += 1
+
+
+def install_db_hooks(engine: Engine) -> None:
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "commit", _on_commit)
+
+
+def count_api_calls(n: int = 1) -> None:
+    m = _current.get()
+    if m is not None:
+        m.api_calls += n
+
+
+def tag(**fields) -> None:
+    """Marca o update em andamento (update_id, chat_id, org_id, flow, step)."""
+    m = _current.get()
+    if m is None:
+        return
+    for key, value in fields.items():
+        setattr(m, key, value)
+
+
+def current() -> UpdateMetrics | None:
+    return _current.get()
+
+
+@contextmanager
+def track_update():
+    m = UpdateMetrics()
+    token = _current.set(m)
+    try:
+        yield m
+    except BaseException:
+        m.error = True
+        raise
+    finally:
+        _current.reset(token)
+        m.elapsed = time.perf_counter() - m.started
+        _record(m)
+
+
+def _record(m: UpdateMetrics) -> None:
+    if m.error:
+        result = "error"
+    elif m.flow == "DUPLICATE":
+        result = "duplicate"
+    else:
+        result = "processed"
+    UPDATES_TOTAL.inc((result,))
+
+    labels = (m.flow or "-", m.step or "-")
+    UPDATE_LATENCY.observe(labels, m.elapsed)
+    UPDATE_SQL_STATEMENTS.observe(labels, m.statements)
+    UPDATE_COMMITS.observe(labels, m.commits)
+    UPDATE_API_CALLS.observe(labels, m.api_calls)
+    if backup_running():
+        UPDATE_LATENCY_DURING_BACKUP.observe((), m.elapsed)
+    # sucesso é o caso comum: amostrado; erro e duplicado sempre aparecem
+    log.log(
+        logging.ERROR if m.error else logging.INFO,
+        "update_processed",
+        extra={"fields": {"result": result, **m.as_dict()}, "sampled": result == "processed"},
+    )
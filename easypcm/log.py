@@ -0,0 +1,129 @@
+# easypcm/log.py
+"""
+Log estruturado (JSON) sem bloquear o processamento do update.
+
+Os loggers "easypcm.*" só colocam o registro numa fila (QueueHandler); uma
+thread (QueueListener) formata e escreve no stdout. Cada registro leva o
+contexto do update em andamento (update_id, chat_id, org_id, flow, step),
+capturado na thread que gerou o log, antes de ir para a fila.
+
+Logs de sucesso de alto volume (ex: cada chamada 200 ao Bot API) passam por
+amostragem: use log_event(..., sampled=True) e ajuste LOG_SAMPLE_RATE.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from .instrumentation import current
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# fração dos logs "sampled" que é mantida (1 = todos, 0.01 = 1%)
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))
+# tamanho da fila; cheia, o registro é descartado em vez de travar o webhook
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+_CONTEXT_FIELDS = ("update_id", "chat_id", "org_id", "flow", "step")
+
+_listener: QueueListener | None = None
+_handler: logging.Handler | None = None
+
+
+class ContextFilter(logging.Filter):
+    """Anexa o contexto do update e aplica a amostragem (roda na thread do log)."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "sampled", False) and record.levelno <= logging.INFO:
+            if random.random() >= LOG_SAMPLE_RATE:
+                return False
+            record.sample_rate = LOG_SAMPLE_RATE
+
+        m = current()
+        if m is not None:
+            record.ctx = {k: getattr(m, k) for k in _CONTEXT_FIELDS if getattr(m, k) not in (None, "")}
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        data.update(getattr(record, "ctx", None) or {})
+        data.update(getattr(record, "fields", None) or {})
+        if getattr(record, "sample_rate", None) is not None:
+            data["sample_rate"] = record.sample_rate
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # a formatação fica para o listener; aqui só resolvemos a mensagem
+        # e o traceback (exc_info não atravessa a fila com segurança)
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+def setup_logging(stream=None) -> None:
+    """Liga o log assíncrono nos loggers "easypcm". Pode ser chamado mais de uma vez."""
+    global _listener, _handler
+    if _listener is not None:
+        return
+
+    q: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    out = logging.StreamHandler(stream or sys.stdout)
+    out.setFormatter(JsonFormatter())
+
+    handler = _NonBlockingQueueHandler(q)
+    handler.addFilter(ContextFilter())
+
+    root = logging.getLogger("easypcm")
+    if _handler is not None:
+        root.removeHandler(_handler)  # setup de novo após um stop_logging()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(handler)
+    root.propagate = False
+    _handler = handler
+
+    _listener = QueueListener(q, out, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging() -> None:
+    """Esvazia a fila e para a thread de escrita."""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    _listener = None
+
+
+def log_event(logger: logging.Logger, event: str, level: int = logging.INFO,
+              sampled: bool = False, exc_info=None, **fields) -> None:
+    if not logger.isEnabledFor(level):
+        return
+    logger.log(level, event, exc_info=exc_info, extra={"fields": fields, "sampled": sampled})
@@ -0,0 +1,136 @@
+# easypcm/metrics.py
+"""
+Exposição das métricas no formato texto do Prometheus (/metrics).
+
+Sob serve.py (METRICS_DIR) contadores e histogramas somam todos os processos:
+qualquer worker pode responder a raspagem. O pool de conexões é o do processo
+que respondeu.
+"""
+import os
+
+from sqlalchemy.orm import Session
+
+from .db import engine
+from .instrumentation import (
+    BACKUP_DURATION,
+    BACKUP_TOTAL,
+    BACKUP_WRITE_WAIT,
+    CounterFamily,
+    HistogramFamily,
+    SEND_TOTAL,
+    UPDATES_TOTAL,
+    UPDATE_LATENCY,
+    UPDATE_SQL_STATEMENTS,
+    UPDATE_COMMITS,
+    UPDATE_API_CALLS,
+    UPDATE_LATENCY_DURING_BACKUP,
+    merged_snapshot,
+    peer_states,
+)
+from .repository import outbox_depth_by_priority, outbox_due_backlog
+from .telegram import SEND_OUTCOMES
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: dict | None = None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    for n, v in (extra or {}).items():
+        pairs.append(f'{n}="{_escape(v)}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _render_counter(fam: CounterFamily, out: list[str], peers: list[dict]) -> None:
+    out.append(f"# HELP {fam.name} {fam.help}")
+    out.append(f"# TYPE {fam.name} counter")
+    for labels, value in sorted(merged_snapshot(fam, peers).items()):
+        out.append(f"{fam.name}{_labels(fam.label_names, labels)} {value}")
+
+
+def _render_histogram(fam: HistogramFamily, out: list[str], peers: list[dict]) -> None:
+    out.append(f"# HELP {fam.name} {fam.help}")
+    out.append(f"# TYPE {fam.name} histogram")
+    for labels, hist in sorted(merged_snapshot(fam, peers).items()):
+        for upper, count in zip(hist.buckets, hist.counts):
+            out.append(f"{fam.name}_bucket{_labels(fam.label_names, labels, {'le': upper})} {count}")
+        out.append(f"{fam.name}_bucket{_labels(fam.label_names, labels, {'le': '+Inf'})} {hist.total}")
+        out.append(f"{fam.name}_sum{_labels(fam.label_names, labels)} {hist.sum}")
+        out.append(f"{fam.name}_count{_labels(fam.label_names, labels)} {hist.total}")
+
+
+def _gauge(out: list[str], name: str, help_text: str, samples: list[tuple[dict, float]]) -> None:
+    out.append(f"# HELP {name} {help_text}")
+    out.append(f"# TYPE {name} gauge")
+    for labels, value in samples:
+        out.append(f"{name}{_labels((), (), labels)} {value}")
+
+
+def _pool_samples() -> list[tuple[dict, float]]:
+    pool = engine.pool
+    samples = []
+    for key in ("size", "checkedout", "overflow", "checkedin"):
+        fn = getattr(pool, key, None)
+        if callable(fn):
+            samples.append(({"state": key}, fn()))
+    return samples
+
+
+def _last_backup_samples() -> list[tuple[dict, float]]:
+    # lê o diretório: vale mesmo quando o backup roda em outro processo (serve.py)
+    from .backup import list_snapshots
+
+    try:
+        snapshots = list_snapshots()
+    except (RuntimeError, OSError):
+        return []
+    return [({}, os.path.getmtime(snapshots[0]))] if snapshots else []
+
+
+def render_metrics(db: Session) -> str:
+    out: list[str] = []
+    peers = peer_states()
+
+    _render_counter(UPDATES_TOTAL, out, peers)
+
+    updates = merged_snapshot(UPDATES_TOTAL, peers)
+    total = sum(updates.values())
+    dedup_rate = (updates.get(("duplicate",), 0) / total) if total else 0.0
+    _gauge(out, "easypcm_dedup_hit_ratio", "Fração dos updates descartados como duplicados", [({}, dedup_rate)])
+
+    for fam in (UPDATE_LATENCY, UPDATE_SQL_STATEMENTS, UPDATE_COMMITS, UPDATE_API_CALLS):
+        _render_histogram(fam, out, peers)
+
+    depth = outbox_depth_by_priority(db)
+    _gauge(
+        out, "easypcm_outbox_pending", "Mensagens pendentes no outbox por prioridade",
+        [({"priority": p}, n) for p, n in sorted(depth.items())] or [({"priority": 0}, 0)],
+    )
+    due, oldest_age = outbox_due_backlog(db)
+    _gauge(out, "easypcm_outbox_due", "Mensagens vencidas aguardando envio", [({}, due)])
+    _gauge(out, "easypcm_outbox_oldest_due_age_seconds", "Idade da mensagem vencida mais antiga", [({}, oldest_age)])
+
+    _gauge(
+        out, "easypcm_db_pool_connections", "Conexões do pool do SQLAlchemy (processo que respondeu)",
+        _pool_samples(),
+    )
+
+    _render_counter(BACKUP_TOTAL, out, peers)
+    for fam in (BACKUP_DURATION, BACKUP_WRITE_WAIT, UPDATE_LATENCY_DURING_BACKUP):
+        _render_histogram(fam, out, peers)
+    _gauge(
+        out, "easypcm_backup_last_success_timestamp_seconds",
+        "Horário (unix) do snapshot mais recente em BACKUP_DIR", _last_backup_samples(),
+    )
+
+    # todos os resultados aparecem, mesmo zerados
+    sends = merged_snapshot(SEND_TOTAL, peers)
+    for outcome in SEND_OUTCOMES:
+        sends.setdefault((outcome,), 0)
+    out.append(f"# HELP {SEND_TOTAL.name} {SEND_TOTAL.help}")
+    out.append(f"# TYPE {SEND_TOTAL.name} counter")
+    for labels, value in sorted(sends.items()):
+        out.append(f"{SEND_TOTAL.name}{_labels(SEND_TOTAL.label_names, labels)} {value}")
+
+    return "\n".join(out) + "\n"
@@ -1,4 +1,4 @@
-from sqlalchemy import String, Integer, Text, DateTime, ForeignKey, Boolean
+from sqlalchemy import Column, String, Integer, Text, DateTime, ForeignKey, Boolean, Index, Table, text
 from sqlalchemy.orm import Mapped, mapped_column
 from sqlalchemy.sql import func
 
@@ -68,12 +68,50 @@ class InviteRow(Base):
     created_at: Mapped[str] = mapped_column(DateTime(timezone=True), server_default=func.now())
 
 
+class NotificationSubscriptionRow(Base):
+    """
+    Quem recebe alertas da empresa. role/setor vazios = qualquer perfil/setor.
+    Sem nenhuma linha para a empresa, todos os membros ativos recebem.
+    """
+    __tablename__ = "notification_subscriptions"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    org_id: Mapped[int] = mapped_column(Integer, ForeignKey("organizations.id"), index=True)
+
+    event: Mapped[str] = mapped_column(String, default="MAQUINA_PARADA")
+    role: Mapped[str] = mapped_column(String, default="")  # ORG_ADMIN / ORG_USER / "" (todos)
+    setor: Mapped[str] = mapped_column(String, default="")  # "" = todos os setores
+
+    active: Mapped[bool] = mapped_column(Boolean, default=True)
+    created_at: Mapped[str] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+
 # ============================================================
 # WORK ORDERS
 # ============================================================
 
+# filtro de "OS em aberto" escrito igual no índice parcial e na consulta
+# (o SQLite só usa o índice parcial se o WHERE da consulta contiver o dele)
+OPEN_STATUS_SQL = "status NOT IN ('FECHADA', 'CANCELADA')"
+
+
 class WorkOrderRow(Base):
     __tablename__ = "work_orders"
+    __table_args__ = (
+        # histórico do equipamento: WHERE org_id AND equipamento_norm ORDER BY abertura_em DESC
+        Index("ix_work_orders_org_equip_abertura", "org_id", "equipamento_norm", "abertura_em"),
+        # OS abertas por equipamento (checagem de duplicata na abertura); parcial:
+        # não cresce com o histórico de fechadas
+        Index(
+            "ix_work_orders_open_equip",
+            "org_id", "equipamento_norm",
+            sqlite_where=text(OPEN_STATUS_SQL),
+            postgresql_where=text(OPEN_STATUS_SQL),
+        ),
+        # id nunca reaproveitado: sem AUTOINCREMENT o SQLite devolve o id da
+        # maior OS depois que ela vai para o arquivo (db.sync_schema migra)
+        {"sqlite_autoincrement": True},
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
 
@@ -84,6 +122,8 @@ class WorkOrderRow(Base):
     chat_id: Mapped[str] = mapped_column(String, index=True)
 
     equipamento: Mapped[str] = mapped_column(String, default="SEM INFORMAÇÃO")
+    # chave de busca do equipamento (schemas.normalize_equipamento)
+    equipamento_norm: Mapped[str] = mapped_column(String, default="", server_default="")
     setor: Mapped[str] = mapped_column(String, default="SEM INFORMAÇÃO")
 
     descricao_do_problema: Mapped[str] = mapped_column(Text, default="SEM INFORMAÇÃO")
@@ -103,9 +143,47 @@ class WorkOrderRow(Base):
     source_text: Mapped[str] = mapped_column(Text, default="")
     created_at: Mapped[str] = mapped_column(DateTime(timezone=True), server_default=func.now())
 
+    # CORRETIVA (aberta por alguém) / PREVENTIVA (gerada por um plano, plano_id)
+    tipo_manutencao: Mapped[str] = mapped_column(String, default="CORRETIVA", server_default="CORRETIVA")
+    plano_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+
+    # controle de concorrência otimista: todo UPDATE confere e incrementa
+    version: Mapped[int] = mapped_column(Integer, nullable=False, default=1, server_default="1")
+
+    __mapper_args__ = {"version_id_col": version}
+
+
+class WorkOrderStatusHistoryRow(Base):
+    """
+    Uma linha por troca de status, só INSERT (nunca atualizada): quanto tempo
+    a OS ficou em from_status antes de ir para to_status. Tempo em status,
+    gargalos etc. saem de agregados sobre esta tabela, sem reler events.
+    """
+    __tablename__ = "work_order_status_history"
+    __table_args__ = (
+        # relatório por período: WHERE org_id AND changed_at >= ? GROUP BY from_status, setor
+        # (cobre a consulta inteira, sem ir na tabela)
+        Index("ix_status_hist_report", "org_id", "changed_at", "from_status", "setor", "duration_sec"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    org_id: Mapped[int | None] = mapped_column(Integer, ForeignKey("organizations.id"), nullable=True)
+    # sem FK: a OS pode ir para o arquivo (work_orders_archive) e o histórico fica aqui
+    work_order_id: Mapped[int] = mapped_column(Integer, index=True)
+    setor: Mapped[str] = mapped_column(String, default="")  # cópia do setor da OS (agrupamento)
+
+    from_status: Mapped[str] = mapped_column(String)
+    to_status: Mapped[str] = mapped_column(String)
+    from_since: Mapped[str] = mapped_column(DateTime(timezone=True))  # quando entrou em from_status
+    changed_at: Mapped[str] = mapped_column(DateTime(timezone=True))
+    duration_sec: Mapped[int] = mapped_column(Integer, default=0)  # changed_at - from_since
+
+    observacao: Mapped[str] = mapped_column(Text, default="")
+
 
 class MaterialRow(Base):
     __tablename__ = "materials"
+    __table_args__ = {"sqlite_autoincrement": True}
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
     work_order_id: Mapped[int] = mapped_column(Integer, ForeignKey("work_orders.id"), index=True)
@@ -122,6 +200,7 @@ class TechnicianRow(Base):
 
 class WorkOrderTechnicianRow(Base):
     __tablename__ = "work_order_technicians"
+    __table_args__ = {"sqlite_autoincrement": True}
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
     work_order_id: Mapped[int] = mapped_column(Integer, ForeignKey("work_orders.id"), index=True)
@@ -134,7 +213,7 @@ class ChatState(Base):
     id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
     chat_id: Mapped[str] = mapped_column(String, unique=True, index=True)
 
-    mode: Mapped[str] = mapped_column(String, default="IDLE")  # IDLE, OPEN_FLOW, CLOSE_FLOW, UPDATE_FLOW
+    mode: Mapped[str] = mapped_column(String, default="IDLE")  # IDLE, OPEN_FLOW, CLOSE_FLOW, UPDATE_FLOW, CONSULT_FLOW
     step: Mapped[str] = mapped_column(String, default="")
     os_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
 
@@ -159,8 +238,170 @@ class ChatState(Base):
     temp_status: Mapped[str] = mapped_column(String, default="")
     temp_status_obs: Mapped[str] = mapped_column(Text, default="")
 
+    # versão da OS quando foi escolhida no seletor (fechar/atualizar)
+    temp_os_version: Mapped[int | None] = mapped_column(Integer, nullable=True)
+
+    # fechamento em lote: OS marcadas no seletor, "id:versão" separados por vírgula
+    temp_lote: Mapped[str] = mapped_column(Text, default="")
+
     updated_at: Mapped[str] = mapped_column(
         DateTime(timezone=True),
         server_default=func.now(),
         onupdate=func.now(),
-    )
\ No newline at end of file
+    )
+
+    # modo por empresa: token do último org_commits (banco da empresa) cujo
+    # lado do catálogo já está gravado aqui (ver repository.recover_org_commit)
+    org_commit: Mapped[str] = mapped_column(String, default="")
+
+    # dois updates do mesmo chat ao mesmo tempo: o segundo a gravar perde
+    version: Mapped[int] = mapped_column(Integer, nullable=False, default=1, server_default="1")
+
+    __mapper_args__ = {"version_id_col": version}
+
+
+# ============================================================
+# PREVENTIVAS (planos que geram OS recorrentes)
+# ============================================================
+
+class PreventivePlanRow(Base):
+    """
+    Plano de preventiva: gera uma OS (tipo_manutencao=PREVENTIVA) para o
+    equipamento a cada vencimento. regra/regra_valor: DIAS (a cada N dias),
+    SEMANAL (dia da semana, 0 = segunda) ou MENSAL (dia do mês).
+    proxima_em é a fila do agendador (easypcm/preventive.py).
+    """
+    __tablename__ = "preventive_plans"
+    __table_args__ = (
+        # agendador: planos alterados desde a última varredura (não relê todos)
+        Index("ix_preventive_plans_updated", "updated_at"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    org_id: Mapped[int | None] = mapped_column(Integer, ForeignKey("organizations.id"), nullable=True, index=True)
+
+    equipamento: Mapped[str] = mapped_column(String, default="SEM INFORMAÇÃO")
+    setor: Mapped[str] = mapped_column(String, default="SEM INFORMAÇÃO")
+    tarefa: Mapped[str] = mapped_column(Text, default="")
+    checklist: Mapped[str] = mapped_column(Text, default="")  # um item por linha
+
+    regra: Mapped[str] = mapped_column(String, default="DIAS")  # DIAS / SEMANAL / MENSAL
+    regra_valor: Mapped[int] = mapped_column(Integer, default=30)
+
+    proxima_em: Mapped[str] = mapped_column(DateTime(timezone=True))
+    ultima_os_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    ultima_em: Mapped[str | None] = mapped_column(DateTime(timezone=True), nullable=True)
+
+    active: Mapped[bool] = mapped_column(Boolean, default=True)
+    created_by_user_id: Mapped[str] = mapped_column(String, default="")
+    created_at: Mapped[str] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    updated_at: Mapped[str] = mapped_column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    # agendador e /preventiva del gravando o mesmo plano: o segundo perde
+    version: Mapped[int] = mapped_column(Integer, nullable=False, default=1, server_default="1")
+
+    __mapper_args__ = {"version_id_col": version}
+
+
+# ============================================================
+# ARQUIVO (OS fechadas antigas saem das tabelas quentes)
+# ============================================================
+
+def _archive_of(table: Table, name: str, *indexes: Index) -> Table:
+    """
+    Tabela fria com as mesmas colunas/tipos da quente, sem FKs nem defaults:
+    só recebe cópias (repository.archive_closed_work_orders). Coluna nova no
+    modelo quente aparece aqui também e o sync_schema cria nas duas.
+    """
+    # sync_schema: a sequência de ids da quente continua depois do maior id arquivado
+    table.info["archive"] = name
+    columns = [
+        Column(c.name, c.type, primary_key=c.primary_key, nullable=c.nullable, autoincrement=False)
+        for c in table.columns
+    ]
+    return Table(name, Base.metadata, *columns, *indexes)
+
+
+work_orders_archive = _archive_of(
+    WorkOrderRow.__table__, "work_orders_archive",
+    Index("ix_wo_archive_org_equip_abertura", "org_id", "equipamento_norm", "abertura_em"),
+    # busca por org mais recentes primeiro: (org_id) já vem em ordem de id, sem sort
+    Index("ix_wo_archive_org_id", "org_id"),
+)
+materials_archive = _archive_of(
+    MaterialRow.__table__, "materials_archive",
+    Index("ix_materials_archive_wo", "work_order_id"),
+)
+work_order_technicians_archive = _archive_of(
+    WorkOrderTechnicianRow.__table__, "work_order_technicians_archive",
+    Index("ix_wo_tech_archive_wo", "work_order_id"),
+)
+
+class OrgCommitRow(Base):
+    """
+    Modo por empresa: o que um commit gravou no catálogo (estado do chat e
+    outbox) junto com as OS, guardado no banco da empresa na MESMA transação
+    delas. O banco da empresa commita primeiro (db.WriteSession); se o commit
+    do catálogo se perder, o próximo update do chat reaplica este registro
+    (repository.recover_org_commit). prev_token é o org_commit que o estado do
+    chat tinha antes: registro com prev_token igual ao do catálogo = não aplicado.
+    """
+    __tablename__ = "org_commits"
+    __table_args__ = (
+        Index("ix_org_commits_chat_prev", "chat_id", "prev_token"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    chat_id: Mapped[str] = mapped_column(String)
+    token: Mapped[str] = mapped_column(String, unique=True)
+    prev_token: Mapped[str] = mapped_column(String, default="")
+    chat_state: Mapped[str] = mapped_column(Text)  # JSON: colunas do ChatState depois do commit
+    outbox: Mapped[str] = mapped_column(Text, default="[]")  # JSON: [chat_id, method, payload, priority]
+    created_at: Mapped[str] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+
+# modo por empresa (db.SHARD_BY_ORG): estas ficam no banco de cada empresa,
+# o resto no catálogo. Nenhuma consulta junta tabelas dos dois lados.
+TENANT_TABLES = (
+    WorkOrderRow.__table__,
+    MaterialRow.__table__,
+    TechnicianRow.__table__,
+    WorkOrderTechnicianRow.__table__,
+    WorkOrderStatusHistoryRow.__table__,
+    PreventivePlanRow.__table__,
+    work_orders_archive,
+    materials_archive,
+    work_order_technicians_archive,
+    OrgCommitRow.__table__,
+)
+
+
+# ============================================================
+# OUTBOX (mensagens de saída para o Telegram)
+# ============================================================
+
+class OutboxMessageRow(Base):
+    __tablename__ = "outbox_messages"
+    __table_args__ = (
+        Index("ix_outbox_status_next_attempt", "status", "next_attempt_at"),
+        # resposta inline: o chat ainda tem chamada na fila? (sem varrer o histórico SENT)
+        Index("ix_outbox_chat_status", "chat_id", "status"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    chat_id: Mapped[str] = mapped_column(String, index=True)
+
+    method: Mapped[str] = mapped_column(String, default="sendMessage")  # método do Bot API
+    payload: Mapped[str] = mapped_column(Text)  # JSON do corpo da chamada
+    priority: Mapped[int] = mapped_column(Integer, default=0)  # 0 = resposta ao usuário, 1 = notificação em massa
+
+    status: Mapped[str] = mapped_column(String, default="PENDING")  # PENDING / SENT / FAILED
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    next_attempt_at: Mapped[str] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    last_error: Mapped[str] = mapped_column(Text, default="")
+
+    # lote que reservou a linha para envio (vários processos enviando)
+    lease_token: Mapped[str] = mapped_column(String, default="")
+
+    created_at: Mapped[str] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    sent_at: Mapped[str | None] = mapped_column(DateTime(timezone=True), nullable=True)
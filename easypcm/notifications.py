@@ -0,0 +1,110 @@
+# easypcm/notifications.py
+"""
+Fan-out de alertas para os membros da empresa.
+
+Os destinatários são resolvidos a partir dos OrgUserRow ativos filtrados pelas
+assinaturas (perfil/setor) e as mensagens vão em lote para o outbox com
+prioridade baixa. O webhook só paga um INSERT em lote; o envio fica com o
+worker, dentro do rate limit.
+"""
+from sqlalchemy.orm import Session
+
+from .instrumentation import count_api_calls
+from .models import WorkOrderRow
+from .repository import (
+    enqueue_outbox_bulk,
+    list_active_org_members,
+    list_notification_subscriptions,
+)
+from .telegram import build_send_message
+from .ui_texts import TXT
+
+EVENT_MACHINE_DOWN = "MAQUINA_PARADA"
+EVENT_PREVENTIVE = "PREVENTIVA"
+
+# perfil digitado no /alertas -> role gravado
+ROLE_ALIASES = {
+    "ADMIN": "ORG_ADMIN",
+    "ORG_ADMIN": "ORG_ADMIN",
+    "USUARIO": "ORG_USER",
+    "USUÁRIO": "ORG_USER",
+    "TECNICO": "ORG_USER",
+    "TÉCNICO": "ORG_USER",
+    "ORG_USER": "ORG_USER",
+    "TODOS": "",
+}
+
+
+def _norm_setor(setor: str) -> str:
+    return " ".join((setor or "").split()).casefold()
+
+
+def _recipient_resolver(db: Session, org_id: int, event: str):
+    """Lê assinaturas e membros uma vez; devolve setor -> destinatários."""
+    subs = list_notification_subscriptions(db, org_id, event)
+    rules = [(s.role, _norm_setor(s.setor)) for s in subs] or [("", "")]
+    members = list_active_org_members(db, org_id)
+
+    def resolve(setor: str) -> list[str]:
+        setor_norm = _norm_setor(setor)
+        recipients = []
+        for mem in members:
+            for role, sub_setor in rules:
+                if role and role != mem.role:
+                    continue
+                if sub_setor and sub_setor != setor_norm:
+                    continue
+                recipients.append(mem.telegram_user_id)
+                break
+        return recipients
+
+    return resolve
+
+
+def resolve_recipients(db: Session, org_id: int, event: str, setor: str) -> list[str]:
+    """telegram_user_id dos membros ativos que assinam o evento para o setor."""
+    return _recipient_resolver(db, org_id, event)(setor)
+
+
+def fan_out(db: Session, org_id: int, event: str, setor: str, text: str, exclude_user_id: str = "") -> int:
+    """Enfileira o alerta para os destinatários (sem commit). Retorna quantos."""
+    payloads = [
+        (user_id, build_send_message(user_id, text))
+        for user_id in resolve_recipients(db, org_id, event, setor)
+        if user_id != str(exclude_user_id)
+    ]
+    count_api_calls(len(payloads))
+    return enqueue_outbox_bulk(db, "sendMessage", payloads)
+
+
+def notify_machine_down(db: Session, wo: WorkOrderRow, exclude_user_id: str = "") -> int:
+    if wo.maquina_parada != "SIM" or not wo.org_id:
+        return 0
+    text = TXT.machine_down_alert(wo.id, wo.equipamento, wo.setor, wo.descricao_do_problema)
+    return fan_out(db, wo.org_id, EVENT_MACHINE_DOWN, wo.setor, text, exclude_user_id=exclude_user_id)
+
+
+def notify_preventive_generated(db: Session, org_id: int, rows: list[tuple[int, str, str, str]]) -> int:
+    """
+    Aviso das OS preventivas geradas num lote: uma mensagem por destinatário
+    com as OS dos setores que ele assina, em vez de uma por OS (sem commit).
+    rows = [(os_id, equipamento, setor, tarefa), ...].
+    """
+    if not rows:
+        return 0
+    resolve = _recipient_resolver(db, org_id, EVENT_PREVENTIVE)
+    recipients_by_setor: dict[str, list[str]] = {}
+    by_user: dict[str, list[tuple[int, str, str, str]]] = {}
+    for row in rows:
+        setor_norm = _norm_setor(row[2])
+        if setor_norm not in recipients_by_setor:
+            recipients_by_setor[setor_norm] = resolve(row[2])
+        for user_id in recipients_by_setor[setor_norm]:
+            by_user.setdefault(user_id, []).append(row)
+
+    payloads = [
+        (user_id, build_send_message(user_id, TXT.preventive_alert(user_rows)))
+        for user_id, user_rows in by_user.items()
+    ]
+    count_api_calls(len(payloads))
+    return enqueue_outbox_bulk(db, "sendMessage", payloads)
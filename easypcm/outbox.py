@@ -0,0 +1,243 @@
+# easypcm/outbox.py
+"""
+Outbox de mensagens para o Telegram.
+
+O webhook só grava as chamadas na tabela outbox_messages (na mesma transação
+da mudança de estado). Um worker em background envia em lotes, respeitando o
+rate limit, e reagenda com backoff o que falhar: entrega "pelo menos uma vez".
+
+Quando o update gera UMA única chamada, ela volta direto no corpo da resposta
+do webhook (o Telegram executa {"method": ...}) e a linha é marcada como
+enviada, economizando um POST. Por isso as chamadas nascem com um pequeno
+atraso: o worker não as pega antes do webhook decidir.
+"""
+import json
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session
+
+from .config import INLINE_REPLY_ENABLED
+from .db import SessionLocal
+from .instrumentation import count_api_calls
+from .log import log_event
+from .repository import claim_due_outbox, enqueue_outbox, has_pending_outbox, save_outbox_results
+from .telegram import (
+    build_answer_callback,
+    build_edit_message_text,
+    build_edit_reply_markup,
+    build_send_message,
+    deliver,
+    limiter,
+    record_send_event,
+    SEND_OK,
+    SEND_RETRY,
+)
+
+log = logging.getLogger("easypcm.outbox")
+
+MAX_ATTEMPTS = 8
+MAX_BACKOFF_SEC = 300
+
+# tempo que a chamada fica reservada para a resposta inline do webhook;
+# se o processo cair antes do commit final, o worker envia depois disso
+INLINE_HOLD_SEC = 30
+
+# chamadas cuja ordem em relação às outras não importa
+_UNORDERED_METHODS = {"answerCallbackQuery"}
+
+# reserva de um lote pelo worker; se o processo morrer no meio, as mensagens
+# voltam a ficar vencidas depois disso (e são reenviadas: pelo menos uma vez)
+LEASE_SEC = 60
+
+
+def queue_call(db: Session, chat_id: str, method: str, payload: dict) -> None:
+    """Enfileira uma chamada do Bot API (sem commit)."""
+    not_before = None
+    if INLINE_REPLY_ENABLED:
+        not_before = datetime.now(timezone.utc) + timedelta(seconds=INLINE_HOLD_SEC)
+    row = enqueue_outbox(db, chat_id, method, payload, not_before=not_before)
+    db.info.setdefault("outbox_rows", []).append(row)
+    count_api_calls()
+
+
+def queue_message(db: Session, chat_id: str, text: str, reply_markup: dict | str | None = None) -> None:
+    """Enfileira um sendMessage (sem commit)."""
+    queue_call(db, chat_id, "sendMessage", build_send_message(chat_id, text, reply_markup))
+
+
+def queue_edit_text(
+    db: Session,
+    chat_id: str,
+    message_id: int,
+    text: str,
+    reply_markup: dict | str | None = None,
+) -> None:
+    queue_call(db, chat_id, "editMessageText", build_edit_message_text(chat_id, message_id, text, reply_markup))
+
+
+def queue_edit_markup(db: Session, chat_id: str, message_id: int, reply_markup: dict | str) -> None:
+    queue_call(db, chat_id, "editMessageReplyMarkup", build_edit_reply_markup(chat_id, message_id, reply_markup))
+
+
+def queue_answer_callback(db: Session, callback_query_id: str, text: str = "", show_alert: bool = False) -> None:
+    # chat_id vazio: não consome o limite por chat
+    queue_call(db, "", "answerCallbackQuery", build_answer_callback(callback_query_id, text, show_alert))
+
+
+def forget_rolled_back(db: Session) -> None:
+    """Após um rollback, esquece as chamadas enfileiradas que não foram gravadas."""
+    rows = db.info.get("outbox_rows", [])
+    db.info["outbox_rows"] = [r for r in rows if inspect(r).persistent]
+
+
+def take_inline_reply(db: Session) -> dict | None:
+    """
+    Fecha as chamadas enfileiradas por este update (antes do commit final).
+    Se sobrar só uma chamada cuja ordem importa (ex: um send ou um edit + o
+    answerCallbackQuery), ela é marcada como enviada e devolvida para a
+    resposta do webhook; o resto é liberado para o worker.
+
+    Só vai inline se o chat não tem chamada anterior ainda na fila (senão
+    passaria na frente dela) e se há vaga no rate limit agora; caso
+    contrário fica com o worker, como as outras.
+    """
+    rows = db.info.pop("outbox_rows", [])
+    now = datetime.now(timezone.utc)
+
+    inline_row = None
+    if INLINE_REPLY_ENABLED and rows:
+        ordered = [r for r in rows if r.method not in _UNORDERED_METHODS]
+        if len(ordered) <= 1:
+            inline_row = ordered[0] if ordered else rows[0]
+        if inline_row is not None and inline_row.chat_id and has_pending_outbox(db, inline_row.chat_id, exclude=rows):
+            inline_row = None
+        if inline_row is not None and limiter.try_acquire(inline_row.chat_id) > 0:
+            inline_row = None
+
+    for row in rows:
+        if row is inline_row:
+            row.status = "SENT"
+            row.sent_at = now
+            row.last_error = "inline"
+            record_send_event("inline")
+        else:
+            row.next_attempt_at = now
+
+    if inline_row is None:
+        return None
+    return {"method": inline_row.method, **json.loads(inline_row.payload)}
+
+
+def _backoff_seconds(attempts: int) -> float:
+    return float(min(MAX_BACKOFF_SEC, 2 ** attempts))
+
+
+class OutboxWorker:
+    def __init__(self, session_factory=SessionLocal, batch_size: int = 50, poll_interval: float = 0.5):
+        self._session_factory = session_factory
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="outbox-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def is_alive(self) -> bool:
+        return bool(self._thread and self._thread.is_alive())
+
+    def wake(self) -> None:
+        """Chamado após o commit do webhook para enviar sem esperar o polling."""
+        self._wake.set()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                sent = self.run_once()
+            except Exception:
+                log_event(log, "outbox_worker_error", logging.ERROR, exc_info=True)
+                sent = 0
+            if sent == 0:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def run_once(self) -> int:
+        """Processa um lote de mensagens vencidas. Retorna quantas foram tentadas."""
+        db = self._session_factory()
+        try:
+            rows = claim_due_outbox(db, limit=self.batch_size, lease_sec=LEASE_SEC)
+            jobs = [
+                {
+                    "id": r.id, "chat_id": r.chat_id, "method": r.method, "payload": r.payload,
+                    "status": r.status, "attempts": r.attempts, "next_attempt_at": r.next_attempt_at,
+                    "last_error": r.last_error, "sent_at": r.sent_at,
+                }
+                for r in rows
+            ]
+            # nada de transação aberta (lock de escrita) enquanto fala com o Telegram
+            db.commit()
+
+            attempted = 0
+            for job in jobs:
+                now = datetime.now(timezone.utc)
+
+                wait = limiter.try_acquire(job["chat_id"])
+                if wait > 0:
+                    # sem vaga no rate limit: só reagenda, não conta como tentativa
+                    if job["attempts"] == 0:
+                        record_send_event("throttled")
+                    job["next_attempt_at"] = now + timedelta(seconds=wait)
+                    continue
+
+                attempted += 1
+                outcome, retry_after, detail = deliver(job["method"], json.loads(job["payload"]), job["chat_id"])
+                job["attempts"] += 1
+
+                if outcome == SEND_OK:
+                    job["status"] = "SENT"
+                    job["sent_at"] = now
+                    job["last_error"] = ""
+                    record_send_event("sent")
+                elif outcome == SEND_RETRY and job["attempts"] < MAX_ATTEMPTS:
+                    delay = max(retry_after, _backoff_seconds(job["attempts"]))
+                    job["next_attempt_at"] = now + timedelta(seconds=delay)
+                    job["last_error"] = detail
+                    record_send_event("retried")
+                else:
+                    job["status"] = "FAILED"
+                    job["last_error"] = detail
+                    record_send_event("dropped")
+                    log_event(
+                        log, "outbox_failed", logging.WARNING,
+                        outbox_id=job["id"], method=job["method"], dest_chat=job["chat_id"],
+                        attempts=job["attempts"], error=detail[:200],
+                    )
+
+            save_outbox_results(db, jobs)
+            return attempted
+        finally:
+            db.close()
+
+    def drain(self, max_batches: int = 20) -> None:
+        """Tenta esvaziar o que já está vencido (usado no shutdown)."""
+        for _ in range(max_batches):
+            if self.run_once() == 0:
+                break
+
+
+outbox_worker = OutboxWorker()
@@ -0,0 +1,331 @@
+# easypcm/preventive.py
+"""
+Preventivas: planos (PreventivePlanRow) que geram OS recorrentes.
+
+O agendador guarda em memória um heap (proxima_em, org_id, plano) dos planos
+ativos. A carga completa acontece uma vez, na subida; depois cada varredura
+só lê os planos alterados desde a anterior (ix_preventive_plans_updated),
+então dezenas de milhares de planos não são relidos a cada volta. Entre
+varreduras ele dorme até o próximo vencimento ou PREVENTIVE_TICK_SEC, o que
+vier antes.
+
+Os vencidos saem do heap em lotes de PREVENTIVE_BATCH_SIZE: cada lote é uma
+transação (OS + avanço dos planos + aviso no outbox) seguida de pausa, como
+no arquivo (archive.py).
+
+Depois de um tempo parado, cada plano atrasado gera UMA OS (com a data em que
+estava prevista na descrição) e o próximo vencimento volta para a grade da
+regra, no primeiro horário depois de agora: não sai uma OS por período perdido.
+
+Em produção o serve.py roda o agendador no processo pai. Avulso (ex: cron):
+    python -m easypcm.preventive
+"""
+import argparse
+import calendar
+import heapq
+import logging
+import re
+import threading
+import time
+import unicodedata
+from datetime import date, datetime, timedelta, timezone
+
+from sqlalchemy.orm.exc import StaleDataError
+
+from .config import PREVENTIVE_BATCH_PAUSE_SEC, PREVENTIVE_BATCH_SIZE, PREVENTIVE_HOUR_UTC, PREVENTIVE_TICK_SEC
+from .db import SHARD_BY_ORG, SessionLocal, route_to_org, tenant_org_ids
+from .log import log_event
+from .notifications import notify_preventive_generated
+from .repository import generate_preventive_work_orders, get_preventive_plans, list_preventive_plan_changes
+from .ui_texts import TXT
+
+log = logging.getLogger("easypcm.preventive")
+
+RULE_DAYS = "DIAS"        # regra_valor = intervalo em dias
+RULE_WEEKLY = "SEMANAL"   # regra_valor = dia da semana (0 = segunda)
+RULE_MONTHLY = "MENSAL"   # regra_valor = dia do mês (31 = último dia nos meses curtos)
+
+_WEEKDAYS = ("seg", "ter", "qua", "qui", "sex", "sab", "dom")
+
+# a varredura relê um pouco antes da anterior: pega transações que gravaram
+# updated_at antes dela e só commitaram depois
+_SYNC_OVERLAP = timedelta(seconds=60)
+
+
+# ============================================================
+# REGRAS
+# ============================================================
+
+def _fold(text: str) -> str:
+    s = unicodedata.normalize("NFKD", str(text or ""))
+    s = "".join(ch for ch in s if not unicodedata.combining(ch)).lower()
+    return " ".join(s.split())
+
+
+def parse_rule(text: str) -> tuple[str, int] | None:
+    """"30 dias" / "30d", "diaria", "semanal SEG", "mensal 5" -> (regra, regra_valor)."""
+    t = _fold(text)
+    if t in ("diaria", "diario"):
+        return RULE_DAYS, 1
+    m = re.fullmatch(r"(?:a cada )?(\d+) ?d(?:ia|ias)?", t)
+    if m and 1 <= int(m.group(1)) <= 3650:
+        return RULE_DAYS, int(m.group(1))
+    m = re.fullmatch(r"semanal (?:de |na |no )?([a-z]{3})[a-z-]*", t)
+    if m and m.group(1) in _WEEKDAYS:
+        return RULE_WEEKLY, _WEEKDAYS.index(m.group(1))
+    m = re.fullmatch(r"mensal (?:dia )?(\d{1,2})", t)
+    if m and 1 <= int(m.group(1)) <= 31:
+        return RULE_MONTHLY, int(m.group(1))
+    return None
+
+
+def _at_hour(day: date) -> datetime:
+    return datetime(day.year, day.month, day.day, PREVENTIVE_HOUR_UTC, tzinfo=timezone.utc)
+
+
+def _as_utc(dt: datetime) -> datetime:
+    # o SQLite devolve datas sem fuso (gravadas em UTC)
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt.astimezone(timezone.utc)
+
+
+def next_due(regra: str, valor: int, anchor: datetime, after: datetime) -> datetime:
+    """
+    Primeiro vencimento da regra depois de `after`. DIAS conta a partir de
+    `anchor` (o vencimento anterior), então atrasos não empurram a grade.
+    """
+    if regra == RULE_DAYS:
+        period = timedelta(days=max(valor, 1))
+        if anchor > after:
+            return anchor
+        return anchor + period * ((after - anchor) // period + 1)
+
+    day = after.date()
+    while True:
+        if regra == RULE_WEEKLY:
+            hit = day.weekday() == valor
+        else:
+            hit = day.day == min(valor, calendar.monthrange(day.year, day.month)[1])
+        if hit and _at_hour(day) > after:
+            return _at_hour(day)
+        day += timedelta(days=1)
+
+
+def first_due(regra: str, valor: int, now: datetime) -> datetime:
+    """Primeiro vencimento de um plano novo."""
+    if regra == RULE_DAYS:
+        return _at_hour(now.date() + timedelta(days=max(valor, 1)))
+    return next_due(regra, valor, now, now)
+
+
+# ============================================================
+# AGENDADOR
+# ============================================================
+
+class PreventiveScheduler:
+    """
+    Fila dos próximos vencimentos: heap (proxima_em, org_id, plano) mais
+    _due {(org_id, plano): proxima_em} com o valor atual de cada plano.
+    Entrada do heap que não bate com _due (plano removido ou remarcado)
+    é descartada quando chega ao topo.
+    """
+
+    def __init__(
+        self,
+        session_factory=SessionLocal,
+        tick_sec: float = PREVENTIVE_TICK_SEC,
+        batch_size: int = PREVENTIVE_BATCH_SIZE,
+        pause: float = PREVENTIVE_BATCH_PAUSE_SEC,
+    ):
+        self._session_factory = session_factory
+        self.tick_sec = tick_sec
+        self.batch_size = batch_size
+        self.pause = pause
+        self._heap: list[tuple[datetime, int, int]] = []
+        self._due: dict[tuple[int, int], datetime] = {}
+        self._synced_at: dict[int | None, datetime] = {}  # por banco (empresa no modo por empresa)
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def _schedule(self, org_id: int, plan_id: int, active: bool, proxima_em: datetime | None) -> None:
+        key = (org_id, plan_id)
+        if not active or proxima_em is None:
+            self._due.pop(key, None)
+            return
+        due = _as_utc(proxima_em)
+        if self._due.get(key) == due:
+            return
+        self._due[key] = due
+        heapq.heappush(self._heap, (due, org_id, plan_id))
+
+    def sync(self) -> int:
+        """Lê os planos alterados desde a varredura anterior (na primeira, todos os ativos)."""
+        seen = 0
+        for shard in tenant_org_ids() if SHARD_BY_ORG else [None]:
+            started = datetime.now(timezone.utc)
+            since = self._synced_at.get(shard)
+            db = route_to_org(self._session_factory(), shard)
+            try:
+                rows = list_preventive_plan_changes(db, since - _SYNC_OVERLAP if since else None)
+            finally:
+                db.close()
+            for plan_id, org_id, active, proxima_em in rows:
+                self._schedule(org_id, plan_id, active, proxima_em)
+            self._synced_at[shard] = started
+            seen += len(rows)
+
+        # remarcações deixam entradas velhas no heap; refaz se passarem do dobro
+        if len(self._heap) > 2 * len(self._due) + 1000:
+            self._heap = [(due, org_id, plan_id) for (org_id, plan_id), due in self._due.items()]
+            heapq.heapify(self._heap)
+        return seen
+
+    def _pop_due(self, now: datetime) -> list[tuple[int, int, datetime]]:
+        batch = []
+        while self._heap and self._heap[0][0] <= now and len(batch) < self.batch_size:
+            due, org_id, plan_id = heapq.heappop(self._heap)
+            if self._due.get((org_id, plan_id)) != due:
+                continue
+            batch.append((org_id, plan_id, due))
+        return batch
+
+    def _generate(self, org_id: int, entries: list[tuple[int, int, datetime]], now: datetime) -> int:
+        """Uma transação: OS dos planos vencidos, avanço dos planos e aviso aos membros."""
+        due_by_plan = {plan_id: due for _, plan_id, due in entries}
+        db = route_to_org(self._session_factory(), org_id)
+        try:
+            plans = get_preventive_plans(db, list(due_by_plan))
+            scheduled: list[tuple[int, bool, datetime | None]] = []
+            to_generate = []
+            for plan in plans:
+                due = due_by_plan[plan.id]
+                if not plan.active or _as_utc(plan.proxima_em) != due:
+                    # alterado depois da última varredura: vale o que está no banco
+                    scheduled.append((plan.id, plan.active, plan.proxima_em))
+                    continue
+                proxima = next_due(plan.regra, plan.regra_valor, due, now)
+                late = due.date() < now.date()
+                descricao = TXT.preventive_problem(
+                    plan.tarefa, plan.checklist.splitlines(), due.strftime("%d/%m/%Y") if late else "",
+                )
+                to_generate.append((plan, descricao, proxima))
+                scheduled.append((plan.id, True, proxima))
+
+            work_orders = generate_preventive_work_orders(db, to_generate, now) if to_generate else []
+            alert_rows = [
+                (wo.id, wo.equipamento, wo.setor, plan.tarefa)
+                for wo, (plan, _, _) in zip(work_orders, to_generate)
+            ]
+            notify_preventive_generated(db, org_id, alert_rows)
+            db.commit()
+        except StaleDataError:
+            # outro agendador (ou /preventiva del) gravou o plano antes: relê
+            db.rollback()
+            log_event(log, "preventive_conflict", logging.WARNING, org_id=org_id, plans=len(entries))
+            for plan_id in due_by_plan:
+                self._due.pop((org_id, plan_id), None)  # já saíram do heap: _schedule põe de volta
+            for plan in get_preventive_plans(db, list(due_by_plan)):
+                self._schedule(org_id, plan.id, plan.active, plan.proxima_em)
+            return 0
+        except Exception:
+            db.rollback()
+            for _, plan_id, due in entries:
+                heapq.heappush(self._heap, (due, org_id, plan_id))  # tenta de novo na próxima volta
+            raise
+        finally:
+            db.close()
+
+        found = {plan_id for plan_id, _, _ in scheduled}
+        for plan_id in due_by_plan.keys() - found:
+            self._due.pop((org_id, plan_id), None)  # plano apagado do banco
+        for plan_id, active, proxima in scheduled:
+            self._schedule(org_id, plan_id, active, proxima)
+        return len(alert_rows)
+
+    def run_due(self, now: datetime | None = None) -> int:
+        """Gera as OS de tudo que venceu até now, lote a lote. Retorna quantas."""
+        now = now or datetime.now(timezone.utc)
+        t0 = time.perf_counter()
+        created = batches = 0
+        while not self._stop.is_set():
+            batch = self._pop_due(now)
+            if not batch:
+                break
+            by_org: dict[int, list[tuple[int, int, datetime]]] = {}
+            for entry in batch:
+                by_org.setdefault(entry[0], []).append(entry)
+            for org_id, entries in by_org.items():
+                created += self._generate(org_id, entries, now)
+            batches += 1
+            if self.pause and self._heap and self._heap[0][0] <= now:
+                time.sleep(self.pause)
+
+        if batches:
+            log_event(
+                log, "preventive_done",
+                created=created, batches=batches, plans=len(self._due),
+                ms=round((time.perf_counter() - t0) * 1000, 1),
+            )
+        return created
+
+    def _seconds_until_next(self) -> float:
+        wait = self.tick_sec
+        if self._heap:
+            wait = min(wait, (self._heap[0][0] - datetime.now(timezone.utc)).total_seconds())
+        return max(wait, 1.0)
+
+    def start(self) -> None:
+        if self.tick_sec <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="preventive-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        # interrompe entre lotes; o lote em andamento termina (ou desfaz) sozinho
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def is_alive(self) -> bool:
+        return bool(self._thread and self._thread.is_alive())
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.sync()
+                self.run_due()
+            except Exception:
+                log_event(log, "preventive_worker_error", logging.ERROR, exc_info=True)
+            self._stop.wait(self._seconds_until_next())
+
+
+preventive_worker = PreventiveScheduler()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Gera as OS das preventivas vencidas e sai")
+    parser.add_argument("--batch", type=int, default=PREVENTIVE_BATCH_SIZE, help="planos por transação")
+    parser.add_argument("--pause", type=float, default=PREVENTIVE_BATCH_PAUSE_SEC,
+                        help="segundos entre lotes (libera o lock de escrita)")
+    args = parser.parse_args()
+
+    from .db import init_db
+    from .log import setup_logging, stop_logging
+
+    setup_logging()
+    try:
+        init_db()
+        scheduler = PreventiveScheduler(batch_size=args.batch, pause=args.pause)
+        scheduler.sync()
+        created = scheduler.run_due()
+        print(f"{created} OS preventivas geradas ({len(scheduler)} planos ativos)")
+    finally:
+        stop_logging()
+
+
+if __name__ == "__main__":
+    main()
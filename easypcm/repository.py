@@ -1,16 +1,19 @@
 import json
 import secrets
 import string
+import time
 from datetime import datetime, timedelta, timezone
 
 from sqlalchemy.orm import Session
-from sqlalchemy import desc
+from sqlalchemy import bindparam, delete, desc, func, insert, select, text, update
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 
 from .models import (
     Event,
     ChatState,
     WorkOrderRow,
+    WorkOrderStatusHistoryRow,
     MaterialRow,
     TechnicianRow,
     WorkOrderTechnicianRow,
@@ -18,8 +21,16 @@ from .models import (
     UserRow,
     OrgUserRow,
     InviteRow,
+    OutboxMessageRow,
+    OrgCommitRow,
+    NotificationSubscriptionRow,
+    PreventivePlanRow,
+    OPEN_STATUS_SQL,
+    work_orders_archive,
+    materials_archive,
+    work_order_technicians_archive,
 )
-from .schemas import SEM_INFO
+from .schemas import SEM_INFO, normalize_equipamento, text_similarity
 
 
 # ============================================================
@@ -116,6 +127,15 @@ def get_user_role_in_org(db: Session, telegram_user_id: str, org_id: int) -> str
     return mem.role if mem else None
 
 
+def list_active_org_members(db: Session, org_id: int) -> list[OrgUserRow]:
+    return (
+        db.query(OrgUserRow)
+        .filter(OrgUserRow.org_id == org_id, OrgUserRow.active == True)
+        .order_by(OrgUserRow.id.asc())
+        .all()
+    )
+
+
 def _generate_invite_token() -> str:
     # Formato amigável: INV-XXXXXX
     alphabet = string.ascii_uppercase + string.digits
@@ -220,6 +240,50 @@ def consume_invite(db: Session, token: str, telegram_user_id: str) -> tuple[bool
     return (True, "Entrada na empresa confirmada.", inv.org_id, inv.role_to_grant)
 
 
+# ============================================================
+# ASSINATURAS DE ALERTA
+# ============================================================
+
+def list_notification_subscriptions(db: Session, org_id: int, event: str) -> list[NotificationSubscriptionRow]:
+    return (
+        db.query(NotificationSubscriptionRow)
+        .filter(
+            NotificationSubscriptionRow.org_id == org_id,
+            NotificationSubscriptionRow.event == event,
+            NotificationSubscriptionRow.active == True,
+        )
+        .order_by(NotificationSubscriptionRow.id.asc())
+        .all()
+    )
+
+
+def add_notification_subscription(db: Session, org_id: int, event: str, role: str, setor: str) -> NotificationSubscriptionRow:
+    sub = NotificationSubscriptionRow(
+        org_id=org_id,
+        event=event,
+        role=(role or "").strip(),
+        setor=(setor or "").strip(),
+        active=True,
+    )
+    db.add(sub)
+    db.commit()
+    db.refresh(sub)
+    return sub
+
+
+def remove_notification_subscription(db: Session, org_id: int, sub_id: int) -> bool:
+    sub = (
+        db.query(NotificationSubscriptionRow)
+        .filter(NotificationSubscriptionRow.org_id == org_id, NotificationSubscriptionRow.id == sub_id)
+        .first()
+    )
+    if not sub or not sub.active:
+        return False
+    sub.active = False
+    db.commit()
+    return True
+
+
 # ============================================================
 # CHAT STATE
 # ============================================================
@@ -243,7 +307,7 @@ def set_state(db: Session, st: ChatState, mode: str, step: str = "", os_id: int
     return st
 
 
-def clear_state(db: Session, st: ChatState) -> ChatState:
+def clear_state(db: Session, st: ChatState, commit: bool = True) -> ChatState:
     st.mode = "IDLE"
     st.step = ""
     st.os_id = None
@@ -263,46 +327,249 @@ def clear_state(db: Session, st: ChatState) -> ChatState:
 
     st.temp_status = ""
     st.temp_status_obs = ""
+    st.temp_os_version = None
+    st.temp_lote = ""
 
-    db.commit()
-    db.refresh(st)
+    if commit:
+        db.commit()
+        db.refresh(st)
     return st
 
 
+# colunas que o registro do commit não copia (identidade/controle do próprio catálogo)
+_ORG_COMMIT_SKIP = ("id", "chat_id", "version", "updated_at", "org_commit")
+
+
+def record_org_commit(db: Session, org_conn, outbox: list) -> None:
+    """
+    Modo por empresa: grava em org_commits, pela conexão do banco da empresa
+    (na transação das OS), o estado do chat e as chamadas do outbox deste
+    commit, e marca o estado do chat com o token. Chamado pelo
+    db.WriteSession antes de commitar a empresa; o token vai para o catálogo
+    no commit seguinte. Sessão sem um único chat (ex: agendador) não grava.
+    """
+    states = [obj for obj in db.identity_map.values() if isinstance(obj, ChatState)]
+    if len(states) != 1:
+        return
+    st = states[0]
+    token = secrets.token_hex(16)
+    snapshot = {
+        c.key: getattr(st, c.key) for c in ChatState.__table__.columns if c.key not in _ORG_COMMIT_SKIP
+    }
+    org_conn.execute(
+        insert(OrgCommitRow),
+        {
+            "chat_id": st.chat_id,
+            "token": token,
+            "prev_token": st.org_commit or "",
+            "chat_state": json.dumps(snapshot, ensure_ascii=False),
+            "outbox": json.dumps(outbox, ensure_ascii=False),
+        },
+    )
+    st.org_commit = token
+
+
+def recover_org_commit(db: Session, st: ChatState) -> bool:
+    """
+    Modo por empresa, com a sessão já roteada: se um commit deste chat gravou
+    no banco da empresa e o do catálogo se perdeu, reaplica o estado do chat
+    e reenfileira as chamadas (a resposta do update que se perdeu) e faz
+    commit. Retorna True se reaplicou.
+    """
+    rec = (
+        db.query(OrgCommitRow)
+        .filter(OrgCommitRow.chat_id == st.chat_id, OrgCommitRow.prev_token == (st.org_commit or ""))
+        .order_by(desc(OrgCommitRow.id))
+        .first()
+    )
+    if rec is None:
+        return False
+    for key, value in json.loads(rec.chat_state).items():
+        setattr(st, key, value)
+    st.org_commit = rec.token
+    now = datetime.now(timezone.utc)
+    for chat_id, method, payload, priority in json.loads(rec.outbox):
+        db.add(OutboxMessageRow(
+            chat_id=chat_id, method=method, payload=payload, priority=priority,
+            status="PENDING", attempts=0, next_attempt_at=now, last_error="",
+        ))
+    db.commit()
+    return True
+
+
 # ============================================================
 # WORK ORDERS (AGORA POR ORG_ID)
 # ============================================================
 
-def create_open_work_order(
+class WorkOrderConflict(ValueError):
+    """A OS foi gravada por outra pessoa depois de escolhida (versão mudou)."""
+
+    def __init__(self, os_id: int):
+        super().__init__(f"OS {os_id} alterada por outra operação.")
+        self.os_id = os_id
+
+
+class ArchiveConflict(ValueError):
+    """OS do lote já tem id no arquivo (id reaproveitado antes do AUTOINCREMENT): não move nada do lote."""
+
+    def __init__(self, os_ids: list[int], last_id: int):
+        super().__init__(f"OS já presentes no arquivo: {os_ids[:20]}")
+        self.os_ids = os_ids
+        self.last_id = last_id
+
+
+class DuplicateWorkOrder(ValueError):
+    """Já existe OS aberta do mesmo equipamento com problema parecido."""
+
+    def __init__(self, work_order: WorkOrderRow, similarity: float):
+        super().__init__(f"Possível duplicata da OS {work_order.id}.")
+        self.work_order = work_order
+        self.similarity = similarity
+
+
+def _save_work_order(db: Session, wo: WorkOrderRow, os_id: int, commit: bool) -> None:
+    """
+    Grava a OS com compare-and-swap na coluna version (UPDATE ... WHERE
+    version = lida): se outra transação gravou antes, nada muda e vira conflito.
+    """
+    try:
+        db.flush()
+    except StaleDataError:
+        raise WorkOrderConflict(os_id)
+    if commit:
+        db.commit()
+        db.refresh(wo)
+
+
+def _check_version(wo: WorkOrderRow, expected_version: int | None) -> None:
+    # expected_version: versão de quando o usuário escolheu a OS no seletor
+    if expected_version is not None and wo.version != expected_version:
+        raise WorkOrderConflict(wo.id)
+
+
+def find_duplicate_open_work_order(
     db: Session,
+    org_id: int,
+    equipamento: str,
+    problema: str,
+    min_similarity: float,
+    limit: int = 50,
+) -> tuple[WorkOrderRow, float] | None:
+    """
+    OS aberta do mesmo equipamento (equipamento_norm) cujo problema mais se
+    parece com o informado, se passar de min_similarity. As candidatas vêm do
+    índice parcial de OS abertas por equipamento (poucas linhas, mesmo com
+    milhares de OS abertas na empresa); a similaridade é calculada aqui.
+    """
+    candidates = (
+        db.query(WorkOrderRow)
+        .filter(
+            WorkOrderRow.org_id == org_id,
+            WorkOrderRow.equipamento_norm == normalize_equipamento(equipamento),
+            text(OPEN_STATUS_SQL),
+        )
+        .order_by(desc(WorkOrderRow.id))
+        .limit(limit)
+        .all()
+    )
+    best = None
+    for wo in candidates:
+        sim = text_similarity(problema, wo.descricao_do_problema)
+        if sim >= min_similarity and (best is None or sim > best[1]):
+            best = (wo, sim)
+    return best
+
+
+def _new_work_order(
     org_id: int,
     chat_id: str,
     equipamento: str,
     setor: str,
     problema: str,
     maquina_parada: str,
+    tipo_manutencao: str = "CORRETIVA",
+    plano_id: int | None = None,
 ) -> WorkOrderRow:
-    wo = WorkOrderRow(
+    return WorkOrderRow(
         org_id=org_id,
         chat_id=chat_id,  # chat privado de quem abriu (registro)
         equipamento=(equipamento or SEM_INFO),
+        equipamento_norm=normalize_equipamento(equipamento or SEM_INFO),
         setor=(setor or SEM_INFO),
         descricao_do_problema=(problema or SEM_INFO),
         maquina_parada=(maquina_parada or SEM_INFO),
         status="ABERTA",
         source_text="",
+        tipo_manutencao=tipo_manutencao,
+        plano_id=plano_id,
     )
+
+
+def create_open_work_order(
+    db: Session,
+    org_id: int,
+    chat_id: str,
+    equipamento: str,
+    setor: str,
+    problema: str,
+    maquina_parada: str,
+    commit: bool = True,
+    dup_min_similarity: float | None = None,
+) -> WorkOrderRow:
+    """
+    dup_min_similarity: se informado, antes de criar procura OS aberta parecida
+    (find_duplicate_open_work_order) e levanta DuplicateWorkOrder sem gravar nada.
+    """
+    if dup_min_similarity is not None:
+        dup = find_duplicate_open_work_order(db, org_id, equipamento, problema, dup_min_similarity)
+        if dup:
+            raise DuplicateWorkOrder(*dup)
+
+    wo = _new_work_order(org_id, chat_id, equipamento, setor, problema, maquina_parada)
     db.add(wo)
-    db.commit()
-    db.refresh(wo)
+    if commit:
+        db.commit()
+        db.refresh(wo)
+    else:
+        db.flush()  # garante wo.id
     return wo
 
 
-def list_open_work_orders(db: Session, org_id: int, limit: int = 10) -> list[WorkOrderRow]:
+def attach_report_to_work_order(
+    db: Session,
+    org_id: int,
+    os_id: int,
+    problema: str,
+    maquina_parada: str,
+    commit: bool = True,
+    expected_version: int | None = None,
+) -> tuple[WorkOrderRow, bool]:
+    """
+    Anexa um novo relato a uma OS aberta (em vez de abrir duplicata): o problema
+    entra na descrição e, se o novo relato diz máquina parada, a OS passa a SIM.
+    Retorna (OS, se a máquina passou a constar como parada agora).
+    """
+    wo = get_work_order(db, org_id, os_id)
+    if not wo:
+        raise ValueError("OS não encontrada.")
+    _check_version(wo, expected_version)
+
+    if problema and problema != SEM_INFO:
+        wo.descricao_do_problema = f"{wo.descricao_do_problema}\n+ {problema}"
+    became_down = maquina_parada == "SIM" and wo.maquina_parada != "SIM"
+    if became_down:
+        wo.maquina_parada = "SIM"
+
+    _save_work_order(db, wo, os_id, commit)
+    return wo, became_down
+
+
+def list_open_work_orders(db: Session, org_id: int, limit: int = 10, offset: int = 0) -> list[WorkOrderRow]:
     return (
         db.query(WorkOrderRow)
         .filter(WorkOrderRow.org_id == org_id, WorkOrderRow.status.notin_(["FECHADA", "CANCELADA"]))
         .order_by(desc(WorkOrderRow.id))
+        .offset(offset)
         .limit(limit)
         .all()
     )
@@ -316,13 +583,146 @@ def get_work_order(db: Session, org_id: int, os_id: int) -> WorkOrderRow | None:
     )
 
 
-def add_materials(db: Session, os_id: int, materiais: list[str]) -> None:
+def get_work_orders(db: Session, org_id: int, os_ids: list[int]) -> list[WorkOrderRow]:
+    """OS da empresa com esses ids numa consulta só, na ordem de os_ids (as que não existem ficam de fora)."""
+    if not os_ids:
+        return []
+    rows = (
+        db.query(WorkOrderRow)
+        .filter(WorkOrderRow.org_id == org_id, WorkOrderRow.id.in_(os_ids))
+        .all()
+    )
+    by_id = {wo.id: wo for wo in rows}
+    return [by_id[os_id] for os_id in os_ids if os_id in by_id]
+
+
+def list_equipment_history(db: Session, org_id: int, equipamento: str, limit: int = 10) -> list[WorkOrderRow]:
+    """
+    Últimas OS (abertas e fechadas) do mesmo equipamento, mais recentes primeiro.
+    Percorre só o índice (org_id, equipamento_norm, abertura_em): o custo é o
+    do limite, não o do tamanho do histórico.
+    """
+    norm = normalize_equipamento(equipamento)
+    hot = (
+        db.query(WorkOrderRow)
+        .filter(
+            WorkOrderRow.org_id == org_id,
+            WorkOrderRow.equipamento_norm == norm,
+        )
+        .order_by(desc(WorkOrderRow.abertura_em))
+        .limit(limit)
+        .all()
+    )
+    # mesmo índice (org_id, equipamento_norm, abertura_em) no arquivo
+    cold = db.execute(
+        _archived_query(org_id)
+        .where(work_orders_archive.c.equipamento_norm == norm)
+        .order_by(desc(work_orders_archive.c.abertura_em))
+        .limit(limit)
+    ).all()
+    return _merge_tiers(hot, cold, key=lambda w: w.abertura_em or datetime.min, limit=limit)
+
+
+def backfill_equipamento_norm(db: Session, batch_size: int = 1000) -> int:
+    """
+    Preenche equipamento_norm das OS gravadas antes da coluna existir, em lotes
+    (um commit por lote). Não mexe em version: é dado derivado. Retorna quantas.
+    """
+    table = WorkOrderRow.__table__
+    stmt = (
+        update(table)
+        .where(table.c.id == bindparam("_id"))
+        .values(equipamento_norm=bindparam("_norm"))
+    )
+    total = 0
+    last_id = 0
+    while True:
+        rows = (
+            db.query(WorkOrderRow.id, WorkOrderRow.equipamento)
+            .filter(WorkOrderRow.equipamento_norm == "", WorkOrderRow.id > last_id)
+            .order_by(WorkOrderRow.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            return total
+        params = [{"_id": r[0], "_norm": normalize_equipamento(r[1])} for r in rows]
+        db.execute(stmt, params)
+        db.commit()
+        total += len(rows)
+        last_id = rows[-1][0]
+
+
+def get_work_order_version(db: Session, org_id: int, os_id: int) -> int | None:
+    """Só a versão da OS (leitura mínima, para validar caches)."""
+    row = (
+        db.query(WorkOrderRow.version)
+        .filter(WorkOrderRow.org_id == org_id, WorkOrderRow.id == os_id)
+        .first()
+    )
+    if row is None:
+        row = db.execute(
+            _archived_query(org_id, work_orders_archive.c.version)
+            .where(work_orders_archive.c.id == os_id)
+        ).first()
+    return row[0] if row else None
+
+
+def search_work_orders(
+    db: Session,
+    org_id: int,
+    equipamento: str = "",
+    status: str = "",
+    limit: int = 10,
+) -> list[WorkOrderRow]:
+    """OS da empresa (abertas e fechadas) por trecho do equipamento e/ou status, mais recentes primeiro."""
+    q = db.query(WorkOrderRow).filter(WorkOrderRow.org_id == org_id)
+    cold = _archived_query(org_id)
+    if equipamento:
+        termo = equipamento.strip().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        q = q.filter(WorkOrderRow.equipamento.ilike(f"%{termo}%", escape="\\"))
+        cold = cold.where(work_orders_archive.c.equipamento.ilike(f"%{termo}%", escape="\\"))
+    if status:
+        q = q.filter(WorkOrderRow.status == status)
+        cold = cold.where(work_orders_archive.c.status == status)
+    hot = q.order_by(desc(WorkOrderRow.id)).limit(limit).all()
+    if status and status not in ARCHIVED_STATUSES:
+        return hot  # OS abertas nunca vão para o arquivo
+    cold = db.execute(cold.order_by(desc(work_orders_archive.c.id)).limit(limit)).all()
+    return _merge_tiers(hot, cold, key=lambda w: w.id, limit=limit)
+
+
+def get_work_order_card(db: Session, org_id: int, os_id: int) -> tuple[WorkOrderRow, list[str], list[str]] | None:
+    """
+    OS + técnicos + peças numa consulta só (LEFT JOINs), em vez de
+    get_work_order + list_technicians_for_os + list_materials.
+    Retorna (os, técnicos em ordem alfabética, peças mais recentes primeiro).
+    """
+    rows = (
+        db.query(WorkOrderRow, TechnicianRow.nome, MaterialRow.id, MaterialRow.descricao)
+        .outerjoin(WorkOrderTechnicianRow, WorkOrderTechnicianRow.work_order_id == WorkOrderRow.id)
+        .outerjoin(TechnicianRow, TechnicianRow.id == WorkOrderTechnicianRow.technician_id)
+        .outerjoin(MaterialRow, MaterialRow.work_order_id == WorkOrderRow.id)
+        .filter(WorkOrderRow.org_id == org_id, WorkOrderRow.id == os_id)
+        .all()
+    )
+    if not rows:
+        return _get_archived_work_order_card(db, org_id, os_id)
+
+    # o join repete cada técnico por peça (e vice-versa): desfaz o produto aqui
+    tecnicos = sorted({nome for _, nome, _, _ in rows if nome})
+    materiais = {mat_id: descricao for _, _, mat_id, descricao in rows if mat_id is not None}
+    return rows[0][0], tecnicos, [materiais[i] for i in sorted(materiais, reverse=True)]
+
+
+def add_materials(db: Session, os_id: int, materiais: list[str], commit: bool = True) -> None:
     for m in materiais:
         desc_txt = (m or "").strip()
         if not desc_txt:
             continue
         db.add(MaterialRow(work_order_id=os_id, descricao=desc_txt))
-    db.commit()
+    if commit:
+        db.commit()
 
 
 def list_materials(db: Session, os_id: int) -> list[MaterialRow]:
@@ -334,7 +734,7 @@ def list_materials(db: Session, os_id: int) -> list[MaterialRow]:
     )
 
 
-def _get_or_create_technician(db: Session, nome: str) -> TechnicianRow:
+def _get_or_create_technician(db: Session, nome: str, commit: bool = True) -> TechnicianRow:
     nome_norm = (nome or "").strip()
     if not nome_norm:
         raise ValueError("Nome de técnico vazio.")
@@ -347,19 +747,22 @@ def _get_or_create_technician(db: Session, nome: str) -> TechnicianRow:
 
     tech = TechnicianRow(nome=nome_norm)
     db.add(tech)
-    db.commit()
-    db.refresh(tech)
+    if commit:
+        db.commit()
+        db.refresh(tech)
+    else:
+        db.flush()  # garante tech.id sem fechar a transação
     return tech
 
 
-def add_technicians_to_os(db: Session, os_id: int, nomes: list[str]) -> list[str]:
+def add_technicians_to_os(db: Session, os_id: int, nomes: list[str], commit: bool = True) -> list[str]:
     saved_names: list[str] = []
     for nome in nomes:
         nome_clean = (nome or "").strip()
         if not nome_clean:
             continue
 
-        tech = _get_or_create_technician(db, nome_clean)
+        tech = _get_or_create_technician(db, nome_clean, commit=commit)
 
         exists = (
             db.query(WorkOrderTechnicianRow)
@@ -371,10 +774,13 @@ def add_technicians_to_os(db: Session, os_id: int, nomes: list[str]) -> list[str
         )
         if not exists:
             db.add(WorkOrderTechnicianRow(work_order_id=os_id, technician_id=tech.id))
+            if not commit:
+                db.flush()  # evita vínculo duplicado se o nome se repetir na lista
 
         saved_names.append(tech.nome)
 
-    db.commit()
+    if commit:
+        db.commit()
     return saved_names
 
 
@@ -389,6 +795,59 @@ def list_technicians_for_os(db: Session, os_id: int) -> list[str]:
     return [r[0] for r in rows]
 
 
+def _utc_naive(dt: datetime) -> datetime:
+    # o SQLite devolve datas sem fuso (gravadas em UTC); compara tudo assim
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def _record_status_change(db: Session, wo: WorkOrderRow, new_status: str, observacao: str, at: datetime) -> None:
+    """
+    Grava na mesma transação a troca de status (antes de alterar wo.status).
+    O início do status atual é a última troca desta OS ou, se não houver, a abertura;
+    status_updated_at não serve (muda em qualquer gravação da OS).
+    """
+    if new_status == wo.status:
+        return
+
+    last_change = (
+        db.query(func.max(WorkOrderStatusHistoryRow.changed_at))
+        .filter(WorkOrderStatusHistoryRow.work_order_id == wo.id)
+        .scalar()
+    )
+    since = _utc_naive(last_change or wo.abertura_em or at)
+    at = _utc_naive(at)
+    db.add(WorkOrderStatusHistoryRow(
+        org_id=wo.org_id,
+        work_order_id=wo.id,
+        setor=wo.setor,
+        from_status=wo.status,
+        to_status=new_status,
+        from_since=since,
+        changed_at=at,
+        duration_sec=max(0, int((at - since).total_seconds())),
+        observacao=(observacao or "").strip(),
+    ))
+
+
+def status_time_report(db: Session, org_id: int, since: datetime) -> list[tuple[str, str, int, int, int]]:
+    """
+    Tempo em cada status por setor, para as trocas desde `since`, numa consulta
+    agregada (coberta por ix_status_hist_report). Só intervalos já encerrados.
+    Retorna (status, setor, quantidade, soma_seg, max_seg), maior soma primeiro.
+    """
+    h = WorkOrderStatusHistoryRow
+    rows = (
+        db.query(h.from_status, h.setor, func.count(), func.sum(h.duration_sec), func.max(h.duration_sec))
+        .filter(h.org_id == org_id, h.changed_at >= _utc_naive(since))
+        .group_by(h.from_status, h.setor)
+        .order_by(desc(func.sum(h.duration_sec)))
+        .all()
+    )
+    return [(r[0], r[1], int(r[2]), int(r[3] or 0), int(r[4] or 0)) for r in rows]
+
+
 def close_work_order(
     db: Session,
     org_id: int,
@@ -397,10 +856,16 @@ def close_work_order(
     tempo_min: int,
     custo_pecas: str,
     fechamento_em: datetime | None = None,
+    commit: bool = True,
+    expected_version: int | None = None,
 ) -> WorkOrderRow:
     wo = get_work_order(db, org_id, os_id)
     if not wo:
         raise ValueError("OS não encontrada.")
+    _check_version(wo, expected_version)
+
+    # o intervalo do último status acaba agora (quando foi registrado), não na data de execução informada
+    _record_status_change(db, wo, "FECHADA", "", datetime.now(timezone.utc))
 
     wo.solucao_aplicada = solucao or SEM_INFO
     wo.tempo_gasto_minutos = str(tempo_min)
@@ -409,8 +874,7 @@ def close_work_order(
     # use provided date or fallback to now
     wo.fechamento_em = fechamento_em or datetime.now(timezone.utc)
 
-    db.commit()
-    db.refresh(wo)
+    _save_work_order(db, wo, os_id, commit)
     return wo
 
 
@@ -420,15 +884,455 @@ def update_work_order_status(
     os_id: int,
     status: str,
     observacao: str,
+    commit: bool = True,
+    expected_version: int | None = None,
 ) -> WorkOrderRow:
     wo = get_work_order(db, org_id, os_id)
     if not wo:
         raise ValueError("OS não encontrada.")
+    _check_version(wo, expected_version)
+
+    now = datetime.now(timezone.utc)
+    _record_status_change(db, wo, status, observacao, now)
 
     wo.status = status
     wo.status_observacao = (observacao or "").strip()
-    wo.status_updated_at = datetime.now(timezone.utc)
+    wo.status_updated_at = now
+
+    _save_work_order(db, wo, os_id, commit)
+    return wo
+
+
+# ============================================================
+# PREVENTIVAS (planos e geração das OS)
+# ============================================================
+
+def create_preventive_plan(
+    db: Session,
+    org_id: int,
+    equipamento: str,
+    setor: str,
+    tarefa: str,
+    checklist: list[str],
+    regra: str,
+    regra_valor: int,
+    proxima_em: datetime,
+    created_by_user_id: str = "",
+) -> PreventivePlanRow:
+    plan = PreventivePlanRow(
+        org_id=org_id,
+        equipamento=(equipamento or SEM_INFO),
+        setor=(setor or SEM_INFO),
+        tarefa=(tarefa or "").strip(),
+        checklist="\n".join(i.strip() for i in checklist if i.strip()),
+        regra=regra,
+        regra_valor=regra_valor,
+        proxima_em=proxima_em,
+        active=True,
+        created_by_user_id=str(created_by_user_id or ""),
+    )
+    db.add(plan)
+    db.commit()
+    db.refresh(plan)
+    return plan
+
+
+def list_preventive_plans(db: Session, org_id: int, limit: int = 20) -> list[PreventivePlanRow]:
+    """Planos ativos da empresa, próximos vencimentos primeiro."""
+    return (
+        db.query(PreventivePlanRow)
+        .filter(PreventivePlanRow.org_id == org_id, PreventivePlanRow.active == True)
+        .order_by(PreventivePlanRow.proxima_em.asc(), PreventivePlanRow.id.asc())
+        .limit(limit)
+        .all()
+    )
+
+
+def count_preventive_plans(db: Session, org_id: int) -> int:
+    return (
+        db.query(func.count(PreventivePlanRow.id))
+        .filter(PreventivePlanRow.org_id == org_id, PreventivePlanRow.active == True)
+        .scalar()
+    )
+
+
+def deactivate_preventive_plan(db: Session, org_id: int, plan_id: int) -> bool:
+    plan = (
+        db.query(PreventivePlanRow)
+        .filter(PreventivePlanRow.org_id == org_id, PreventivePlanRow.id == plan_id)
+        .first()
+    )
+    if not plan or not plan.active:
+        return False
+    plan.active = False
+    db.commit()
+    return True
+
+
+def list_preventive_plan_changes(db: Session, since: datetime | None) -> list[tuple[int, int, bool, datetime]]:
+    """
+    (id, org_id, active, proxima_em) dos planos alterados desde `since`
+    (ix_preventive_plans_updated). since=None: todos os ativos (carga inicial).
+    """
+    p = PreventivePlanRow
+    q = db.query(p.id, p.org_id, p.active, p.proxima_em)
+    if since is None:
+        q = q.filter(p.active == True)
+    else:
+        q = q.filter(p.updated_at >= _utc_naive(since))
+    return [tuple(row) for row in q.yield_per(5000)]
+
+
+def get_preventive_plans(db: Session, plan_ids: list[int]) -> list[PreventivePlanRow]:
+    if not plan_ids:
+        return []
+    return db.query(PreventivePlanRow).filter(PreventivePlanRow.id.in_(plan_ids)).all()
+
+
+def generate_preventive_work_orders(
+    db: Session,
+    due: list[tuple[PreventivePlanRow, str, datetime]],
+    at: datetime,
+) -> list[WorkOrderRow]:
+    """
+    Abre as OS de um lote de planos vencidos e avança cada plano, sem commit.
+    due = [(plano, descrição da OS, próximo vencimento), ...]. Um flush só
+    para as OS (INSERT em lote). Dois agendadores no mesmo plano: o commit do
+    segundo falha na versão do plano (StaleDataError) e nada do lote é gravado.
+    """
+    work_orders = [
+        _new_work_order(plan.org_id, "", plan.equipamento, plan.setor, descricao, "NÃO", "PREVENTIVA", plan.id)
+        for plan, descricao, _ in due
+    ]
+    db.add_all(work_orders)
+    db.flush()  # ids das OS
+
+    for (plan, _, proxima_em), wo in zip(due, work_orders):
+        plan.ultima_os_id = wo.id
+        plan.ultima_em = at
+        plan.proxima_em = proxima_em
+    return work_orders
+
+
+# ============================================================
+# ARQUIVO (OS fechadas antigas, tabelas *_archive)
+# ============================================================
+
+# só estes status vão para o arquivo (o contrário de OPEN_STATUS_SQL)
+ARCHIVED_STATUSES = ("FECHADA", "CANCELADA")
+
+
+def _archived_query(org_id: int, *columns):
+    return select(*(columns or (work_orders_archive,))).where(work_orders_archive.c.org_id == org_id)
+
+
+def _merge_tiers(hot: list, cold: list, key, limit: int) -> list:
+    # cada lista já vem ordenada (desc) e limitada; o resultado junta as duas
+    return sorted([*hot, *cold], key=key, reverse=True)[:limit]
+
+
+def get_archived_work_order(db: Session, org_id: int, os_id: int):
+    """OS do arquivo (linha só leitura, mesmos atributos de WorkOrderRow) ou None."""
+    return db.execute(_archived_query(org_id).where(work_orders_archive.c.id == os_id)).first()
+
+
+def _get_archived_work_order_card(db: Session, org_id: int, os_id: int):
+    wo = get_archived_work_order(db, org_id, os_id)
+    if wo is None:
+        return None
+    tecnicos = db.execute(
+        select(TechnicianRow.nome)
+        .join(work_order_technicians_archive, work_order_technicians_archive.c.technician_id == TechnicianRow.id)
+        .where(work_order_technicians_archive.c.work_order_id == os_id)
+        .order_by(TechnicianRow.nome)
+    ).scalars().all()
+    materiais = db.execute(
+        select(materials_archive.c.descricao)
+        .where(materials_archive.c.work_order_id == os_id)
+        .order_by(desc(materials_archive.c.id))
+    ).scalars().all()
+    return wo, sorted(set(tecnicos)), list(materiais)
+
+
+def archive_closed_work_orders(
+    db: Session,
+    older_than: datetime,
+    batch_size: int = 500,
+    after_id: int = 0,
+) -> tuple[int, int]:
+    """
+    Move um lote de OS fechadas/canceladas antes de older_than (data de
+    fechamento; sem ela, a da última troca de status) para as tabelas
+    *_archive, com peças e técnicos, numa transação só: cópia + DELETE.
+
+    Percorre por id (after_id = último id visto no lote anterior) para não
+    reler as OS que ainda não venceram. Retorna (movidas, último id visto);
+    movidas == 0 e último id == after_id: acabou.
+    O histórico de status (work_order_status_history) fica onde está.
+
+    Id da OS que já existe no arquivo é ArchiveConflict (nada do lote é
+    movido; last_id diz onde continuar): copiar por cima misturaria duas OS.
+    """
+    cutoff = _utc_naive(older_than)
+    ids = db.execute(
+        select(WorkOrderRow.id)
+        .where(WorkOrderRow.id > after_id, WorkOrderRow.status.in_(ARCHIVED_STATUSES))
+        .order_by(WorkOrderRow.id)
+        .limit(batch_size)
+    ).scalars().all()
+    if not ids:
+        return 0, after_id
+
+    hot = WorkOrderRow.__table__
+    due = select(hot.c.id).where(
+        hot.c.id.in_(ids),
+        func.coalesce(hot.c.fechamento_em, hot.c.status_updated_at) < cutoff,
+    )
+    due_ids = db.execute(due).scalars().all()
+    if not due_ids:
+        return 0, ids[-1]
+
+    clash = db.execute(
+        select(work_orders_archive.c.id).where(work_orders_archive.c.id.in_(due_ids))
+    ).scalars().all()
+    if clash:
+        raise ArchiveConflict(list(clash), ids[-1])
+
+    try:
+        for src, dst, fk in (
+            (hot, work_orders_archive, hot.c.id),
+            (MaterialRow.__table__, materials_archive, MaterialRow.__table__.c.work_order_id),
+            (WorkOrderTechnicianRow.__table__, work_order_technicians_archive,
+             WorkOrderTechnicianRow.__table__.c.work_order_id),
+        ):
+            names = [c.name for c in dst.columns]
+            db.execute(insert(dst).from_select(names, select(*(src.c[n] for n in names)).where(fk.in_(due_ids))))
+
+        # filhos antes da OS (FKs)
+        db.execute(delete(WorkOrderTechnicianRow.__table__).where(WorkOrderTechnicianRow.work_order_id.in_(due_ids)))
+        db.execute(delete(MaterialRow.__table__).where(MaterialRow.work_order_id.in_(due_ids)))
+        db.execute(delete(hot).where(hot.c.id.in_(due_ids)))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return len(due_ids), ids[-1]
+
+
+# ============================================================
+# OUTBOX (mensagens de saída)
+# ============================================================
+
+def enqueue_outbox(
+    db: Session,
+    chat_id: str,
+    method: str,
+    payload: dict,
+    not_before: datetime | None = None,
+) -> OutboxMessageRow:
+    """
+    Adiciona a chamada do Bot API à sessão SEM commit: ela é gravada
+    junto com a mudança de estado que o chamador commitar.
+    """
+    row = OutboxMessageRow(
+        chat_id=str(chat_id),
+        method=method,
+        payload=json.dumps(payload, ensure_ascii=False),
+        priority=0,
+        status="PENDING",
+        attempts=0,
+        next_attempt_at=not_before or datetime.now(timezone.utc),
+        last_error="",
+    )
+    db.add(row)
+    return row
+
+
+def enqueue_outbox_bulk(db: Session, method: str, payloads: list[tuple[str, dict]], priority: int = 1) -> int:
+    """
+    Enfileira muitas chamadas de uma vez (INSERT em lote, sem commit).
+    payloads = [(chat_id, payload), ...]. Usado no fan-out de alertas.
+    """
+    if not payloads:
+        return 0
+    now = datetime.now(timezone.utc)
+    rows = [
+        {
+            "chat_id": str(chat_id),
+            "method": method,
+            "payload": json.dumps(payload, ensure_ascii=False),
+            "priority": priority,
+            "status": "PENDING",
+            "attempts": 0,
+            "next_attempt_at": now,
+            "last_error": "",
+        }
+        for chat_id, payload in payloads
+    ]
+    db.execute(insert(OutboxMessageRow), rows)
+    # INSERT direto não passa pelo flush: entra no registro do db.WriteSession aqui
+    db.info.setdefault("tx_outbox", []).extend(
+        [r["chat_id"], method, r["payload"], priority] for r in rows
+    )
+    return len(payloads)
+
+
+def fetch_due_outbox(db: Session, limit: int = 50) -> list[OutboxMessageRow]:
+    now = datetime.now(timezone.utc)
+    return (
+        db.query(OutboxMessageRow)
+        .filter(OutboxMessageRow.status == "PENDING", OutboxMessageRow.next_attempt_at <= now)
+        # respostas aos usuários passam na frente dos alertas em massa
+        .order_by(OutboxMessageRow.priority.asc(), OutboxMessageRow.id.asc())
+        .limit(limit)
+        .all()
+    )
+
+
+def claim_due_outbox(db: Session, limit: int = 50, lease_sec: float = 60.0) -> list[OutboxMessageRow]:
+    """
+    Reserva (e faz commit) um lote de mensagens vencidas para ESTE worker.
+    A reserva empurra next_attempt_at para frente (lease): outros processos
+    não as veem como vencidas e, se este cair, elas voltam sozinhas depois.
+    """
+    ids = [r.id for r in fetch_due_outbox(db, limit=limit)]
+    if not ids:
+        db.rollback()
+        return []
+
+    now = datetime.now(timezone.utc)
+    token = secrets.token_hex(8)
+    (
+        db.query(OutboxMessageRow)
+        .filter(
+            OutboxMessageRow.id.in_(ids),
+            OutboxMessageRow.status == "PENDING",
+            OutboxMessageRow.next_attempt_at <= now,
+        )
+        .update(
+            {
+                OutboxMessageRow.next_attempt_at: now + timedelta(seconds=lease_sec),
+                OutboxMessageRow.lease_token: token,
+            },
+            synchronize_session=False,
+        )
+    )
+    db.commit()
+
+    return (
+        db.query(OutboxMessageRow)
+        .filter(OutboxMessageRow.id.in_(ids), OutboxMessageRow.lease_token == token)
+        .order_by(OutboxMessageRow.priority.asc(), OutboxMessageRow.id.asc())
+        .all()
+    )
+
+
+def save_outbox_results(db: Session, results: list[dict]) -> None:
+    """Grava o resultado dos envios de um lote (UPDATE em lote por id) e faz commit."""
+    if results:
+        cols = ("id", "status", "attempts", "next_attempt_at", "last_error", "sent_at")
+        db.execute(update(OutboxMessageRow), [{k: r[k] for k in cols} for r in results])
+    db.commit()
+
+
+def purge_outbox(db: Session, older_than: datetime, batch_size: int = 500) -> int:
+    """
+    Apaga um lote de chamadas já resolvidas (SENT/FAILED) criadas antes de
+    older_than, as mais antigas primeiro, e faz commit. Retorna quantas
+    apagou; menos que batch_size: acabou. PENDING nunca é apagada.
+    """
+    ids = db.execute(
+        select(OutboxMessageRow.id)
+        .where(
+            OutboxMessageRow.status.in_(("SENT", "FAILED")),
+            OutboxMessageRow.created_at < _utc_naive(older_than),
+        )
+        .order_by(OutboxMessageRow.id)
+        .limit(batch_size)
+    ).scalars().all()
+    if ids:
+        db.execute(delete(OutboxMessageRow).where(OutboxMessageRow.id.in_(ids)))
+    db.commit()
+    return len(ids)
+
 
+def purge_org_commits(db: Session, older_than: datetime, batch_size: int = 500) -> int:
+    """
+    Como purge_outbox, para os registros de org_commits (banco da empresa; a
+    sessão já roteada). Só o último de cada chat ainda pode ser reaplicado, e
+    só até o próximo update dele.
+    """
+    ids = db.execute(
+        select(OrgCommitRow.id)
+        .where(OrgCommitRow.created_at < _utc_naive(older_than))
+        .order_by(OrgCommitRow.id)
+        .limit(batch_size)
+    ).scalars().all()
+    if ids:
+        db.execute(delete(OrgCommitRow).where(OrgCommitRow.id.in_(ids)))
     db.commit()
-    db.refresh(wo)
-    return wo
\ No newline at end of file
+    return len(ids)
+
+
+def has_pending_outbox(db: Session, chat_id: str, exclude: list[OutboxMessageRow] = ()) -> bool:
+    """
+    Se o chat tem chamada ainda não resolvida na fila (inclui as reservadas
+    por um lote), fora as de exclude. Sem flush: com autoflush=False as de
+    exclude que ainda não foram gravadas nem aparecem na consulta.
+    """
+    q = db.query(OutboxMessageRow.id).filter(
+        OutboxMessageRow.chat_id == str(chat_id),
+        OutboxMessageRow.status == "PENDING",
+    )
+    own = [r.id for r in exclude if r.id is not None]
+    if own:
+        q = q.filter(OutboxMessageRow.id.notin_(own))
+    return q.first() is not None
+
+
+def count_pending_outbox(db: Session) -> int:
+    return db.query(OutboxMessageRow).filter(OutboxMessageRow.status == "PENDING").count()
+
+
+def outbox_depth_by_priority(db: Session) -> dict[int, int]:
+    rows = (
+        db.query(OutboxMessageRow.priority, func.count(OutboxMessageRow.id))
+        .filter(OutboxMessageRow.status == "PENDING")
+        .group_by(OutboxMessageRow.priority)
+        .all()
+    )
+    return {int(p): int(n) for p, n in rows}
+
+
+def outbox_due_backlog(db: Session) -> tuple[int, float]:
+    """(mensagens já vencidas e não enviadas, idade em segundos da mais antiga)."""
+    now = datetime.now(timezone.utc)
+    count, oldest = (
+        db.query(func.count(OutboxMessageRow.id), func.min(OutboxMessageRow.next_attempt_at))
+        .filter(OutboxMessageRow.status == "PENDING", OutboxMessageRow.next_attempt_at <= now)
+        .one()
+    )
+    if not oldest:
+        return (int(count or 0), 0.0)
+    if isinstance(oldest, str):
+        oldest = datetime.fromisoformat(oldest)
+    if oldest.tzinfo is None:
+        oldest = oldest.replace(tzinfo=timezone.utc)
+    return (int(count), max(0.0, (now - oldest).total_seconds()))
+
+
+# ============================================================
+# SAÚDE DO BANCO
+# ============================================================
+
+def probe_db_write(db: Session) -> float:
+    """
+    Abre uma transação de escrita que não altera nada e desfaz.
+    Retorna a latência em ms (inclui espera por lock de escrita no SQLite).
+    """
+    t0 = time.perf_counter()
+    try:
+        db.execute(text("UPDATE chat_states SET mode = mode WHERE 1 = 0"))
+    finally:
+        db.rollback()
+    return (time.perf_counter() - t0) * 1000.0
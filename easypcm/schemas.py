@@ -1,3 +1,6 @@
+import re
+import unicodedata
+
 from pydantic import BaseModel, Field
 from typing import Union
 
@@ -5,6 +8,44 @@ from typing import Union
 SEM_INFO = "SEM INFORMAÇÃO"
 
 
+def _fold_tokens(v) -> list[str]:
+    # sem acento, minúscula; só letras/dígitos
+    s = unicodedata.normalize("NFKD", str(v or ""))
+    s = "".join(ch for ch in s if not unicodedata.combining(ch)).lower()
+    return re.findall(r"[a-z0-9]+", s)
+
+
+def normalize_equipamento(v) -> str:
+    """
+    Chave de busca do equipamento (coluna equipamento_norm): sem acento,
+    minúscula, pontuação vira espaço e zeros à esquerda somem dos números.
+    "Bomba-014", "bomba 14" e "BOMBA  14" viram todos "bomba 14".
+    """
+    return " ".join(str(int(t)) if t.isdigit() else t for t in _fold_tokens(v))
+
+
+def trigrams(v) -> frozenset[str]:
+    """
+    Trigramas das palavras (como o pg_trgm: "  p", " pa", ..., "ra "), sem
+    palavras de 1-2 letras ("de", "no") que só aproximam textos diferentes.
+    """
+    grams = set()
+    for word in _fold_tokens(v):
+        if len(word) < 3:
+            continue
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return frozenset(grams)
+
+
+def text_similarity(a, b) -> float:
+    """Jaccard dos trigramas: 0 (nada em comum) a 1 (mesmas palavras)."""
+    ta, tb = trigrams(a), trigrams(b)
+    if not ta or not tb:
+        return 0.0
+    return len(ta & tb) / len(ta | tb)
+
+
 def _norm_str(v) -> str:
     if v is None:
         return SEM_INFO
@@ -0,0 +1,143 @@
+# easypcm/shards.py
+"""
+Modo por empresa (SHARD_BY_ORG): um SQLite por empresa para as tabelas da
+operação (models.TENANT_TABLES), com o banco de DATABASE_URL como catálogo.
+O roteamento fica em db.route_to_org; aqui ficam as ferramentas.
+
+Para ligar num banco que já tem dados, copie as OS de cada empresa para o
+arquivo dela ANTES de subir o serviço com SHARD_BY_ORG=1:
+
+    python -m easypcm.shards migrate
+    python -m easypcm.shards list
+
+A cópia mantém os ids (botões e /consultar antigos continuam valendo) e não
+apaga nada do banco original. Empresa cujo arquivo já tem OS é pulada.
+Exportar ou apagar uma empresa passa a ser copiar ou remover o arquivo dela.
+"""
+import argparse
+import os
+import sqlite3
+
+from .db import SHARD_DIR, engine, shard_path, sync_schema, tenant_engine, tenant_org_ids
+from .models import (
+    TENANT_TABLES,
+    Base,
+    MaterialRow,
+    PreventivePlanRow,
+    TechnicianRow,
+    WorkOrderRow,
+    WorkOrderStatusHistoryRow,
+    WorkOrderTechnicianRow,
+    materials_archive,
+    work_order_technicians_archive,
+    work_orders_archive,
+)
+
+# WHERE de cada tabela da empresa no banco único (? = org_id)
+_WO_IDS = "SELECT id FROM main.work_orders WHERE org_id = ?"
+_ARCHIVED_WO_IDS = "SELECT id FROM main.work_orders_archive WHERE org_id = ?"
+_ORG_FILTERS = {
+    WorkOrderRow.__table__: ("org_id = ?", 1),
+    work_orders_archive: ("org_id = ?", 1),
+    WorkOrderStatusHistoryRow.__table__: ("org_id = ?", 1),
+    PreventivePlanRow.__table__: ("org_id = ?", 1),
+    MaterialRow.__table__: (f"work_order_id IN ({_WO_IDS})", 1),
+    WorkOrderTechnicianRow.__table__: (f"work_order_id IN ({_WO_IDS})", 1),
+    materials_archive: (f"work_order_id IN ({_ARCHIVED_WO_IDS})", 1),
+    work_order_technicians_archive: (f"work_order_id IN ({_ARCHIVED_WO_IDS})", 1),
+    # técnicos são globais no banco único: leva os que a empresa usou
+    TechnicianRow.__table__: (
+        "id IN (SELECT technician_id FROM main.work_order_technicians "
+        f"WHERE work_order_id IN ({_WO_IDS}) "
+        "UNION SELECT technician_id FROM main.work_order_technicians_archive "
+        f"WHERE work_order_id IN ({_ARCHIVED_WO_IDS}))",
+        2,
+    ),
+}
+
+
+def _columns(con: sqlite3.Connection, schema: str, table: str) -> list[str]:
+    return [row[1] for row in con.execute(f"PRAGMA {schema}.table_info({table})")]
+
+
+def migrate_org(con: sqlite3.Connection, org_id: int) -> dict[str, int] | None:
+    """Copia as linhas da empresa do banco aberto em con para o arquivo dela. None se já tinha OS."""
+    tenant_engine(org_id)  # cria o arquivo com o schema atual
+    con.execute("ATTACH DATABASE ? AS shard", (shard_path(org_id),))
+    try:
+        if con.execute("SELECT 1 FROM shard.work_orders LIMIT 1").fetchone():
+            return None
+
+        copied: dict[str, int] = {}
+        con.execute("BEGIN")
+        try:
+            for table in TENANT_TABLES:
+                # só as colunas dos dois lados (o banco antigo pode estar atrás do modelo)
+                shard_cols = set(_columns(con, "shard", table.name))
+                cols = ", ".join(c for c in _columns(con, "main", table.name) if c in shard_cols)
+                where, n_params = _ORG_FILTERS[table]
+                cur = con.execute(
+                    f"INSERT INTO shard.{table.name} ({cols}) SELECT {cols} FROM main.{table.name} WHERE {where}",
+                    (org_id,) * n_params,
+                )
+                copied[table.name] = cur.rowcount
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        return copied
+    finally:
+        con.execute("DETACH DATABASE shard")
+
+
+def migrate_all() -> None:
+    source = engine.url.database
+    if engine.dialect.name != "sqlite" or not source:
+        raise RuntimeError("A migração para o modo por empresa só funciona com SQLite.")
+
+    # o banco de origem precisa de todas as tabelas/colunas do modelo
+    # (arquivo, equipamento_norm...), mesmo com SHARD_BY_ORG=1 no ambiente
+    Base.metadata.create_all(bind=engine)
+    sync_schema(engine, Base.metadata)
+
+    con = sqlite3.connect(source, isolation_level=None)
+    try:
+        for org_id in tenant_org_ids():
+            copied = migrate_org(con, org_id)
+            if copied is None:
+                print(f"org {org_id}: já migrada, pulando")
+            else:
+                # ids novos continuam depois das OS arquivadas que vieram junto
+                sync_schema(tenant_engine(org_id), Base.metadata)
+                print(f"org {org_id}: " + ", ".join(f"{t}={n}" for t, n in copied.items()))
+    finally:
+        con.close()
+
+
+def list_shards() -> None:
+    for org_id in tenant_org_ids():
+        path = shard_path(org_id)
+        if not os.path.exists(path):
+            print(f"org {org_id}: (sem arquivo)")
+            continue
+        con = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            n = con.execute("SELECT count(*) FROM work_orders").fetchone()[0]
+        finally:
+            con.close()
+        print(f"org {org_id}: {path}  {os.path.getsize(path) / 1e6:.1f} MB  {n} OS")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=f"Bancos por empresa do EasyPCM (em {SHARD_DIR})")
+    parser.add_argument("command", choices=("migrate", "list"))
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        migrate_all()
+    else:
+        list_shards()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,72 +1,352 @@
 # easypcm/telegram.py
+import json
+import logging
 import os
-import requests
+import threading
+import time
+
+from .instrumentation import SEND_TOTAL
+from .log import log_event
 
 from .ui_labels import (
     BTN_OPEN, BTN_UPDATE, BTN_CLOSE, BTN_CONSULT,
-    CB_CLOSE_PREFIX, CB_UPDATE_PREFIX, CB_STATUS_PREFIX,
+    BTN_PAGE_PREV, BTN_PAGE_NEXT, BTN_HISTORY, BTN_DUP_ATTACH, BTN_DUP_NEW,
+    BTN_BATCH_START, BTN_BATCH_ALL, BTN_BATCH_DONE, BTN_BATCH_CANCEL,
+    CB_CLOSE_PREFIX, CB_UPDATE_PREFIX, CB_STATUS_PREFIX, CB_VIEW_PREFIX, CB_HISTORY_PREFIX,
+    CB_DUP_PREFIX, CB_BATCH_PREFIX,
+    CB_CLOSE_PAGE_PREFIX, CB_UPDATE_PAGE_PREFIX,
     STATUS_OPTIONS,
 )
 
 
-def send_message(chat_id: str, text: str, reply_markup: dict | None = None) -> None:
+log = logging.getLogger("easypcm.telegram")
+
+# base do Bot API (troque para um servidor fake em benchmarks)
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+
+
+# ============================================================
+# RATE LIMIT (limites do Bot API)
+# ============================================================
+
+# ~30 msg/s no total do bot e ~1 msg/s por chat
+GLOBAL_RATE_PER_SEC = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+CHAT_RATE_PER_SEC = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+
+
+class TokenBucket:
+    """
+    Token bucket simples. reserve() consome um token e devolve quantos
+    segundos faltam até esse token existir (0 = pode enviar agora).
+    """
+
+    def __init__(self, rate_per_sec: float, capacity: float):
+        self.rate = rate_per_sec
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0  # pausa imposta por um 429
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def reserve(self, now: float) -> float:
+        self._refill(now)
+        self.tokens -= 1
+        wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def wait_time(self, now: float) -> float:
+        """Quanto falta para haver um token livre, sem consumir nada."""
+        self._refill(now)
+        need = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(need, self.blocked_until - now)
+
+    def block(self, now: float, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+
+class RateLimiter:
+    def __init__(self, global_rate: float, chat_rate: float):
+        self._lock = threading.Lock()
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._chats: dict[str, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: str, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10_000:
+                # descarta chats ociosos para não crescer sem limite
+                self._chats = {k: b for k, b in self._chats.items() if not b.is_idle(now)}
+            bucket = TokenBucket(self._chat_rate, 1)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def try_acquire(self, chat_id: str | None) -> float:
+        """
+        Consome a vaga só se ela estiver livre agora (retorna 0).
+        Caso contrário não consome nada e retorna quantos segundos faltam.
+        """
+        with self._lock:
+            now = time.monotonic()
+            buckets = [self._global]
+            if chat_id:
+                buckets.append(self._chat_bucket(str(chat_id), now))
+            wait = max(b.wait_time(now) for b in buckets)
+            if wait > 0:
+                return wait
+            for b in buckets:
+                b.reserve(now)
+            return 0.0
+
+    def penalize(self, chat_id: str | None, retry_after: float) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if chat_id:
+                self._chat_bucket(str(chat_id), now).block(now, retry_after)
+            else:
+                self._global.block(now, retry_after)
+
+
+limiter = RateLimiter(GLOBAL_RATE_PER_SEC, CHAT_RATE_PER_SEC)
+
+SEND_OUTCOMES = ("sent", "inline", "throttled", "retried", "dropped")
+
+
+def record_send_event(key: str) -> None:
+    SEND_TOTAL.inc((key,))
+
+
+def get_send_stats() -> dict:
+    """Contadores de envio deste processo: sent, inline, throttled, retried, dropped."""
+    stats = dict.fromkeys(SEND_OUTCOMES, 0)
+    for (outcome,), value in SEND_TOTAL.snapshot().items():
+        stats[outcome] = value
+    return stats
+
+
+# ============================================================
+# ENVIO
+# ============================================================
+
+# resultado de deliver()
+SEND_OK = "ok"
+SEND_RETRY = "retry"
+SEND_FAILED = "failed"
+
+# conexão reaproveitada (keep-alive) entre chamadas; criada no primeiro envio
+# (requests pesa no import e um worker que só responde inline nem usa)
+_http = None
+_http_lock = threading.Lock()
+
+
+def _http_session():
+    global _http
+    if _http is None:
+        import requests
+
+        with _http_lock:
+            if _http is None:
+                _http = requests.Session()
+    return _http
+
+
+def deliver(method: str, payload: dict, chat_id: str | None = None) -> tuple[str, float, str]:
+    """
+    Faz UMA chamada ao Bot API, sem rate limit e sem agendar nada.
+    Retorna (resultado, retry_after, detalhe) para quem chamou decidir o reenvio.
+    """
     token = os.getenv("TELEGRAM_BOT_TOKEN")
 
     if not token:
-        print("ERRO: TELEGRAM_BOT_TOKEN não carregado (None). Verifique .env e load_dotenv().")
-        return
+        log_event(log, "telegram_token_missing", logging.ERROR, method=method)
+        return (SEND_FAILED, 0.0, "token ausente")
+
+    import requests
+
+    url = f"{TELEGRAM_API_BASE}/bot{token}/{method}"
+    t0 = time.perf_counter()
+    try:
+        r = _http_session().post(url, json=payload, timeout=20)
+    except requests.RequestException as e:
+        log_event(log, "telegram_call", logging.WARNING, method=method, dest_chat=chat_id, error=repr(e)[:200])
+        return (SEND_RETRY, 0.0, repr(e)[:500])
+
+    ok = r.status_code == 200
+    log_event(
+        log, "telegram_call", logging.INFO if ok else logging.WARNING, sampled=ok,
+        method=method, dest_chat=chat_id, status=r.status_code,
+        latency_ms=round((time.perf_counter() - t0) * 1000, 2),
+        **({} if ok else {"body": r.text[:200]}),
+    )
+
+    if r.status_code == 429:
+        try:
+            retry_after = float(r.json().get("parameters", {}).get("retry_after", 1))
+        except ValueError:
+            retry_after = 1.0
+        limiter.penalize(chat_id, retry_after)
+        return (SEND_RETRY, retry_after, r.text[:500])
 
-    url = f"https://api.telegram.org/bot{token}/sendMessage"
+    if r.status_code >= 500:
+        return (SEND_RETRY, 0.0, r.text[:500])
 
+    if r.status_code != 200:
+        # 400/403 (chat inexistente, bot bloqueado...) não adianta repetir
+        return (SEND_FAILED, 0.0, r.text[:500])
+
+    return (SEND_OK, 0.0, "")
+
+
+def build_send_message(chat_id: str, text: str, reply_markup: dict | str | None = None) -> dict:
     payload = {
         "chat_id": chat_id,
         "text": text,
     }
     if reply_markup:
         payload["reply_markup"] = reply_markup
+    return payload
+
 
-    r = requests.post(url, json=payload, timeout=20)
-    print("sendMessage:", r.status_code, r.text[:200])
+def build_edit_message_text(
+    chat_id: str,
+    message_id: int,
+    text: str,
+    reply_markup: dict | str | None = None,
+) -> dict:
+    # sem reply_markup o Telegram remove o teclado inline da mensagem
+    payload = build_send_message(chat_id, text, reply_markup)
+    payload["message_id"] = message_id
+    return payload
 
 
-def main_menu_keyboard() -> dict:
+def build_edit_reply_markup(chat_id: str, message_id: int, reply_markup: dict | str) -> dict:
     return {
-        "keyboard": [
-            [BTN_OPEN, BTN_UPDATE],
-            [BTN_CLOSE, BTN_CONSULT],
-        ],
-        "resize_keyboard": True,
-        "is_persistent": True,
-        "one_time_keyboard": False,
-        "input_field_placeholder": "Escolha uma opção abaixo",
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "reply_markup": reply_markup,
     }
 
 
-def close_os_inline_keyboard(items: list[tuple[int, str]]) -> dict:
+def build_answer_callback(callback_query_id: str, text: str = "", show_alert: bool = False) -> dict:
+    payload = {"callback_query_id": callback_query_id}
+    if text:
+        payload["text"] = text
+        payload["show_alert"] = show_alert
+    return payload
+
+
+# ============================================================
+# TECLADOS
+# ============================================================
+# Teclados fixos são montados uma vez e já guardados como JSON:
+# o Bot API aceita reply_markup como string serializada.
+
+_MAIN_MENU_MARKUP = json.dumps({
+    "keyboard": [
+        [BTN_OPEN, BTN_UPDATE],
+        [BTN_CLOSE, BTN_CONSULT],
+    ],
+    "resize_keyboard": True,
+    "is_persistent": True,
+    "one_time_keyboard": False,
+    "input_field_placeholder": "Escolha uma opção abaixo",
+}, ensure_ascii=False)
+
+_STATUS_MARKUP = json.dumps({
+    "inline_keyboard": [
+        [{"text": label, "callback_data": f"{CB_STATUS_PREFIX}{value}"}]
+        for label, value in STATUS_OPTIONS
+    ],
+}, ensure_ascii=False)
+
+
+def main_menu_keyboard() -> str:
+    return _MAIN_MENU_MARKUP
+
+
+def _page_nav_row(prefix: str, page: int, has_more: bool) -> list[dict]:
+    row = []
+    if page > 0:
+        row.append({"text": BTN_PAGE_PREV, "callback_data": f"{prefix}{page - 1}"})
+    if has_more:
+        row.append({"text": BTN_PAGE_NEXT, "callback_data": f"{prefix}{page + 1}"})
+    return row
+
+
+def close_os_inline_keyboard(items: list[tuple[int, str]], page: int = 0, has_more: bool = False) -> dict:
     buttons = []
     for os_id, resumo in items:
         buttons.append([{
             "text": f"#{os_id} - {resumo}",
             "callback_data": f"{CB_CLOSE_PREFIX}{os_id}",
         }])
+    nav = _page_nav_row(CB_CLOSE_PAGE_PREFIX, page, has_more)
+    if nav:
+        buttons.append(nav)
+    buttons.append([{"text": BTN_BATCH_START, "callback_data": f"{CB_BATCH_PREFIX}pg:{page}"}])
     return {"inline_keyboard": buttons}
 
 
-def update_os_inline_keyboard(items: list[tuple[int, str]]) -> dict:
+def batch_close_inline_keyboard(
+    items: list[tuple[int, str]], selected: dict[int, int], page: int = 0, has_more: bool = False,
+) -> dict:
+    """Seletor de várias OS (selected: os_id -> versão): cada toque marca/desmarca, a seleção vale entre páginas."""
     buttons = []
     for os_id, resumo in items:
+        mark = "✅" if os_id in selected else "⬜"
         buttons.append([{
-            "text": f"#{os_id} - {resumo}",
-            "callback_data": f"{CB_UPDATE_PREFIX}{os_id}",
+            "text": f"{mark} #{os_id} - {resumo}",
+            "callback_data": f"{CB_BATCH_PREFIX}tog:{os_id}:{page}",
         }])
+    nav = _page_nav_row(f"{CB_BATCH_PREFIX}pg:", page, has_more)
+    if nav:
+        buttons.append(nav)
+    buttons.append([{"text": BTN_BATCH_ALL, "callback_data": f"{CB_BATCH_PREFIX}all:{page}"}])
+    buttons.append([
+        {"text": f"{BTN_BATCH_DONE} ({len(selected)})", "callback_data": f"{CB_BATCH_PREFIX}ok"},
+        {"text": BTN_BATCH_CANCEL, "callback_data": f"{CB_BATCH_PREFIX}cancel"},
+    ])
     return {"inline_keyboard": buttons}
 
 
-def status_inline_keyboard() -> dict:
+def update_os_inline_keyboard(items: list[tuple[int, str]], page: int = 0, has_more: bool = False) -> dict:
     buttons = []
-    for label, value in STATUS_OPTIONS:
+    for os_id, resumo in items:
         buttons.append([{
-            "text": label,
-            "callback_data": f"{CB_STATUS_PREFIX}{value}",
+            "text": f"#{os_id} - {resumo}",
+            "callback_data": f"{CB_UPDATE_PREFIX}{os_id}",
         }])
+    nav = _page_nav_row(CB_UPDATE_PAGE_PREFIX, page, has_more)
+    if nav:
+        buttons.append(nav)
     return {"inline_keyboard": buttons}
+
+
+def view_os_inline_keyboard(items: list[tuple[int, str]]) -> dict:
+    return {"inline_keyboard": [
+        [{"text": f"#{os_id} - {resumo}", "callback_data": f"{CB_VIEW_PREFIX}{os_id}"}]
+        for os_id, resumo in items
+    ]}
+
+
+def os_card_inline_keyboard(os_id: int) -> dict:
+    return {"inline_keyboard": [[{"text": BTN_HISTORY, "callback_data": f"{CB_HISTORY_PREFIX}{os_id}"}]]}
+
+
+def duplicate_inline_keyboard(os_id: int) -> dict:
+    return {"inline_keyboard": [
+        [{"text": f"{BTN_DUP_ATTACH} (#{os_id})", "callback_data": f"{CB_DUP_PREFIX}attach:{os_id}"}],
+        [{"text": BTN_DUP_NEW, "callback_data": f"{CB_DUP_PREFIX}new"}],
+    ]}
+
+
+def status_inline_keyboard() -> str:
+    return _STATUS_MARKUP
@@ -10,6 +10,11 @@ BTN_CONSULT = "Consultar OS"
 CMD_OPEN = "/abrir"
 CMD_UPDATE = "/atualizar"
 CMD_CLOSE = "/fechar"
+CMD_CLOSE_BATCH = "/fechar_lote"
+CMD_CONSULT = "/consultar"
+CMD_HISTORY = "/historico"
+CMD_BOTTLENECKS = "/gargalos"
+CMD_PREVENTIVE = "/preventiva"
 CMD_MENU_1 = "/menu"
 CMD_MENU_2 = "/opcoes"
 CMD_MENU_3 = "/opções"
@@ -17,8 +22,18 @@ CMD_MENU_3 = "/opções"
 # Callback prefixes
 CB_CLOSE_PREFIX = "close:"
 CB_UPDATE_PREFIX = "update:"
-CB_VIEW_PREFIX = "view:"          # (futuro)
+CB_VIEW_PREFIX = "view:"          # view:<OS> (ficha da OS na consulta)
 CB_STATUS_PREFIX = "status:"      # status:<VALOR>
+CB_HISTORY_PREFIX = "hist:"       # hist:<OS> (histórico do equipamento da OS)
+CB_DUP_PREFIX = "dup:"            # dup:attach:<OS> / dup:new (abertura com OS parecida aberta)
+CB_CLOSE_PAGE_PREFIX = "closepg:"     # closepg:<PÁGINA>
+CB_UPDATE_PAGE_PREFIX = "updatepg:"   # updatepg:<PÁGINA>
+CB_BATCH_PREFIX = "batch:"       # batch:pg:<PÁGINA> / batch:tog:<OS>:<PÁGINA> / batch:all:<PÁGINA> / batch:ok / batch:cancel
+
+# Paginação dos seletores de OS
+PICKER_PAGE_SIZE = 10
+BTN_PAGE_PREV = "« Anteriores"
+BTN_PAGE_NEXT = "Mais »"
 
 # Status (MVP) - valores que vão para o banco
 STATUS_ABERTA = "ABERTA"
@@ -32,7 +47,43 @@ STATUS_AGUARDANDO_PARADA = "AGUARDANDO_PARADA"
 STATUS_AGUARDANDO_TERCEIRO = "AGUARDANDO_TERCEIRO"
 STATUS_AGUARDANDO_OUTROS = "AGUARDANDO_OUTROS"
 
+# Consulta: quantas OS no máximo na lista de resultados
+CONSULT_MAX_RESULTS = 10
+
+# Histórico do equipamento (botão na ficha da OS)
+BTN_HISTORY = "Histórico do equipamento"
+HISTORY_MAX_RESULTS = 10
+
+# Abertura com possível duplicata
+BTN_DUP_ATTACH = "Anexar à OS existente"
+BTN_DUP_NEW = "Abrir nova OS mesmo assim"
+
+# Fechamento em lote (várias OS com as mesmas respostas)
+BTN_BATCH_START = "Fechar várias de uma vez"
+BTN_BATCH_ALL = "Marcar todas da página"
+BTN_BATCH_DONE = "Fechar selecionadas"
+BTN_BATCH_CANCEL = "Cancelar"
+BATCH_CLOSE_MAX = 30
+
+
+
+# Esperas por terceiros (compras, TI, fornecedor...): "balde" do relatório de gargalos
+WAITING_STATUSES = (
+    STATUS_AGUARDANDO_COMPRAS,
+    STATUS_AGUARDANDO_TI,
+    STATUS_AGUARDANDO_SEGURANCA,
+    STATUS_AGUARDANDO_PARADA,
+    STATUS_AGUARDANDO_TERCEIRO,
+    STATUS_AGUARDANDO_OUTROS,
+)
+
+# Relatório de gargalos (/gargalos [dias])
+BOTTLENECK_DEFAULT_DAYS = 30
+BOTTLENECK_MAX_DAYS = 365
+BOTTLENECK_MAX_LINES = 10
 
+# Preventivas (/preventiva): planos listados
+PREVENTIVE_LIST_MAX = 20
 
 # Lista para teclado de status (Atualizar OS)
 STATUS_OPTIONS = [
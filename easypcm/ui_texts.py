@@ -12,6 +12,12 @@ class TXT:
     ASK_PARADA = "A máquina está parada? Responda: SIM ou NÃO"
     PARADA_INVALID = "Resposta inválida. Digite SIM ou NÃO:"
 
+    OPEN_INLINE_USAGE = (
+        "Uso (abertura em uma mensagem):\n"
+        "/abrir equipamento | setor | problema | SIM ou NÃO\n\n"
+        "Ex: /abrir Bomba 14 | Utilidades | vazamento no selo | SIM"
+    )
+
     @staticmethod
     def open_done(os_id: int, equipamento: str, setor: str, parada: str, problema: str) -> str:
         return (
@@ -22,6 +28,28 @@ class TXT:
             f"Problema: {problema}"
         )
 
+    # Abertura: já existe OS aberta parecida
+    @staticmethod
+    def dup_found(os_id: int, equipamento: str, problema: str, abertura: str) -> str:
+        return (
+            f"⚠️ Já existe a OS #{os_id} aberta para {equipamento} com problema parecido:\n\n"
+            f"Problema: {problema}\n"
+            f"Abertura: {abertura}\n\n"
+            "Se for o mesmo problema, anexe seu relato a ela em vez de abrir outra OS."
+        )
+
+    DUP_CHOOSE = "Escolha nos botões da mensagem acima: anexar à OS existente ou abrir nova OS."
+
+    @staticmethod
+    def attach_done(os_id: int, equipamento: str, setor: str, parada: str, problema: str) -> str:
+        return (
+            f"📎 Relato anexado à OS #{os_id}\n\n"
+            f"Equipamento: {equipamento}\n"
+            f"Setor: {setor}\n"
+            f"Parada: {parada}\n"
+            f"Problema: {problema}"
+        )
+
     # Fechamento
     @staticmethod
     def close_intro(os_id: int) -> str:
@@ -58,6 +86,26 @@ class TXT:
         "Se não souber, envie 0."
     )
 
+    CLOSE_INLINE_USAGE = (
+        "Uso (fechamento em uma mensagem):\n"
+        "/fechar OS DATA | solução | HH:MM-HH:MM | técnicos | peças | custo\n\n"
+        "Ex: /fechar 42 HOJE | troca rolamento | 08:10-09:40 | Marcos, João | Rolamento | 35,50\n"
+        "O tempo também pode ser TOTAL 3h. Peças e custo são opcionais."
+    )
+    OS_NOT_FOUND = "OS não encontrada."
+    OS_ALREADY_CLOSED = "Esta OS já está fechada ou cancelada."
+
+    # Conflito de concorrência (outra pessoa gravou antes)
+    @staticmethod
+    def os_conflict(os_id: int) -> str:
+        return (
+            f"⚠️ A OS #{os_id} foi alterada por outra pessoa enquanto você preenchia "
+            "(ex: já foi fechada ou teve o status trocado).\n"
+            "Nada foi gravado. Confira a OS e comece de novo pelo menu."
+        )
+
+    CHAT_CONFLICT = "⚠️ Recebi duas ações suas ao mesmo tempo e esta não foi aplicada. Envie de novo."
+
     @staticmethod
     def close_done(os_id: int, equipamento: str, setor: str, data_fechamento: str, tempo_min: str, tecnicos: str, pecas: str, custo: str, solucao: str) -> str:
         return (
@@ -72,6 +120,50 @@ class TXT:
             f"Solução: {solucao}"
         )
 
+    # Fechamento em lote (mesmas respostas para várias OS)
+    BATCH_PICK = (
+        "Marque as OS que serão fechadas com as MESMAS respostas "
+        "(data, solução, tempo, técnicos, peças e custo) e toque em Fechar selecionadas."
+    )
+    BATCH_PICK_BUTTONS = "Use os botões da mensagem acima: marque as OS e toque em Fechar selecionadas."
+    BATCH_EMPTY = "Marque pelo menos uma OS."
+    BATCH_CANCELLED = "Fechamento em lote cancelado."
+
+    @staticmethod
+    def batch_limit(max_os: int) -> str:
+        return f"No máximo {max_os} OS por lote."
+
+    @staticmethod
+    def batch_intro(os_ids: list[int]) -> str:
+        lista = ", ".join(f"#{os_id}" for os_id in os_ids)
+        return (
+            f"Ok. Vamos fechar {len(os_ids)} OS: {lista}\n"
+            "As próximas respostas valem para todas elas (o custo de peças é por OS).\n\n"
+            "Escreva HOJE ou coloque a data no formato DD/MM/AAAA."
+        )
+
+    @staticmethod
+    def batch_close_done(rows: list[tuple[int, str, str]], data_fechamento: str, tempo_min: str, tecnicos: str, pecas: str, custo: str, solucao: str) -> str:
+        # rows: (id, equipamento, setor) de cada OS fechada
+        linhas = "\n".join(f"#{os_id} - {equipamento} ({setor})" for os_id, equipamento, setor in rows)
+        return (
+            f"✅ {len(rows)} OS FECHADAS\n\n"
+            f"{linhas}\n\n"
+            f"Data execução: {data_fechamento}\n"
+            f"Tempo (min): {tempo_min}\n"
+            f"Técnicos: {tecnicos}\n"
+            f"Peças: {pecas}\n"
+            f"Custo peças (por OS): {custo}\n"
+            f"Solução: {solucao}"
+        )
+
+    CLOSE_BATCH_INLINE_USAGE = (
+        "Uso (várias OS com as mesmas respostas):\n"
+        "/fechar_lote OS,OS,OS DATA | solução | HH:MM-HH:MM | técnicos | peças | custo\n\n"
+        "Ex: /fechar_lote 42,43,47 HOJE | lubrificação | TOTAL 30 | Marcos | Graxa | 0\n"
+        "Sem OS, /fechar_lote abre o seletor para marcar as OS."
+    )
+
     # Atualizar OS
     UPDATE_PICK_OS = "Selecione a OS para atualizar:"
     @staticmethod
@@ -84,6 +176,10 @@ class TXT:
         "Se não quiser, digite: PULAR"
     )
 
+    @staticmethod
+    def update_ask_obs(status_label: str) -> str:
+        return f"Novo status: {status_label}\n\n" + TXT.UPDATE_ASK_OBS
+
     @staticmethod
     def update_done(os_id: int, status: str, obs: str) -> str:
         obs_txt = obs if obs.strip() else "SEM OBSERVAÇÃO"
@@ -93,8 +189,186 @@ class TXT:
             f"Obs: {obs_txt}"
         )
 
+    # Consultar OS
+    CONSULT_START = (
+        "Qual OS você quer consultar?\n\n"
+        "Envie o número (ex: 42), o equipamento (ex: Bomba 14) "
+        "ou um status (ex: ABERTA, FECHADA, Aguardando compras)."
+    )
+    CONSULT_NOT_FOUND = "Nenhuma OS encontrada para essa busca."
+
+    @staticmethod
+    def consult_results(termo: str, total: int, limite: int) -> str:
+        if total >= limite:
+            return f"OS encontradas para \"{termo}\" (as {limite} mais recentes):"
+        return f"OS encontradas para \"{termo}\":"
+
+    @staticmethod
+    def os_card(
+        os_id: int, status: str, equipamento: str, setor: str, parada: str, problema: str,
+        abertura: str, obs: str, fechamento: str, tempo_min: str, tecnicos: str, pecas: str,
+        custo: str, solucao: str, tipo: str = "",
+    ) -> str:
+        lines = [
+            f"📋 OS #{os_id} - {status}",
+            "",
+            f"Equipamento: {equipamento}",
+            f"Setor: {setor}",
+        ]
+        if tipo:
+            lines.append(f"Tipo: {tipo}")
+        lines += [
+            f"Parada: {parada}",
+            f"Problema: {problema}",
+            f"Abertura: {abertura}",
+        ]
+        if obs.strip():
+            lines.append(f"Obs: {obs}")
+        if fechamento:
+            lines += [
+                "",
+                f"Data execução: {fechamento}",
+                f"Tempo (min): {tempo_min}",
+                f"Técnicos: {tecnicos}",
+                f"Peças: {pecas}",
+                f"Custo peças: {custo}",
+                f"Solução: {solucao}",
+            ]
+        return "\n".join(lines)
+
+    # Histórico do equipamento
+    HISTORY_USAGE = (
+        "Uso: /historico EQUIPAMENTO  (ex: /historico Bomba 14)\n"
+        "ou /historico NÚMERO-DA-OS para o equipamento daquela OS."
+    )
+
+    @staticmethod
+    def history_empty(equipamento: str) -> str:
+        return f"Nenhuma OS encontrada para o equipamento \"{equipamento}\"."
+
+    @staticmethod
+    def history(equipamento: str, rows: list[tuple[int, str, str, str]]) -> str:
+        lines = [f"🛠 Histórico: {equipamento} (últimas {len(rows)})", ""]
+        for os_id, data, status, problema in rows:
+            lines.append(f"#{os_id} {data} - {status} - {problema}")
+        return "\n".join(lines)
+
+    # Gargalos (tempo em cada status)
+    BOTTLENECK_USAGE = "Uso: /gargalos [DIAS]  (padrão: 30, máximo: 365)"
+
+    @staticmethod
+    def bottleneck_empty(dias: int) -> str:
+        return f"Nenhuma troca de status registrada nos últimos {dias} dias."
+
+    @staticmethod
+    def bottlenecks(dias: int, por_status: list[tuple[str, int, str, str]], esperas: list[tuple[str, str, int, str]]) -> str:
+        lines = [f"⏳ Gargalos - últimos {dias} dias", "", "Tempo em cada status:"]
+        for label, n, media, total in por_status:
+            lines.append(f"{label}: {n}x, média {media}, total {total}")
+        if esperas:
+            lines += ["", "Maiores esperas por setor:"]
+            for setor, label, n, media in esperas:
+                lines.append(f"{setor} - {label}: {n}x, média {media}")
+        return "\n".join(lines)
+
+    # Alertas (máquina parada)
+    @staticmethod
+    def machine_down_alert(os_id: int, equipamento: str, setor: str, problema: str) -> str:
+        return (
+            f"🚨 MÁQUINA PARADA - OS #{os_id}\n\n"
+            f"Equipamento: {equipamento}\n"
+            f"Setor: {setor}\n"
+            f"Problema: {problema}"
+        )
+
+    ALERTS_USAGE = (
+        "Uso:\n"
+        "/alertas  (lista quem recebe alerta de máquina parada)\n"
+        "/alertas add PERFIL [SETOR]  (PERFIL: ADMIN, USUARIO ou TODOS)\n"
+        "/alertas del ID\n\n"
+        "Para o aviso de preventivas geradas, comece com PREVENTIVA:\n"
+        "/alertas preventiva add ADMIN Utilidades"
+    )
+    ALERTS_DEFAULT = "Nenhuma regra cadastrada: todos os membros ativos recebem alertas de máquina parada."
+    ALERTS_DEFAULT_PREVENTIVE = "Nenhuma regra cadastrada: todos os membros ativos recebem o aviso de preventivas."
+    ALERTS_ONLY_ADMIN = "Sem permissão. Apenas ADMIN da empresa pode configurar alertas."
+
+    @staticmethod
+    def alerts_list(rules: list[tuple[int, str, str]], evento: str = "máquina parada") -> str:
+        lines = [f"Regras de alerta ({evento}):", ""]
+        for sub_id, role, setor in rules:
+            lines.append(f"#{sub_id} - Perfil: {role or 'TODOS'} | Setor: {setor or 'TODOS'}")
+        return "\n".join(lines)
+
+    # Preventivas (/preventiva)
+    PREVENTIVE_USAGE = (
+        "Uso:\n"
+        "/preventiva  (lista os planos)\n"
+        "/preventiva add equipamento | setor | tarefa | regra [| item; item; ...]\n"
+        "/preventiva del ID\n\n"
+        "Regra: 30 dias, diaria, semanal SEG, mensal 5\n"
+        "Ex: /preventiva add Bomba 14 | Utilidades | Lubrificar mancais | 30 dias | graxa nos mancais; conferir vibração"
+    )
+    PREVENTIVE_RULE_INVALID = "Regra inválida. Use: 30 dias, diaria, semanal SEG (SEG a DOM) ou mensal 5 (dia 1 a 31)."
+    PREVENTIVE_ONLY_ADMIN = "Sem permissão. Apenas ADMIN da empresa pode cadastrar ou remover preventivas."
+    PREVENTIVE_EMPTY = "Nenhum plano de preventiva cadastrado."
+    PREVENTIVE_NOT_FOUND = "Plano não encontrado."
+
+    _WEEKDAY_LABELS = ("segunda", "terça", "quarta", "quinta", "sexta", "sábado", "domingo")
+
+    @staticmethod
+    def preventive_rule(regra: str, valor: int) -> str:
+        if regra == "SEMANAL":
+            return f"semanal ({TXT._WEEKDAY_LABELS[valor % 7]})"
+        if regra == "MENSAL":
+            return f"mensal (dia {valor})"
+        return "diária" if valor == 1 else f"a cada {valor} dias"
+
+    @staticmethod
+    def preventive_created(plan_id: int, equipamento: str, tarefa: str, regra: str, proxima: str) -> str:
+        return (
+            f"🗓 Plano #{plan_id} cadastrado\n\n"
+            f"Equipamento: {equipamento}\n"
+            f"Tarefa: {tarefa}\n"
+            f"Regra: {regra}\n"
+            f"Primeira OS: {proxima}"
+        )
+
+    @staticmethod
+    def preventive_removed(plan_id: int) -> str:
+        return f"Plano #{plan_id} removido. As OS já geradas continuam como estão."
+
+    @staticmethod
+    def preventive_list(rows: list[tuple[int, str, str, str, str]], total: int) -> str:
+        lines = [f"🗓 Planos de preventiva ({total})", ""]
+        for plan_id, equipamento, tarefa, regra, proxima in rows:
+            lines.append(f"#{plan_id} {equipamento} - {tarefa} - {regra} - próxima {proxima}")
+        if total > len(rows):
+            lines.append(f"... e mais {total - len(rows)}")
+        return "\n".join(lines)
+
+    @staticmethod
+    def preventive_problem(tarefa: str, itens: list[str], prevista_em: str = "") -> str:
+        """Descrição da OS gerada pelo plano (prevista_em: só quando saiu atrasada)."""
+        lines = [f"Preventiva: {tarefa}"]
+        if itens:
+            lines += ["Checklist:"] + [f"- {item}" for item in itens]
+        if prevista_em:
+            lines.append(f"(prevista para {prevista_em})")
+        return "\n".join(lines)
+
+    @staticmethod
+    def preventive_alert(rows: list[tuple[int, str, str, str]], max_lines: int = 30) -> str:
+        lines = [f"🗓 PREVENTIVAS GERADAS ({len(rows)})", ""]
+        for os_id, equipamento, setor, tarefa in rows[:max_lines]:
+            lines.append(f"#{os_id} {equipamento} ({setor}) - {tarefa}")
+        if len(rows) > max_lines:
+            lines.append(f"... e mais {len(rows) - max_lines}. Veja em /consultar ABERTA.")
+        return "\n".join(lines)
+
     # Gerais
     UNKNOWN_ACTION = "Ação não reconhecida."
+    NOT_IN_ORG = "Você ainda não está em uma empresa. Use: /entrar SEU-CÓDIGO"
     UNKNOWN_COMMAND = "Escolha uma opção abaixo ⬇"
     NO_OPEN_OS_TO_CLOSE = "Não encontrei OS abertas para fechar."
     NO_OPEN_OS_TO_UPDATE = "Não encontrei OS abertas para atualizar."
@@ -0,0 +1,136 @@
+# serve.py
+"""
+Entrada de produção: N processos uvicorn atendendo a mesma porta.
+
+- o schema é criado/atualizado UMA vez aqui, antes de subir os workers
+  (os workers não rodam create_all no import: EASYPCM_SCHEMA_READY=1);
+- cada worker é um processo novo (spawn) com engine/conexões próprias;
+  no SQLite: WAL, busy_timeout e BEGIN IMMEDIATE (ver easypcm/db.py);
+- dedup (events) e estado da conversa (chat_states + version) já ficam no
+  banco, então qualquer worker pode receber qualquer update;
+- o envio do outbox roda só neste processo: um único rate limit do bot
+  (~30 msg/s) em vez de um por worker. Com mais de um worker a resposta
+  inline no corpo do webhook fica desligada (INLINE_REPLY_ENABLED=0): cada
+  worker teria o próprio limiter em memória e, somados, passariam do limite
+  do bot. Os workers só gravam no outbox;
+- SIGTERM/SIGINT: o uvicorn para de aceitar conexões e espera os updates em
+  andamento (--graceful-timeout); depois o outbox é drenado;
+- o arquivo de OS fechadas antigas (easypcm/archive.py) e o backup online
+  do SQLite (easypcm/backup.py) também rodam só aqui, em passos curtos;
+- métricas: cada processo (workers e este) grava contadores e histogramas
+  em METRICS_DIR (um diretório temporário, se não informado) e o /metrics de
+  qualquer worker devolve a soma de todos. Sem isso cada raspagem caía num
+  worker diferente e os contadores pareciam zerar; envio e backup, que só
+  rodam aqui, ficavam sempre em 0;
+- o agendador de preventivas (easypcm/preventive.py) também: um heap só,
+  sem dois processos gerando a mesma OS.
+
+Uso:
+    python serve.py --workers 4 --port 8000
+
+Para desenvolvimento continue usando: uvicorn app:app --reload
+"""
+import argparse
+import glob
+import logging
+import os
+import shutil
+import tempfile
+
+from dotenv import load_dotenv
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Sobe o EasyPCM com vários workers")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1))))
+    parser.add_argument("--graceful-timeout", type=int, default=30,
+                        help="segundos para terminar os updates em andamento no shutdown")
+    parser.add_argument("--outbox-poll", type=float, default=0.2,
+                        help="intervalo de varredura do outbox (os workers não conseguem acordar o envio)")
+    parser.add_argument("--no-outbox", dest="outbox", action="store_false",
+                        help="não envia o outbox neste processo (ex: outro serviço envia)")
+    parser.add_argument("--no-archive", dest="archive", action="store_false",
+                        help="não roda o arquivo de OS antigas neste processo (ex: roda no cron)")
+    parser.add_argument("--no-backup", dest="backup", action="store_false",
+                        help="não faz o backup automático neste processo (ex: roda no cron)")
+    parser.add_argument("--no-preventive", dest="preventive", action="store_false",
+                        help="não gera as OS de preventiva neste processo (ex: roda no cron)")
+    args = parser.parse_args()
+
+    load_dotenv()
+    # valem para este processo e são herdadas pelos workers
+    os.environ["EASYPCM_SCHEMA_READY"] = "1"
+    os.environ["OUTBOX_WORKER_ENABLED"] = "0"
+    os.environ["ARCHIVE_WORKER_ENABLED"] = "0"
+    os.environ["BACKUP_WORKER_ENABLED"] = "0"
+    os.environ["PREVENTIVE_WORKER_ENABLED"] = "0"
+    if args.workers > 1:
+        os.environ.setdefault("SQLITE_BEGIN_IMMEDIATE", "1")
+        # todo envio passa pelo limiter deste processo (ver docstring)
+        os.environ["INLINE_REPLY_ENABLED"] = "0"
+    own_metrics_dir = not os.getenv("METRICS_DIR")
+    if own_metrics_dir:
+        os.environ["METRICS_DIR"] = tempfile.mkdtemp(prefix="easypcm-metrics-")
+    else:
+        # contadores de uma execução anterior somariam com os desta
+        for path in glob.glob(os.path.join(os.environ["METRICS_DIR"], "*.json")):
+            os.remove(path)
+
+    import uvicorn
+    from easypcm.archive import archive_worker
+    from easypcm.backup import backup_worker
+    from easypcm.db import engine, init_db
+    from easypcm.instrumentation import metrics_exporter
+    from easypcm.log import log_event, setup_logging, stop_logging
+    from easypcm.outbox import outbox_worker
+    from easypcm.preventive import preventive_worker
+
+    setup_logging()
+    log = logging.getLogger("easypcm.serve")
+
+    added = init_db()
+    # os workers abrem as próprias conexões; nada herdado deste processo
+    engine.dispose()
+    log_event(log, "schema_ready", added=added, workers=args.workers)
+
+    metrics_exporter.start()
+    if args.outbox:
+        outbox_worker.poll_interval = args.outbox_poll
+        outbox_worker.start()
+    if args.archive:
+        archive_worker.start()
+    if args.backup:
+        backup_worker.start()
+    if args.preventive:
+        preventive_worker.start()
+
+    try:
+        uvicorn.run(
+            "app:app",
+            host=args.host,
+            port=args.port,
+            workers=args.workers,
+            timeout_graceful_shutdown=args.graceful_timeout,
+            proxy_headers=True,
+        )
+    finally:
+        if args.archive:
+            archive_worker.stop()
+        if args.backup:
+            backup_worker.stop()
+        if args.preventive:
+            preventive_worker.stop()
+        if args.outbox:
+            outbox_worker.stop()
+            outbox_worker.drain()
+        metrics_exporter.stop()
+        if own_metrics_dir:
+            shutil.rmtree(os.environ["METRICS_DIR"], ignore_errors=True)
+        log_event(log, "shutdown_complete")
+        stop_logging()
+
+
+if __name__ == "__main__":
+    main()